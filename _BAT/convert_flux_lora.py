@@ -109,12 +109,12 @@ double_blocks.0.processor.qkv_lora2.up.weight torch.Size([9216, 16])
 
 
 import argparse
-from safetensors.torch import save_file
+import time
 from safetensors import safe_open
 import torch
 
 
-from library.utils import setup_logging
+from library.utils import setup_logging, SafetensorsStreamWriter
 
 setup_logging()
 import logging
@@ -122,6 +122,65 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def make_conversion_table():
+    """
+    conversion table between sd-scripts and ai-toolkit keys: (sd-scripts key, [ai-toolkit keys], dims of split up weights or None).
+    single ai-toolkit key is renamed, multiple keys are concatenated to / split from one sd-scripts module.
+    """
+    table = []
+    for i in range(19):
+        block = f"transformer.transformer_blocks.{i}"
+        table += [
+            (f"lora_unet_double_blocks_{i}_img_attn_proj", [f"{block}.attn.to_out.0"], None),
+            (f"lora_unet_double_blocks_{i}_img_attn_qkv", [f"{block}.attn.to_q", f"{block}.attn.to_k", f"{block}.attn.to_v"], None),
+            (f"lora_unet_double_blocks_{i}_img_mlp_0", [f"{block}.ff.net.0.proj"], None),
+            (f"lora_unet_double_blocks_{i}_img_mlp_2", [f"{block}.ff.net.2"], None),
+            (f"lora_unet_double_blocks_{i}_img_mod_lin", [f"{block}.norm1.linear"], None),
+            (f"lora_unet_double_blocks_{i}_txt_attn_proj", [f"{block}.attn.to_add_out"], None),
+            (
+                f"lora_unet_double_blocks_{i}_txt_attn_qkv",
+                [f"{block}.attn.add_q_proj", f"{block}.attn.add_k_proj", f"{block}.attn.add_v_proj"],
+                None,
+            ),
+            (f"lora_unet_double_blocks_{i}_txt_mlp_0", [f"{block}.ff_context.net.0.proj"], None),
+            (f"lora_unet_double_blocks_{i}_txt_mlp_2", [f"{block}.ff_context.net.2"], None),
+            (f"lora_unet_double_blocks_{i}_txt_mod_lin", [f"{block}.norm1_context.linear"], None),
+        ]
+
+    for i in range(38):
+        block = f"transformer.single_transformer_blocks.{i}"
+        table += [
+            (
+                f"lora_unet_single_blocks_{i}_linear1",
+                [f"{block}.attn.to_q", f"{block}.attn.to_k", f"{block}.attn.to_v", f"{block}.proj_mlp"],
+                [3072, 3072, 3072, 12288],
+            ),
+            (f"lora_unet_single_blocks_{i}_linear2", [f"{block}.proj_out"], None),
+            (f"lora_unet_single_blocks_{i}_modulation_lin", [f"{block}.norm.linear"], None),
+        ]
+    return table
+
+
+# compiled once at import, shared by both directions
+CONVERSION_TABLE = make_conversion_table()
+
+
+def get_scale_down_and_up(scale):
+    # calculate scale_down and scale_up to keep the same value. if scale is 4, scale_down is 2 and scale_up is 2
+    scale_down = scale
+    scale_up = 1.0
+    while scale_down * 2 < scale_up:
+        scale_down *= 2
+        scale_up /= 2
+    # print(f"scale: {scale}, scale_down: {scale_down}, scale_up: {scale_up}")
+    return scale_down, scale_up
+
+
+def scale_weight(weight, scale):
+    # keep the loaded tensor (no copy) if the scale is 1
+    return weight if scale == 1.0 else weight * scale
+
+
 def convert_to_sd_scripts(sds_sd, ait_sd, sds_key, ait_key):
     ait_down_key = ait_key + ".lora_A.weight"
     if ait_down_key not in ait_sd:
@@ -169,70 +228,11 @@ def convert_to_sd_scripts_cat(sds_sd, ait_sd, sds_key, ait_keys):
 
 def convert_ai_toolkit_to_sd_scripts(ait_sd):
     sds_sd = {}
-    for i in range(19):
-        convert_to_sd_scripts(
-            sds_sd, ait_sd, f"lora_unet_double_blocks_{i}_img_attn_proj", f"transformer.transformer_blocks.{i}.attn.to_out.0"
-        )
-        convert_to_sd_scripts_cat(
-            sds_sd,
-            ait_sd,
-            f"lora_unet_double_blocks_{i}_img_attn_qkv",
-            [
-                f"transformer.transformer_blocks.{i}.attn.to_q",
-                f"transformer.transformer_blocks.{i}.attn.to_k",
-                f"transformer.transformer_blocks.{i}.attn.to_v",
-            ],
-        )
-        convert_to_sd_scripts(
-            sds_sd, ait_sd, f"lora_unet_double_blocks_{i}_img_mlp_0", f"transformer.transformer_blocks.{i}.ff.net.0.proj"
-        )
-        convert_to_sd_scripts(
-            sds_sd, ait_sd, f"lora_unet_double_blocks_{i}_img_mlp_2", f"transformer.transformer_blocks.{i}.ff.net.2"
-        )
-        convert_to_sd_scripts(
-            sds_sd, ait_sd, f"lora_unet_double_blocks_{i}_img_mod_lin", f"transformer.transformer_blocks.{i}.norm1.linear"
-        )
-        convert_to_sd_scripts(
-            sds_sd, ait_sd, f"lora_unet_double_blocks_{i}_txt_attn_proj", f"transformer.transformer_blocks.{i}.attn.to_add_out"
-        )
-        convert_to_sd_scripts_cat(
-            sds_sd,
-            ait_sd,
-            f"lora_unet_double_blocks_{i}_txt_attn_qkv",
-            [
-                f"transformer.transformer_blocks.{i}.attn.add_q_proj",
-                f"transformer.transformer_blocks.{i}.attn.add_k_proj",
-                f"transformer.transformer_blocks.{i}.attn.add_v_proj",
-            ],
-        )
-        convert_to_sd_scripts(
-            sds_sd, ait_sd, f"lora_unet_double_blocks_{i}_txt_mlp_0", f"transformer.transformer_blocks.{i}.ff_context.net.0.proj"
-        )
-        convert_to_sd_scripts(
-            sds_sd, ait_sd, f"lora_unet_double_blocks_{i}_txt_mlp_2", f"transformer.transformer_blocks.{i}.ff_context.net.2"
-        )
-        convert_to_sd_scripts(
-            sds_sd, ait_sd, f"lora_unet_double_blocks_{i}_txt_mod_lin", f"transformer.transformer_blocks.{i}.norm1_context.linear"
-        )
-
-    for i in range(38):
-        convert_to_sd_scripts_cat(
-            sds_sd,
-            ait_sd,
-            f"lora_unet_single_blocks_{i}_linear1",
-            [
-                f"transformer.single_transformer_blocks.{i}.attn.to_q",
-                f"transformer.single_transformer_blocks.{i}.attn.to_k",
-                f"transformer.single_transformer_blocks.{i}.attn.to_v",
-                f"transformer.single_transformer_blocks.{i}.proj_mlp",
-            ],
-        )
-        convert_to_sd_scripts(
-            sds_sd, ait_sd, f"lora_unet_single_blocks_{i}_linear2", f"transformer.single_transformer_blocks.{i}.proj_out"
-        )
-        convert_to_sd_scripts(
-            sds_sd, ait_sd, f"lora_unet_single_blocks_{i}_modulation_lin", f"transformer.single_transformer_blocks.{i}.norm.linear"
-        )
+    for sds_key, ait_keys, _ in CONVERSION_TABLE:
+        if len(ait_keys) == 1:
+            convert_to_sd_scripts(sds_sd, ait_sd, sds_key, ait_keys[0])
+        else:
+            convert_to_sd_scripts_cat(sds_sd, ait_sd, sds_key, ait_keys)
 
     if len(ait_sd) > 0:
         logger.warning(f"Unsuppored keys for sd-scripts: {ait_sd.keys()}")
@@ -250,16 +250,10 @@ def convert_to_ai_toolkit(sds_sd, ait_sd, sds_key, ait_key):
     scale = alpha / rank  # LoRA is scaled by 'alpha / rank' in forward pass, so we need to scale it back here
     # print(f"rank: {rank}, alpha: {alpha}, scale: {scale}")
 
-    # calculate scale_down and scale_up to keep the same value. if scale is 4, scale_down is 2 and scale_up is 2
-    scale_down = scale
-    scale_up = 1.0
-    while scale_down * 2 < scale_up:
-        scale_down *= 2
-        scale_up /= 2
-    # print(f"scale: {scale}, scale_down: {scale_down}, scale_up: {scale_up}")
+    scale_down, scale_up = get_scale_down_and_up(scale)
 
-    ait_sd[ait_key + ".lora_A.weight"] = down_weight * scale_down
-    ait_sd[ait_key + ".lora_B.weight"] = sds_sd.pop(sds_key + ".lora_up.weight") * scale_up
+    ait_sd[ait_key + ".lora_A.weight"] = scale_weight(down_weight, scale_down)
+    ait_sd[ait_key + ".lora_B.weight"] = scale_weight(sds_sd.pop(sds_key + ".lora_up.weight"), scale_up)
 
 
 def convert_to_ai_toolkit_cat(sds_sd, ait_sd, sds_key, ait_keys, dims=None):
@@ -270,18 +264,12 @@ def convert_to_ai_toolkit_cat(sds_sd, ait_sd, sds_key, ait_keys, dims=None):
     sd_lora_rank = down_weight.shape[0]
 
     # scale weight by alpha and dim
-    alpha = sds_sd.pop(sds_key + ".alpha")
+    alpha = sds_sd.pop(sds_key + ".alpha").item()
     scale = alpha / sd_lora_rank
 
-    # calculate scale_down and scale_up
-    scale_down = scale
-    scale_up = 1.0
-    while scale_down * 2 < scale_up:
-        scale_down *= 2
-        scale_up /= 2
-
-    down_weight = down_weight * scale_down
-    up_weight = up_weight * scale_up
+    scale_down, scale_up = get_scale_down_and_up(scale)
+    down_weight = scale_weight(down_weight, scale_down)
+    up_weight = scale_weight(up_weight, scale_up)
 
     # calculate dims if not provided
     num_splits = len(ait_keys)
@@ -305,7 +293,7 @@ def convert_to_ai_toolkit_cat(sds_sd, ait_sd, sds_key, ait_keys, dims=None):
         if is_sparse:
             logger.info(f"weight is sparse: {sds_key}")
 
-    # make ai-toolkit weight
+    # make ai-toolkit weight. all weights are views of down_weight/up_weight, the writer does not need separate storages
     ait_down_keys = [k + ".lora_A.weight" for k in ait_keys]
     ait_up_keys = [k + ".lora_B.weight" for k in ait_keys]
     if not is_sparse:
@@ -321,83 +309,68 @@ def convert_to_ai_toolkit_cat(sds_sd, ait_sd, sds_key, ait_keys, dims=None):
         # up_weight is sparse: only non-zero values are copied to each split
         i = 0
         for j in range(len(dims)):
-            ait_sd[ait_up_keys[j]] = up_weight[i : i + dims[j], j * ait_rank : (j + 1) * ait_rank].contiguous()
+            ait_sd[ait_up_keys[j]] = up_weight[i : i + dims[j], j * ait_rank : (j + 1) * ait_rank]
             i += dims[j]
 
 
 def convert_sd_scripts_to_ai_toolkit(sds_sd):
     ait_sd = {}
-    for i in range(19):
-        convert_to_ai_toolkit(
-            sds_sd, ait_sd, f"lora_unet_double_blocks_{i}_img_attn_proj", f"transformer.transformer_blocks.{i}.attn.to_out.0"
-        )
-        convert_to_ai_toolkit_cat(
-            sds_sd,
-            ait_sd,
-            f"lora_unet_double_blocks_{i}_img_attn_qkv",
-            [
-                f"transformer.transformer_blocks.{i}.attn.to_q",
-                f"transformer.transformer_blocks.{i}.attn.to_k",
-                f"transformer.transformer_blocks.{i}.attn.to_v",
-            ],
-        )
-        convert_to_ai_toolkit(
-            sds_sd, ait_sd, f"lora_unet_double_blocks_{i}_img_mlp_0", f"transformer.transformer_blocks.{i}.ff.net.0.proj"
-        )
-        convert_to_ai_toolkit(
-            sds_sd, ait_sd, f"lora_unet_double_blocks_{i}_img_mlp_2", f"transformer.transformer_blocks.{i}.ff.net.2"
-        )
-        convert_to_ai_toolkit(
-            sds_sd, ait_sd, f"lora_unet_double_blocks_{i}_img_mod_lin", f"transformer.transformer_blocks.{i}.norm1.linear"
-        )
-        convert_to_ai_toolkit(
-            sds_sd, ait_sd, f"lora_unet_double_blocks_{i}_txt_attn_proj", f"transformer.transformer_blocks.{i}.attn.to_add_out"
-        )
-        convert_to_ai_toolkit_cat(
-            sds_sd,
-            ait_sd,
-            f"lora_unet_double_blocks_{i}_txt_attn_qkv",
-            [
-                f"transformer.transformer_blocks.{i}.attn.add_q_proj",
-                f"transformer.transformer_blocks.{i}.attn.add_k_proj",
-                f"transformer.transformer_blocks.{i}.attn.add_v_proj",
-            ],
-        )
-        convert_to_ai_toolkit(
-            sds_sd, ait_sd, f"lora_unet_double_blocks_{i}_txt_mlp_0", f"transformer.transformer_blocks.{i}.ff_context.net.0.proj"
-        )
-        convert_to_ai_toolkit(
-            sds_sd, ait_sd, f"lora_unet_double_blocks_{i}_txt_mlp_2", f"transformer.transformer_blocks.{i}.ff_context.net.2"
-        )
-        convert_to_ai_toolkit(
-            sds_sd, ait_sd, f"lora_unet_double_blocks_{i}_txt_mod_lin", f"transformer.transformer_blocks.{i}.norm1_context.linear"
-        )
-
-    for i in range(38):
-        convert_to_ai_toolkit_cat(
-            sds_sd,
-            ait_sd,
-            f"lora_unet_single_blocks_{i}_linear1",
-            [
-                f"transformer.single_transformer_blocks.{i}.attn.to_q",
-                f"transformer.single_transformer_blocks.{i}.attn.to_k",
-                f"transformer.single_transformer_blocks.{i}.attn.to_v",
-                f"transformer.single_transformer_blocks.{i}.proj_mlp",
-            ],
-            dims=[3072, 3072, 3072, 12288],
-        )
-        convert_to_ai_toolkit(
-            sds_sd, ait_sd, f"lora_unet_single_blocks_{i}_linear2", f"transformer.single_transformer_blocks.{i}.proj_out"
-        )
-        convert_to_ai_toolkit(
-            sds_sd, ait_sd, f"lora_unet_single_blocks_{i}_modulation_lin", f"transformer.single_transformer_blocks.{i}.norm.linear"
-        )
+    for sds_key, ait_keys, dims in CONVERSION_TABLE:
+        if len(ait_keys) == 1:
+            convert_to_ai_toolkit(sds_sd, ait_sd, sds_key, ait_keys[0])
+        else:
+            convert_to_ai_toolkit_cat(sds_sd, ait_sd, sds_key, ait_keys, dims)
 
     if len(sds_sd) > 0:
         logger.warning(f"Unsuppored keys for ai-toolkit: {sds_sd.keys()}")
     return ait_sd
 
 
+CONVERTERS = {
+    ("ai-toolkit", "sd-scripts"): convert_ai_toolkit_to_sd_scripts,
+    ("sd-scripts", "ai-toolkit"): convert_sd_scripts_to_ai_toolkit,
+}
+
+
+def get_effective_weight(state_dict, format, sds_key, ait_keys):
+    """
+    calculate delta weight (up @ down * scale) of the module, or None if the module is not in the state dict.
+    modules split in ai-toolkit are concatenated to compare with the sd-scripts module.
+    """
+    if format == "sd-scripts":
+        if sds_key + ".lora_down.weight" not in state_dict:
+            return None
+        down_weight = state_dict[sds_key + ".lora_down.weight"].float()
+        up_weight = state_dict[sds_key + ".lora_up.weight"].float()
+        scale = state_dict[sds_key + ".alpha"].item() / down_weight.shape[0]
+        return up_weight @ down_weight * scale
+
+    if ait_keys[0] + ".lora_A.weight" not in state_dict:
+        return None
+    deltas = [state_dict[k + ".lora_B.weight"].float() @ state_dict[k + ".lora_A.weight"].float() for k in ait_keys]
+    return torch.cat(deltas, dim=0)
+
+
+def verify_round_trip(src_sd, dst_sd, src, dst):
+    # converters pop the converted keys, so pass a shallow copy
+    round_trip_sd = CONVERTERS[(dst, src)](dict(dst_sd))
+
+    num_modules = 0
+    max_errors = {"converted": 0.0, "round trip": 0.0}
+    for sds_key, ait_keys, _ in CONVERSION_TABLE:
+        src_weight = get_effective_weight(src_sd, src, sds_key, ait_keys)
+        for name, sd, format in [("converted", dst_sd, dst), ("round trip", round_trip_sd, src)]:
+            weight = get_effective_weight(sd, format, sds_key, ait_keys)
+            assert (src_weight is None) == (weight is None), f"{name}: module is missing / モジュールがありません: {sds_key}"
+            if weight is not None:
+                max_errors[name] = max(max_errors[name], torch.max(torch.abs(src_weight - weight)).item())
+        if src_weight is not None:
+            num_modules += 1
+
+    for name, max_error in max_errors.items():
+        logger.info(f"{name}: {num_modules} modules, max abs error of delta weights: {max_error}")
+
+
 def main(args):
     # load source safetensors
     logger.info(f"Loading source file {args.src_path}")
@@ -407,21 +380,29 @@ def main(args):
         for k in f.keys():
             state_dict[k] = f.get_tensor(k)
 
-    logger.info(f"Converting {args.src} to {args.dst} format")
-    if args.src == "ai-toolkit" and args.dst == "sd-scripts":
-        state_dict = convert_ai_toolkit_to_sd_scripts(state_dict)
-    elif args.src == "sd-scripts" and args.dst == "ai-toolkit":
-        state_dict = convert_sd_scripts_to_ai_toolkit(state_dict)
-
-        # eliminate 'shared tensors' 
-        for k in list(state_dict.keys()):
-            state_dict[k] = state_dict[k].detach().clone()
-    else:
+    if (args.src, args.dst) not in CONVERTERS:
         raise NotImplementedError(f"Conversion from {args.src} to {args.dst} is not supported")
 
-    # save destination safetensors
+    logger.info(f"Converting {args.src} to {args.dst} format")
+    src_state_dict = dict(state_dict) if args.verify else None
+    num_bytes = sum(v.numel() * v.element_size() for v in state_dict.values())
+    start_time = time.perf_counter()
+    state_dict = CONVERTERS[(args.src, args.dst)](state_dict)
+    elapsed = time.perf_counter() - start_time
+    logger.info(
+        f"Converted {len(state_dict)} tensors in {elapsed:.3f} sec: {len(state_dict) / max(elapsed, 1e-9):.1f} tensors/sec, "
+        + f"{num_bytes / max(elapsed, 1e-9) / 1024 / 1024:.1f} MB/sec"
+    )
+
+    if args.verify:
+        verify_round_trip(src_state_dict, state_dict, args.src, args.dst)
+
+    # save destination safetensors. tensors are written one by one, so shared tensors and views need not be cloned
     logger.info(f"Saving destination file {args.dst_path}")
-    save_file(state_dict, args.dst_path, metadata=metadata)
+    tensor_specs = {k: (v.dtype, tuple(v.shape)) for k, v in state_dict.items()}
+    with SafetensorsStreamWriter(args.dst_path, tensor_specs, metadata) as writer:
+        for k, v in state_dict.items():
+            writer.write(k, v)
 
 
 if __name__ == "__main__":
@@ -430,5 +411,10 @@ if __name__ == "__main__":
     parser.add_argument("--dst", type=str, default="sd-scripts", help="destination format, ai-toolkit or sd-scripts")
     parser.add_argument("--src_path", type=str, default=None, help="source path")
     parser.add_argument("--dst_path", type=str, default=None, help="destination path")
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="compare delta weights of the converted and round-tripped LoRA with the source, and log the max error",
+    )
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
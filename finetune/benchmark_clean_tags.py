@@ -0,0 +1,110 @@
+# clean_captions_and_tags.py のタグ整理の速度を計測し、従来の正規表現による実装と結果が同一であることを確認する
+# python finetune/benchmark_clean_tags.py [--in_json meta.jsonl] [--num_captions 1000000]
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.dirname(__file__))
+import clean_captions_and_tags
+from library import metadata_store
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 合成コーパス用のタグ。複数人、髪や目の色、重複タグ、アンダースコアを含む。まれに空のタグなどの境界条件を混ぜる
+SYNTHETIC_TAGS = [
+    "1girl", "2girls", "multiple girls", "1boy", "2boys", "solo", "smile", "open_mouth", "looking_at_viewer", "^_^",
+    "long hair", "short hair", "medium hair", "long_hair", "blonde hair", "red hair", "black hair", "brown hair", "red_hair",
+    "bob cut", "hime cut", "blue eyes", "red eyes", "green eyes", "long sleeves", "short sleeves", "sleeveless",
+    "ponytail", "braid", "side braid", "ahoge", "twintails", "hair bun", "single hair bun", "two side up", "sidelocks",
+    "shirt", "white shirt", "a-b shirt", "skirt", "pleated skirt", "hair ornament", "red hair ornament", "ornament",
+    "x-y", "hair", "bun", "girls hair", "boys hair", "simple background", "white background", "upper body", "blush",
+]  # fmt: skip
+SYNTHETIC_EDGE_TAGS = ["white  shirt", " shirt", "shirt ", "", ",", "@@@", "rating", "hair ornament hair ornament"]
+SYNTHETIC_SEPARATORS = [", "] * 20 + [",", " , ", ", , "]
+SYNTHETIC_RATINGS = ["", "", "", ", rating:safe", ", rating:questionable", ", rating:safe, rating:explicit"]
+
+
+def make_synthetic_tags(num_captions, seed):
+    rng = random.Random(seed)
+    captions = []
+    for _ in range(num_captions):
+        tags = ""
+        for i in range(rng.randint(1, 30)):
+            if i > 0:
+                tags += rng.choice(SYNTHETIC_SEPARATORS)
+            tags += rng.choice(SYNTHETIC_EDGE_TAGS if rng.random() < 0.01 else SYNTHETIC_TAGS)
+        captions.append(tags + rng.choice(SYNTHETIC_RATINGS))
+    return captions
+
+
+def run(clean_tags, captions):
+    results = []
+    start_time = time.perf_counter()
+    for i, tags in enumerate(captions):
+        try:
+            results.append(clean_tags(str(i), tags))
+        except AssertionError:
+            results.append(None)  # すべてのタグが削除される場合、どちらの実装も失敗する
+    return results, time.perf_counter() - start_time
+
+
+def main(args):
+    if args.in_json is not None:
+        logger.info(f"loading tags from metadata: {args.in_json}")
+        captions = [entry["tags"] for _, entry in metadata_store.iterate_metadata(args.in_json) if "tags" in entry]
+        if args.num_captions is not None:
+            captions = captions[: args.num_captions]
+    else:
+        captions = make_synthetic_tags(args.num_captions or 100000, args.seed)
+    logger.info(f"{len(captions)} captions")
+
+    # multiple ratingsのログは計測の邪魔になるので抑制する
+    logging.getLogger(clean_captions_and_tags.__name__).setLevel(logging.WARNING)
+
+    expected, regex_time = run(clean_captions_and_tags.clean_tags_by_regex, captions)
+    clean_captions_and_tags.classify_tag.cache_clear()
+    actual, token_time = run(clean_captions_and_tags.clean_tags, captions)
+
+    for name, elapsed in [("regex", regex_time), ("tokenized", token_time)]:
+        logger.info(
+            f"{name}: {len(captions) / elapsed:.0f} captions/sec, {elapsed / len(captions) * 1e6:.1f} sec per million captions"
+        )
+    logger.info(f"speedup: {regex_time / token_time:.2f}x")
+
+    mismatches = [i for i, (e, a) in enumerate(zip(expected, actual)) if e != a]
+    if len(mismatches) > 0:
+        for i in mismatches[:10]:
+            logger.error(f"mismatch: {captions[i]!r}\n  regex:     {expected[i]!r}\n  tokenized: {actual[i]!r}")
+        logger.error(f"{len(mismatches)} mismatches / 結果が一致しません")
+        sys.exit(1)
+    logger.info("all results are identical / すべての結果が一致しました")
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--in_json",
+        type=str,
+        default=None,
+        help="metadata file (.json or .jsonl) to take the tags from, synthetic tags if omitted"
+        + " / タグを読み込むメタデータファイル、省略時は合成したタグを使う",
+    )
+    parser.add_argument(
+        "--num_captions", type=int, default=None, help="number of captions, default 100000 for synthetic tags / キャプション数"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed for synthetic tags / 合成タグのシード")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+
+    args = parser.parse_args()
+    main(args)
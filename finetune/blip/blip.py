@@ -131,7 +131,7 @@ class BLIP_Decoder(nn.Module):
         
         return loss_lm
         
-    def generate(self, image, sample=False, num_beams=3, max_length=30, min_length=10, top_p=0.9, repetition_penalty=1.0):
+    def generate(self, image, sample=False, num_beams=3, max_length=30, min_length=10, top_p=0.9, repetition_penalty=1.0, early_stopping=False):
         image_embeds = self.visual_encoder(image)
 
         # recent version of transformers seems to do repeat_interleave automatically
@@ -167,6 +167,7 @@ class BLIP_Decoder(nn.Module):
                                                   eos_token_id=self.tokenizer.sep_token_id,
                                                   pad_token_id=self.tokenizer.pad_token_id,     
                                                   repetition_penalty=repetition_penalty,
+                                                  early_stopping=early_stopping,
                                                   **model_kwargs)            
             
         captions = []    
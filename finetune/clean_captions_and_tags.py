@@ -2,12 +2,12 @@
 # (c) 2022 Kohya S. @kohya_ss
 
 import argparse
+import functools
 import glob
 import os
-import json
 import re
 
-from tqdm import tqdm
+from library import metadata_store
 from library.utils import setup_logging
 setup_logging()
 import logging
@@ -29,8 +29,16 @@ PATTERNS_REMOVE_IN_MULTI = [
         r', (ponytail|braid|ahoge|twintails|[\w\-]+ bun|single hair bun|single side bun|two side up|two tails|[\w\-]+ braid|sidelocks), '),
 ]
 
+# タグ単位で判定するためのパターン: 上のパターンから前後の ", " を除いたもの。上のパターンを編集すればこちらにも反映される
+TOKEN_PATTERN_HAIR_LENGTH = re.compile(PATTERN_HAIR_LENGTH.pattern[2:-2])
+TOKEN_PATTERN_HAIR = re.compile(PATTERN_HAIR.pattern[2:-2])
+TOKEN_PATTERN_WORD = re.compile(PATTERN_WORD.pattern[2:-2])
+TOKEN_PATTERNS_REMOVE_IN_MULTI = [re.compile(pat.pattern[2:-2]) for pat in PATTERNS_REMOVE_IN_MULTI]
+TOKEN_PATTERN_WORDS_PREFIX = re.compile(r'(\w+ )+')   # "white shirt" の "white " のような部分
 
-def clean_tags(image_key, tags):
+
+def clean_tags_by_regex(image_key, tags):
+  # 文字列全体に正規表現を繰り返し適用する従来の実装。clean_tagsの検証用と、タグに "@@@" を含む場合に使う
   # replace '_' to ' '
   tags = tags.replace('^_^', '^@@@^')
   tags = tags.replace('_', ' ')
@@ -83,6 +91,93 @@ def clean_tags(image_key, tags):
   return tags
 
 
+@functools.lru_cache(maxsize=65536)
+def classify_tag(tag):
+  # タグごとにすべてのパターンを一度だけ判定して覚えておく: (複数人で削除するパターンのindex, 髪の長さ, 髪, 単語, 重複とみなす単語)
+  multi = tuple(i for i, pat in enumerate(TOKEN_PATTERNS_REMOVE_IN_MULTI) if pat.fullmatch(tag))
+  hair_length = TOKEN_PATTERN_HAIR_LENGTH.fullmatch(tag) is not None
+  hair = TOKEN_PATTERN_HAIR.fullmatch(tag) is not None
+  word = TOKEN_PATTERN_WORD.fullmatch(tag) is not None
+
+  # "white shirt" なら "shirt" を、"red hair ornament" なら "hair ornament" と "ornament" を重複として削除する
+  suffixes = []
+  pos = tag.find(' ')
+  while pos >= 0:
+    suffix = tag[pos + 1:]
+    if TOKEN_PATTERN_WORDS_PREFIX.fullmatch(tag, 0, pos + 1) and TOKEN_PATTERN_WORD.fullmatch(suffix):
+      suffixes.append(suffix)
+    pos = tag.find(' ', pos + 1)
+  return multi, hair_length, hair, word, tuple(suffixes)
+
+
+def clean_tags(image_key, tags):
+  # タグの列に一度だけ分割して、タグ単位で判定・削除してから結合する。結果はclean_tags_by_regexと同一
+  if '@@@' in tags:
+    return clean_tags_by_regex(image_key, tags)
+
+  # replace '_' to ' '
+  tags = tags.replace('^_^', '^@@@^')
+  tags = tags.replace('_', ' ')
+  tags = tags.replace('^@@@^', '^_^')
+
+  # remove rating: deepdanbooruのみ
+  tokens = tags.split(", rating")
+  if len(tokens) > 1:
+    if len(tokens) > 2:
+      logger.info("multiple ratings:")
+      logger.info(f"{image_key} {tags}")
+    tags = tokens[0]
+
+  tag_list = tags.split(", ")
+  infos = [classify_tag(tag) for tag in tag_list]
+
+  # 複数の人物がいる場合は髪色等のタグを削除する
+  if 'girls' in tags or 'boys' in tags:
+    indices_by_pattern = {}
+    for i, info in enumerate(infos):
+      for pi in info[0]:
+        indices_by_pattern.setdefault(pi, []).append(i)
+
+    removed = set()
+    for pi in sorted(indices_by_pattern.keys()):   # パターンの順に、それまでに削除されていないタグを数える
+      found = [i for i in indices_by_pattern[pi] if i not in removed]
+      if len(found) > 1:                        # 二つ以上、タグがある
+        removed.update(found)
+
+    # 髪の特殊対応: 髪の長さタグは例外なので避けておき、最初の髪の長さタグで戻す（全員が同じ髪の長さの場合）
+    found = [i for i, info in enumerate(infos) if info[2] and not info[1] and i not in removed]
+    if len(found) > 1:
+      removed.update(found)
+
+    if len(removed) > 0:
+      tag_list = [tag for i, tag in enumerate(tag_list) if i not in removed]
+      infos = [info for i, info in enumerate(infos) if i not in removed]
+    org = next((i for i, info in enumerate(infos) if info[1]), None)
+    if org is not None:
+      tag_list = [tag_list[org] if info[1] else tag for tag, info in zip(tag_list, infos)]
+      infos = [infos[org] if info[1] else info for info in infos]
+
+  # white shirtとshirtみたいな重複タグの削除
+  words = [tag for tag, info in zip(tag_list, infos) if info[3]]
+  if len(words) > 0:
+    suffixes = set(suffix for info in infos for suffix in info[4])
+    removed_words = set()
+    for word in dict.fromkeys(words):
+      if word in suffixes:
+        removed_words.add(word)
+        if len(classify_tag(word)[4]) > 0:       # hair ornamentのように重複判定の元になるタグも削除された
+          suffixes = set(suffix for tag, info in zip(tag_list, infos) if tag not in removed_words for suffix in info[4])
+    if len(removed_words) > 0:
+      tag_list = [tag for tag in tag_list if tag not in removed_words]
+
+  # 空のタグなどを含めて従来と同じ結果になるよう、同じ方法で結合する
+  if len(tag_list) == 0:
+    raise AssertionError(f"all tags are removed / すべてのタグが削除されました: {image_key}")
+  tags = (", " + ", , ".join(tag_list) + ", ").replace(", , ", ", ")
+  assert tags.startswith(", ") and tags.endswith(", ")
+  return tags[2:-2]
+
+
 # 上から順に検索、置換される
 # ('置換元文字列', '置換後文字列')
 CAPTION_REPLACEMENTS = [
@@ -126,44 +221,47 @@ def clean_caption(caption):
   return caption
 
 
-def main(args):
-  if os.path.exists(args.in_json):
-    logger.info(f"loading existing metadata: {args.in_json}")
-    with open(args.in_json, "rt", encoding='utf-8') as f:
-      metadata = json.load(f)
+def clean_entry(image_key, entry, debug=False):
+  # メタデータの一件分を処理する。ワーカープロセスでも呼ばれる。変更がなければNoneを返す
+  entry = dict(entry)
+  changed = False
+  tags = entry.get('tags')
+  if tags is None:
+    logger.error(f"image does not have tags / メタデータにタグがありません: {image_key}")
+  else:
+    org = tags
+    tags = clean_tags(image_key, tags)
+    entry['tags'] = tags
+    changed = changed or org != tags
+    if debug and org != tags:
+      logger.info("FROM: " + org)
+      logger.info("TO:   " + tags)
+
+  caption = entry.get('caption')
+  if caption is None:
+    logger.error(f"image does not have caption / メタデータにキャプションがありません: {image_key}")
   else:
+    org = caption
+    caption = clean_caption(caption)
+    entry['caption'] = caption
+    changed = changed or org != caption
+    if debug and org != caption:
+      logger.info("FROM: " + org)
+      logger.info("TO:   " + caption)
+
+  return entry if changed else None
+
+
+def main(args):
+  if not os.path.exists(args.in_json):
     logger.error("no metadata / メタデータファイルがありません")
     return
 
-  logger.info("cleaning captions and tags.")
-  image_keys = list(metadata.keys())
-  for image_key in tqdm(image_keys):
-    tags = metadata[image_key].get('tags')
-    if tags is None:
-      logger.error(f"image does not have tags / メタデータにタグがありません: {image_key}")
-    else:
-      org = tags
-      tags = clean_tags(image_key, tags)
-      metadata[image_key]['tags'] = tags
-      if args.debug and org != tags:
-        logger.info("FROM: " + org)
-        logger.info("TO:   " + tags)
-
-    caption = metadata[image_key].get('caption')
-    if caption is None:
-      logger.error(f"image does not have caption / メタデータにキャプションがありません: {image_key}")
-    else:
-      org = caption
-      caption = clean_caption(caption)
-      metadata[image_key]['caption'] = caption
-      if args.debug and org != caption:
-        logger.info("FROM: " + org)
-        logger.info("TO:   " + caption)
-
-  # metadataを書き出して終わり
-  logger.info(f"writing metadata: {args.out_json}")
-  with open(args.out_json, "wt", encoding='utf-8') as f:
-    json.dump(metadata, f, indent=2)
+  # メタデータは一件ずつ読み込んで処理し、変更のないエントリはそのまま書き出す
+  logger.info(f"cleaning captions and tags: {args.in_json} -> {args.out_json}")
+  num_entries, num_changed = metadata_store.update_metadata(
+      args.in_json, args.out_json, transform=functools.partial(clean_entry, debug=args.debug), num_workers=args.max_workers)
+  logger.info(f"{num_entries} entries, {num_changed} changed")
   logger.info("done!")
 
 
@@ -171,7 +269,9 @@ def setup_parser() -> argparse.ArgumentParser:
   parser = argparse.ArgumentParser()
   # parser.add_argument("train_data_dir", type=str, help="directory for train images / 学習画像データのディレクトリ")
   parser.add_argument("in_json", type=str, help="metadata file to input / 読み込むメタデータファイル")
-  parser.add_argument("out_json", type=str, help="metadata file to output / メタデータファイル書き出し先")
+  parser.add_argument("out_json", type=str, help="metadata file to output, .json or .jsonl / メタデータファイル書き出し先、.jsonまたは.jsonl")
+  parser.add_argument("--max_workers", type=int, default=None,
+                      help="number of worker processes to clean entries in parallel / 並列に処理するワーカープロセス数")
   parser.add_argument("--debug", action="store_true", help="debug mode")
 
   return parser
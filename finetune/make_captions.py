@@ -1,13 +1,9 @@
 import argparse
-import glob
 import os
-import json
 import random
 import sys
 
 from pathlib import Path
-from PIL import Image
-from tqdm import tqdm
 import numpy as np
 
 import torch
@@ -19,7 +15,8 @@ from torchvision.transforms.functional import InterpolationMode
 sys.path.append(os.path.dirname(__file__))
 from blip.blip import blip_decoder, is_url
 import library.train_util as train_util
-from library.utils import setup_logging
+from library import caption_utils
+from library.utils import ProgressJournal, setup_logging
 setup_logging()
 import logging
 logger = logging.getLogger(__name__)
@@ -39,38 +36,6 @@ IMAGE_TRANSFORM = transforms.Compose(
 )
 
 
-# 共通化したいが微妙に処理が異なる……
-class ImageLoadingTransformDataset(torch.utils.data.Dataset):
-    def __init__(self, image_paths):
-        self.images = image_paths
-
-    def __len__(self):
-        return len(self.images)
-
-    def __getitem__(self, idx):
-        img_path = self.images[idx]
-
-        try:
-            image = Image.open(img_path).convert("RGB")
-            # convert to tensor temporarily so dataloader will accept it
-            tensor = IMAGE_TRANSFORM(image)
-        except Exception as e:
-            logger.error(f"Could not load image path / 画像を読み込めません: {img_path}, error: {e}")
-            return None
-
-        return (tensor, img_path)
-
-
-def collate_fn_remove_corrupted(batch):
-    """Collate function that allows to remove corrupted examples in the
-    dataloader. It expects that the dataloader returns 'None' when that occurs.
-    The 'None's in the batch are removed.
-    """
-    # Filter out all the Nones (corrupted examples)
-    batch = list(filter(lambda x: x is not None, batch))
-    return batch
-
-
 def main(args):
     # fix the seed for reproducibility
     seed = args.seed  # + utils.get_rank()
@@ -80,6 +45,10 @@ def main(args):
 
     if not os.path.exists("blip"):
         args.train_data_dir = os.path.abspath(args.train_data_dir)  # convert to absolute path
+        if args.tensor_cache_dir is not None:
+            args.tensor_cache_dir = os.path.abspath(args.tensor_cache_dir)
+        if args.journal_file is not None:
+            args.journal_file = os.path.abspath(args.journal_file)
 
         cwd = os.getcwd()
         logger.info(f"Current Working Directory is: {cwd}")
@@ -92,6 +61,15 @@ def main(args):
     image_paths = train_util.glob_images_pathlib(train_data_dir_path, args.recursive)
     logger.info(f"found {len(image_paths)} images.")
 
+    # skip images already captioned in the previous runs
+    journal = ProgressJournal(args.journal_file)
+    if args.journal_file is not None:
+        num_images = len(image_paths)
+        image_paths = [image_path for image_path in image_paths if not journal.is_done(image_path)]
+        logger.info(f"skip {num_images - len(image_paths)} images already captioned / キャプション付け済みの画像をスキップします")
+    if args.sort_by_size:
+        image_paths = caption_utils.sort_images_by_size(image_paths, args.max_data_loader_n_workers)
+
     logger.info(f"loading BLIP caption: {args.caption_weights}")
     model = blip_decoder(pretrained=args.caption_weights, image_size=IMAGE_SIZE, vit="large", med_config="./blip/med_config.json")
     model.eval()
@@ -99,62 +77,48 @@ def main(args):
     logger.info("BLIP loaded")
 
     # captioningする
-    def run_batch(path_imgs):
-        imgs = torch.stack([im for _, im in path_imgs]).to(DEVICE)
+    def caption_batch(imgs):
+        imgs = imgs.to(DEVICE)
 
-        with torch.no_grad():
+        with torch.no_grad(), caption_utils.get_autocast_context(DEVICE, args.mixed_precision):
             if args.beam_search:
                 captions = model.generate(
-                    imgs, sample=False, num_beams=args.num_beams, max_length=args.max_length, min_length=args.min_length
+                    imgs,
+                    sample=False,
+                    num_beams=args.num_beams,
+                    max_length=args.max_length,
+                    min_length=args.min_length,
+                    early_stopping=args.early_stopping,
                 )
             else:
                 captions = model.generate(
                     imgs, sample=True, top_p=args.top_p, max_length=args.max_length, min_length=args.min_length
                 )
-
-        for (image_path, _), caption in zip(path_imgs, captions):
-            with open(os.path.splitext(image_path)[0] + args.caption_extension, "wt", encoding="utf-8") as f:
-                f.write(caption + "\n")
-                if args.debug:
-                    logger.info(f'{image_path} {caption}')
-
-    # 読み込みの高速化のためにDataLoaderを使うオプション
-    if args.max_data_loader_n_workers is not None:
-        dataset = ImageLoadingTransformDataset(image_paths)
-        data = torch.utils.data.DataLoader(
-            dataset,
-            batch_size=args.batch_size,
-            shuffle=False,
+        return captions
+
+    def write_caption(image_path, caption):
+        with open(os.path.splitext(image_path)[0] + args.caption_extension, "wt", encoding="utf-8") as f:
+            f.write(caption + "\n")
+            if args.debug:
+                logger.info(f'{image_path} {caption}')
+
+    # 前処理済みのテンソルをキャッシュするオプション
+    cache = None
+    if args.tensor_cache_dir is not None:
+        cache = caption_utils.PreprocessedTensorCache(args.tensor_cache_dir, f"blip_{IMAGE_SIZE}")
+
+    # DataLoaderのワーカー数を指定すると、画像の読み込みと前処理を並列に行う
+    with journal:
+        caption_utils.caption_images(
+            image_paths,
+            IMAGE_TRANSFORM,
+            caption_batch,
+            write_caption,
+            args.batch_size,
             num_workers=args.max_data_loader_n_workers,
-            collate_fn=collate_fn_remove_corrupted,
-            drop_last=False,
+            cache=cache,
+            journal=journal,
         )
-    else:
-        data = [[(None, ip)] for ip in image_paths]
-
-    b_imgs = []
-    for data_entry in tqdm(data, smoothing=0.0):
-        for data in data_entry:
-            if data is None:
-                continue
-
-            img_tensor, image_path = data
-            if img_tensor is None:
-                try:
-                    raw_image = Image.open(image_path)
-                    if raw_image.mode != "RGB":
-                        raw_image = raw_image.convert("RGB")
-                    img_tensor = IMAGE_TRANSFORM(raw_image)
-                except Exception as e:
-                    logger.error(f"Could not load image path / 画像を読み込めません: {image_path}, error: {e}")
-                    continue
-
-            b_imgs.append((image_path, img_tensor))
-            if len(b_imgs) >= args.batch_size:
-                run_batch(b_imgs)
-                b_imgs.clear()
-    if len(b_imgs) > 0:
-        run_batch(b_imgs)
 
     logger.info("done!")
 
@@ -194,6 +158,36 @@ def setup_parser() -> argparse.ArgumentParser:
     parser.add_argument("--seed", default=42, type=int, help="seed for reproducibility / 再現性を確保するための乱数seed")
     parser.add_argument("--debug", action="store_true", help="debug mode")
     parser.add_argument("--recursive", action="store_true", help="search for images in subfolders recursively / サブフォルダを再帰的に検索する")
+    parser.add_argument(
+        "--early_stopping",
+        action="store_true",
+        help="in beam search, finish each image as soon as it has enough finished candidates (faster) / beam search時、十分な候補が得られた画像から生成を終了する（高速化）",
+    )
+    parser.add_argument(
+        "--mixed_precision",
+        type=str,
+        default="no",
+        choices=["no", "fp16", "bf16"],
+        help="use mixed precision in inference / 推論時に混合精度を使う",
+    )
+    parser.add_argument(
+        "--sort_by_size",
+        action="store_true",
+        help="process images in the order of image size / 画像サイズの順に処理する",
+    )
+    parser.add_argument(
+        "--tensor_cache_dir",
+        type=str,
+        default=None,
+        help="directory to cache preprocessed images to speed up the next runs / 前処理済みの画像をキャッシュするディレクトリ（次回以降の実行を高速化）",
+    )
+    parser.add_argument(
+        "--journal_file",
+        type=str,
+        default=None,
+        help="journal of captioned images to resume an interrupted run, images in the journal are skipped"
+        + " / 中断した処理を再開するためのジャーナル、記録済みの画像はスキップされる",
+    )
 
     return parser
 
@@ -1,10 +1,9 @@
 import argparse
+import functools
 import os
 import re
 
 from pathlib import Path
-from PIL import Image
-from tqdm import tqdm
 
 import torch
 from library.device_utils import init_ipex, get_preferred_device
@@ -14,7 +13,8 @@ from transformers import AutoProcessor, AutoModelForCausalLM
 from transformers.generation.utils import GenerationMixin
 
 import library.train_util as train_util
-from library.utils import setup_logging
+from library import caption_utils
+from library.utils import ProgressJournal, setup_logging
 setup_logging()
 import logging
 logger = logging.getLogger(__name__)
@@ -48,14 +48,9 @@ def remove_words(captions, debug):
     return removed_caps
 
 
-def collate_fn_remove_corrupted(batch):
-    """Collate function that allows to remove corrupted examples in the
-    dataloader. It expects that the dataloader returns 'None' when that occurs.
-    The 'None's in the batch are removed.
-    """
-    # Filter out all the Nones (corrupted examples)
-    batch = list(filter(lambda x: x is not None, batch))
-    return batch
+def preprocess_image(processor, image):
+    # DataLoaderのワーカーで実行される
+    return processor(images=image, return_tensors="pt").pixel_values[0]
 
 
 def main(args):
@@ -82,6 +77,15 @@ def main(args):
     image_paths = train_util.glob_images_pathlib(train_data_dir_path, args.recursive)
     logger.info(f"found {len(image_paths)} images.")
 
+    # skip images already captioned in the previous runs
+    journal = ProgressJournal(args.journal_file)
+    if args.journal_file is not None:
+        num_images = len(image_paths)
+        image_paths = [image_path for image_path in image_paths if not journal.is_done(image_path)]
+        logger.info(f"skip {num_images - len(image_paths)} images already captioned / キャプション付け済みの画像をスキップします")
+    if args.sort_by_size:
+        image_paths = caption_utils.sort_images_by_size(image_paths, args.max_data_loader_n_workers)
+
     # できればcacheに依存せず明示的にダウンロードしたい
     logger.info(f"loading GIT: {args.model_id}")
     git_processor = AutoProcessor.from_pretrained(args.model_id)
@@ -89,60 +93,38 @@ def main(args):
     logger.info("GIT loaded")
 
     # captioningする
-    def run_batch(path_imgs):
-        imgs = [im for _, im in path_imgs]
-
-        # curr_batch_size[0] = len(path_imgs)
-        inputs = git_processor(images=imgs, return_tensors="pt").to(DEVICE)  # 画像はpil形式
-        generated_ids = git_model.generate(pixel_values=inputs.pixel_values, max_length=args.max_length)
+    def caption_batch(pixel_values):
+        with torch.no_grad(), caption_utils.get_autocast_context(DEVICE, args.mixed_precision):
+            generated_ids = git_model.generate(pixel_values=pixel_values.to(DEVICE), max_length=args.max_length)
         captions = git_processor.batch_decode(generated_ids, skip_special_tokens=True)
 
         if args.remove_words:
             captions = remove_words(captions, args.debug)
-
-        for (image_path, _), caption in zip(path_imgs, captions):
-            with open(os.path.splitext(image_path)[0] + args.caption_extension, "wt", encoding="utf-8") as f:
-                f.write(caption + "\n")
-                if args.debug:
-                    logger.info(f"{image_path} {caption}")
-
-    # 読み込みの高速化のためにDataLoaderを使うオプション
-    if args.max_data_loader_n_workers is not None:
-        dataset = train_util.ImageLoadingDataset(image_paths)
-        data = torch.utils.data.DataLoader(
-            dataset,
-            batch_size=args.batch_size,
-            shuffle=False,
+        return captions
+
+    def write_caption(image_path, caption):
+        with open(os.path.splitext(image_path)[0] + args.caption_extension, "wt", encoding="utf-8") as f:
+            f.write(caption + "\n")
+            if args.debug:
+                logger.info(f"{image_path} {caption}")
+
+    # 前処理済みのテンソルをキャッシュするオプション
+    cache = None
+    if args.tensor_cache_dir is not None:
+        cache = caption_utils.PreprocessedTensorCache(args.tensor_cache_dir, f"git_{args.model_id}")
+
+    # DataLoaderのワーカー数を指定すると、画像の読み込みと前処理を並列に行う
+    with journal:
+        caption_utils.caption_images(
+            image_paths,
+            functools.partial(preprocess_image, git_processor.image_processor),
+            caption_batch,
+            write_caption,
+            args.batch_size,
             num_workers=args.max_data_loader_n_workers,
-            collate_fn=collate_fn_remove_corrupted,
-            drop_last=False,
+            cache=cache,
+            journal=journal,
         )
-    else:
-        data = [[(None, ip)] for ip in image_paths]
-
-    b_imgs = []
-    for data_entry in tqdm(data, smoothing=0.0):
-        for data in data_entry:
-            if data is None:
-                continue
-
-            image, image_path = data
-            if image is None:
-                try:
-                    image = Image.open(image_path)
-                    if image.mode != "RGB":
-                        image = image.convert("RGB")
-                except Exception as e:
-                    logger.error(f"Could not load image path / 画像を読み込めません: {image_path}, error: {e}")
-                    continue
-
-            b_imgs.append((image_path, image))
-            if len(b_imgs) >= args.batch_size:
-                run_batch(b_imgs)
-                b_imgs.clear()
-
-    if len(b_imgs) > 0:
-        run_batch(b_imgs)
 
     logger.info("done!")
 
@@ -172,6 +154,31 @@ def setup_parser() -> argparse.ArgumentParser:
     )
     parser.add_argument("--debug", action="store_true", help="debug mode")
     parser.add_argument("--recursive", action="store_true", help="search for images in subfolders recursively / サブフォルダを再帰的に検索する")
+    parser.add_argument(
+        "--mixed_precision",
+        type=str,
+        default="no",
+        choices=["no", "fp16", "bf16"],
+        help="use mixed precision in inference / 推論時に混合精度を使う",
+    )
+    parser.add_argument(
+        "--sort_by_size",
+        action="store_true",
+        help="process images in the order of image size / 画像サイズの順に処理する",
+    )
+    parser.add_argument(
+        "--tensor_cache_dir",
+        type=str,
+        default=None,
+        help="directory to cache preprocessed images to speed up the next runs / 前処理済みの画像をキャッシュするディレクトリ（次回以降の実行を高速化）",
+    )
+    parser.add_argument(
+        "--journal_file",
+        type=str,
+        default=None,
+        help="journal of captioned images to resume an interrupted run, images in the journal are skipped"
+        + " / 中断した処理を再開するためのジャーナル、記録済みの画像はスキップされる",
+    )
 
     return parser
 
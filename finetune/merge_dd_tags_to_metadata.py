@@ -1,9 +1,9 @@
 import argparse
-import json
 from pathlib import Path
 from typing import List
 from tqdm import tqdm
 import library.train_util as train_util
+from library import metadata_store
 import os
 from library.utils import setup_logging
 
@@ -26,14 +26,13 @@ def main(args):
         args.in_json = args.out_json
 
     if args.in_json is not None:
-        logger.info(f"loading existing metadata: {args.in_json}")
-        metadata = json.loads(Path(args.in_json).read_text(encoding="utf-8"))
+        logger.info(f"updating existing metadata: {args.in_json}")
         logger.warning("tags data for existing images will be overwritten / 既存の画像のタグは上書きされます")
     else:
         logger.info("new metadata will be created / 新しいメタデータファイルが作成されます")
-        metadata = {}
 
     logger.info("merge tags to metadata json.")
+    updates = {}
     for image_path in tqdm(image_paths):
         tags_path = image_path.with_suffix(args.caption_extension)
         tags = tags_path.read_text(encoding="utf-8").strip()
@@ -42,16 +41,15 @@ def main(args):
             tags_path = os.path.join(image_path, args.caption_extension)
 
         image_key = str(image_path) if args.full_path else image_path.stem
-        if image_key not in metadata:
-            metadata[image_key] = {}
-
-        metadata[image_key]["tags"] = tags
+        updates[image_key] = {"tags": tags}
         if args.debug:
             logger.info(f"{image_key} {tags}")
 
     # metadataを書き出して終わり
+    # 既存のメタデータは一件ずつ読み込み、変更のないエントリはそのまま書き出す
     logger.info(f"writing metadata: {args.out_json}")
-    Path(args.out_json).write_text(json.dumps(metadata, indent=2), encoding="utf-8")
+    num_entries, num_changed = metadata_store.update_metadata(args.in_json, args.out_json, updates=updates)
+    logger.info(f"{num_entries} entries, {num_changed} updated")
 
     logger.info("done!")
 
@@ -59,7 +57,9 @@ def main(args):
 def setup_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     parser.add_argument("train_data_dir", type=str, help="directory for train images / 学習画像データのディレクトリ")
-    parser.add_argument("out_json", type=str, help="metadata file to output / メタデータファイル書き出し先")
+    parser.add_argument(
+        "out_json", type=str, help="metadata file to output, .json or .jsonl (JSON Lines) / メタデータファイル書き出し先、.jsonまたは.jsonl"
+    )
     parser.add_argument(
         "--in_json",
         type=str,
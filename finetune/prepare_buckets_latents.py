@@ -1,6 +1,5 @@
 import argparse
 import os
-import json
 
 from pathlib import Path
 from typing import List
@@ -18,6 +17,7 @@ from torchvision import transforms
 
 import library.model_util as model_util
 import library.train_util as train_util
+from library import metadata_store
 from library.utils import setup_logging
 
 setup_logging()
@@ -72,11 +72,7 @@ def main(args):
     image_paths: List[str] = [str(p) for p in train_util.glob_images_pathlib(train_data_dir_path, args.recursive)]
     logger.info(f"found {len(image_paths)} images.")
 
-    if os.path.exists(args.in_json):
-        logger.info(f"loading existing metadata: {args.in_json}")
-        with open(args.in_json, "rt", encoding="utf-8") as f:
-            metadata = json.load(f)
-    else:
+    if not os.path.exists(args.in_json):
         logger.error(f"no metadata / メタデータファイルがありません: {args.in_json}")
         return
 
@@ -130,6 +126,7 @@ def main(args):
         data = [[(None, ip)] for ip in image_paths]
 
     bucket_counts = {}
+    updates = {}  # image key -> fields to update in metadata
     for data_entry in tqdm(data, smoothing=0.0):
         if data_entry[0] is None:
             continue
@@ -147,8 +144,6 @@ def main(args):
                 continue
 
         image_key = image_path if args.full_path else os.path.splitext(os.path.basename(image_path))[0]
-        if image_key not in metadata:
-            metadata[image_key] = {}
 
         # 本当はこのあとの部分もDataSetに持っていけば高速化できるがいろいろ大変
 
@@ -157,7 +152,7 @@ def main(args):
         bucket_counts[reso] = bucket_counts.get(reso, 0) + 1
 
         # メタデータに記録する解像度はlatent単位とするので、8単位で切り捨て
-        metadata[image_key]["train_resolution"] = (reso[0] - reso[0] % 8, reso[1] - reso[1] % 8)
+        updates[image_key] = {"train_resolution": (reso[0] - reso[0] % 8, reso[1] - reso[1] % 8)}
 
         if not args.bucket_no_upscale:
             # upscaleを行わないときには、resize後のサイズは、bucketのサイズと、縦横どちらかが同じであることを確認する
@@ -200,18 +195,18 @@ def main(args):
     img_ar_errors = np.array(img_ar_errors)
     logger.info(f"mean ar error: {np.mean(img_ar_errors)}")
 
-    # metadataを書き出して終わり
+    # metadataを書き出して終わり。既存のメタデータは一件ずつ読み込み、変更のないエントリはそのまま書き出す
     logger.info(f"writing metadata: {args.out_json}")
-    with open(args.out_json, "wt", encoding="utf-8") as f:
-        json.dump(metadata, f, indent=2)
+    num_entries, num_changed = metadata_store.update_metadata(args.in_json, args.out_json, updates=updates)
+    logger.info(f"{num_entries} entries, {num_changed} updated")
     logger.info("done!")
 
 
 def setup_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     parser.add_argument("train_data_dir", type=str, help="directory for train images / 学習画像データのディレクトリ")
-    parser.add_argument("in_json", type=str, help="metadata file to input / 読み込むメタデータファイル")
-    parser.add_argument("out_json", type=str, help="metadata file to output / メタデータファイル書き出し先")
+    parser.add_argument("in_json", type=str, help="metadata file to input, .json or .jsonl / 読み込むメタデータファイル、.jsonまたは.jsonl")
+    parser.add_argument("out_json", type=str, help="metadata file to output, .json or .jsonl / メタデータファイル書き出し先、.jsonまたは.jsonl")
     parser.add_argument("model_name_or_path", type=str, help="model name or path to encode latents / latentを取得するためのモデル")
     parser.add_argument(
         "--v2", action="store_true", help="not used (for backward compatibility) / 使用されません（互換性のため残してあります）"
@@ -1,17 +1,18 @@
 import argparse
 import csv
 import os
+import time
+from collections import deque
 from pathlib import Path
 
 import cv2
 import numpy as np
-import torch
 from huggingface_hub import hf_hub_download
 from PIL import Image
 from tqdm import tqdm
 
 import library.train_util as train_util
-from library.utils import setup_logging, pil_resize
+from library.utils import setup_logging, pil_resize, ProgressJournal
 
 setup_logging()
 import logging
@@ -30,7 +31,7 @@ SUB_DIR_FILES = ["variables.data-00000-of-00001", "variables.index"]
 CSV_FILE = FILES[-1]
 
 
-def preprocess_image(image):
+def preprocess_image(image, dtype=np.float32):
     image = np.array(image)
     image = image[:, :, ::-1]  # RGB->BGR
 
@@ -47,39 +48,48 @@ def preprocess_image(image):
     else:
         image = pil_resize(image, (IMAGE_SIZE, IMAGE_SIZE))
 
-    image = image.astype(np.float32)
+    image = image.astype(dtype, copy=False)
     return image
 
 
-class ImageLoadingPrepDataset(torch.utils.data.Dataset):
-    def __init__(self, image_paths):
-        self.images = image_paths
+def load_and_preprocess_image(image_path):
+    # also called in worker processes. uint8 is enough (the values are integers) and reduces the transfer between processes
+    try:
+        image = Image.open(image_path)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        return preprocess_image(image, np.uint8)
+    except Exception as e:
+        logger.error(f"Could not load image path / 画像を読み込めません: {image_path}, error: {e}")
+        return None
 
-    def __len__(self):
-        return len(self.images)
 
-    def __getitem__(self, idx):
-        img_path = str(self.images[idx])
-
-        try:
-            image = Image.open(img_path).convert("RGB")
-            image = preprocess_image(image)
-            # tensor = torch.tensor(image) # これ Tensor に変換する必要ないな……(;･∀･)
-        except Exception as e:
-            logger.error(f"Could not load image path / 画像を読み込めません: {img_path}, error: {e}")
-            return None
+def iterate_images(image_paths, num_workers, prefetch):
+    r"""
+    Yields (image_path, preprocessed image or None) in order. With `num_workers`, images are decoded in worker processes while
+    the model is running, at most `prefetch` images ahead.
+    """
+    if not num_workers:
+        for image_path in image_paths:
+            yield image_path, load_and_preprocess_image(image_path)
+        return
 
-        return (image, img_path)
+    from concurrent.futures import ProcessPoolExecutor
 
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        image_paths = iter(image_paths)
+        futures = deque()
+        for image_path in image_paths:
+            futures.append((image_path, executor.submit(load_and_preprocess_image, image_path)))
+            if len(futures) >= prefetch:
+                break
 
-def collate_fn_remove_corrupted(batch):
-    """Collate function that allows to remove corrupted examples in the
-    dataloader. It expects that the dataloader returns 'None' when that occurs.
-    The 'None's in the batch are removed.
-    """
-    # Filter out all the Nones (corrupted examples)
-    batch = list(filter(lambda x: x is not None, batch))
-    return batch
+        while len(futures) > 0:
+            image_path, future = futures.popleft()
+            next_path = next(image_paths, None)
+            if next_path is not None:
+                futures.append((next_path, executor.submit(load_and_preprocess_image, next_path)))
+            yield image_path, future.result()
 
 
 def main(args):
@@ -160,6 +170,11 @@ def main(args):
                     ["CPUExecutionProvider"]
                 ),
             )
+
+        # the input is bound to the reused batch buffer (IO binding), and the batch shape is fixed by padding the last batch,
+        # so that onnxruntime can reuse its memory allocation
+        output_name = ort_sess.get_outputs()[0].name
+        io_binding = ort_sess.io_binding()
     else:
         from tensorflow.keras.models import load_model
 
@@ -220,7 +235,12 @@ def main(args):
     image_paths = train_util.glob_images_pathlib(train_data_dir_path, args.recursive)
     logger.info(f"found {len(image_paths)} images.")
 
-    tag_freq = {}
+    # skip images already tagged in the previous runs
+    journal = ProgressJournal(args.journal_file)
+    if args.journal_file is not None:
+        num_images = len(image_paths)
+        image_paths = [image_path for image_path in image_paths if not journal.is_done(image_path)]
+        logger.info(f"skip {num_images - len(image_paths)} images already tagged / タグ付け済みの画像をスキップします")
 
     caption_separator = args.caption_separator
     stripped_caption_separator = caption_separator.strip()
@@ -231,59 +251,91 @@ def main(args):
     if args.always_first_tags is not None:
         always_first_tags = [tag for tag in args.always_first_tags.split(stripped_caption_separator) if tag.strip() != ""]
 
-    def run_batch(path_imgs):
-        imgs = np.array([im for _, im in path_imgs])
-
+    # タグの後処理用のテーブルを事前に作っておく
+    # tables for the vectorized post-processing. probs[:, 4 + i] is the confidence of tag_names[i]
+    num_general_tags = len(general_tags)
+    tag_names = np.array(general_tags + character_tags, dtype=object)
+    tag_allowed = np.array([tag not in undesired_tags for tag in tag_names], dtype=bool)
+    rating_allowed = np.array([tag not in undesired_tags for tag in rating_tags], dtype=bool)
+
+    # tag frequencies are counted by name, because --tag_replacement may make the same names
+    freq_names = list(dict.fromkeys(rating_tags + general_tags + character_tags))
+    name_to_id = {name: i for i, name in enumerate(freq_names)}
+    tag_name_ids = np.array([name_to_id[tag] for tag in tag_names], dtype=np.int64)
+    rating_name_ids = np.array([name_to_id[tag] for tag in rating_tags], dtype=np.int64)
+    tag_counts = np.zeros(len(freq_names), dtype=np.int64)
+    first_seen_ids = []  # order of the first appearance, to keep the order of the tags with the same frequency
+
+    def count_tags(rows, cols, rating_indices):
+        # same as counting tag by tag: for each image, the tags in the column order and then the rating
+        ids, id_rows, id_orders = [tag_name_ids[cols]], [rows], [cols]
+        if rating_indices is not None:
+            rating_rows = np.flatnonzero(rating_allowed[rating_indices])
+            ids.append(rating_name_ids[rating_indices[rating_rows]])
+            id_rows.append(rating_rows)
+            id_orders.append(np.full(len(rating_rows), len(tag_names)))
+        ids = np.concatenate(ids)
+        if len(ids) == 0:
+            return
+        ids = ids[np.lexsort((np.concatenate(id_orders), np.concatenate(id_rows)))]
+
+        unique_ids, first_indices = np.unique(ids, return_index=True)
+        is_new = tag_counts[unique_ids] == 0
+        first_seen_ids.extend(unique_ids[is_new][np.argsort(first_indices[is_new])].tolist())
+        tag_counts[:] += np.bincount(ids, minlength=len(tag_counts))
+
+    def run_batch(image_paths, imgs):
+        # imgs: buffer of batch size, the first len(image_paths) images are valid
         if args.onnx:
-            # if len(imgs) < args.batch_size:
-            #     imgs = np.concatenate([imgs, np.zeros((args.batch_size - len(imgs), IMAGE_SIZE, IMAGE_SIZE, 3))], axis=0)
-            probs = ort_sess.run(None, {input_name: imgs})[0]  # onnx output numpy
-            probs = probs[: len(path_imgs)]
+            imgs[len(image_paths) :] = 0  # pad to the fixed batch shape
+            io_binding.bind_cpu_input(input_name, imgs)
+            io_binding.bind_output(output_name)
+            ort_sess.run_with_iobinding(io_binding)
+            probs = io_binding.copy_outputs_to_cpu()[0]  # onnx output numpy
+            probs = probs[: len(image_paths)]
         else:
-            probs = model(imgs, training=False)
+            probs = model(imgs[: len(image_paths)], training=False)
             probs = probs.numpy()
 
-        for (image_path, _), prob in zip(path_imgs, probs):
-            combined_tags = []
+        # 最初の4つ以降はタグなのでconfidenceがthreshold以上のものを追加する
+        # First 4 labels are ratings, the rest are tags: pick any where prediction confidence >= threshold
+        tag_probs = probs[:, 4 : 4 + len(tag_names)]
+        selected = np.concatenate(
+            [tag_probs[:, :num_general_tags] >= args.general_threshold, tag_probs[:, num_general_tags:] >= args.character_threshold],
+            axis=1,
+        )
+        selected &= tag_allowed
+        rows, cols = np.nonzero(selected)  # sorted by image, then by tag
+        row_starts = np.searchsorted(rows, np.arange(len(image_paths) + 1)).tolist()
+        num_generals = np.bincount(rows[cols < num_general_tags], minlength=len(image_paths)).tolist()
+        selected_names = tag_names[cols].tolist()
+
+        # 最初の4つはratingなのでargmaxで選ぶ
+        # First 4 labels are actually ratings: pick one with argmax
+        rating_indices = None
+        if args.use_rating_tags or args.use_rating_tags_as_last_tag:
+            rating_indices = probs[:, :4].argmax(axis=1)
+
+        if args.frequency_tags:
+            count_tags(rows, cols, rating_indices)
+
+        for i, image_path in enumerate(image_paths):
+            names = selected_names[row_starts[i] : row_starts[i + 1]]
+            general_names = names[: num_generals[i]]
+            character_names = names[num_generals[i] :]
+            if args.character_tags_first:  # insert to the beginning one by one
+                combined_tags = character_names[::-1] + general_names
+            else:
+                combined_tags = general_names + character_names
+
             rating_tag_text = ""
-            character_tag_text = ""
-            general_tag_text = ""
-
-            # 最初の4つ以降はタグなのでconfidenceがthreshold以上のものを追加する
-            # First 4 labels are ratings, the rest are tags: pick any where prediction confidence >= threshold
-            for i, p in enumerate(prob[4:]):
-                if i < len(general_tags) and p >= args.general_threshold:
-                    tag_name = general_tags[i]
-
-                    if tag_name not in undesired_tags:
-                        tag_freq[tag_name] = tag_freq.get(tag_name, 0) + 1
-                        general_tag_text += caption_separator + tag_name
-                        combined_tags.append(tag_name)
-                elif i >= len(general_tags) and p >= args.character_threshold:
-                    tag_name = character_tags[i - len(general_tags)]
-
-                    if tag_name not in undesired_tags:
-                        tag_freq[tag_name] = tag_freq.get(tag_name, 0) + 1
-                        character_tag_text += caption_separator + tag_name
-                        if args.character_tags_first: # insert to the beginning
-                            combined_tags.insert(0, tag_name)
-                        else:
-                            combined_tags.append(tag_name)
-
-            # 最初の4つはratingなのでargmaxで選ぶ
-            # First 4 labels are actually ratings: pick one with argmax
-            if args.use_rating_tags or args.use_rating_tags_as_last_tag:
-                ratings_probs = prob[:4]
-                rating_index = ratings_probs.argmax()
-                found_rating = rating_tags[rating_index]
-
-                if found_rating not in undesired_tags:
-                    tag_freq[found_rating] = tag_freq.get(found_rating, 0) + 1
-                    rating_tag_text = found_rating
-                    if args.use_rating_tags:
-                        combined_tags.insert(0, found_rating) # insert to the beginning
-                    else:
-                        combined_tags.append(found_rating)
+            if rating_indices is not None and rating_allowed[rating_indices[i]]:
+                found_rating = rating_tags[rating_indices[i]]
+                rating_tag_text = found_rating
+                if args.use_rating_tags:
+                    combined_tags.insert(0, found_rating)  # insert to the beginning
+                else:
+                    combined_tags.append(found_rating)
 
             # 一番最初に置くタグを指定する
             # Always put some tags at the beginning
@@ -293,11 +345,8 @@ def main(args):
                         combined_tags.remove(tag)
                         combined_tags.insert(0, tag)
 
-            # 先頭のカンマを取る
-            if len(general_tag_text) > 0:
-                general_tag_text = general_tag_text[len(caption_separator) :]
-            if len(character_tag_text) > 0:
-                character_tag_text = character_tag_text[len(caption_separator) :]
+            general_tag_text = caption_separator.join(general_names)
+            character_tag_text = caption_separator.join(character_names)
 
             caption_file = os.path.splitext(image_path)[0] + args.caption_extension
 
@@ -328,48 +377,38 @@ def main(args):
                     logger.info(f"\tCharacter tags: {character_tag_text}")
                     logger.info(f"\tGeneral tags: {general_tag_text}")
 
-    # 読み込みの高速化のためにDataLoaderを使うオプション
-    if args.max_data_loader_n_workers is not None:
-        dataset = ImageLoadingPrepDataset(image_paths)
-        data = torch.utils.data.DataLoader(
-            dataset,
-            batch_size=args.batch_size,
-            shuffle=False,
-            num_workers=args.max_data_loader_n_workers,
-            collate_fn=collate_fn_remove_corrupted,
-            drop_last=False,
-        )
-    else:
-        data = [[(None, ip)] for ip in image_paths]
-
-    b_imgs = []
-    for data_entry in tqdm(data, smoothing=0.0):
-        for data in data_entry:
-            if data is None:
-                continue
-
-            image, image_path = data
-            if image is None:
-                try:
-                    image = Image.open(image_path)
-                    if image.mode != "RGB":
-                        image = image.convert("RGB")
-                    image = preprocess_image(image)
-                except Exception as e:
-                    logger.error(f"Could not load image path / 画像を読み込めません: {image_path}, error: {e}")
-                    continue
-            b_imgs.append((image_path, image))
-
-            if len(b_imgs) >= args.batch_size:
-                b_imgs = [(str(image_path), image) for image_path, image in b_imgs]  # Convert image_path to string
-                run_batch(b_imgs)
-                b_imgs.clear()
-
-    if len(b_imgs) > 0:
-        b_imgs = [(str(image_path), image) for image_path, image in b_imgs]  # Convert image_path to string
-        run_batch(b_imgs)
+    def flush_batch():
+        run_batch(b_paths, b_imgs)
+        for image_path in b_paths:
+            journal.add(image_path)
+        journal.flush()
+        b_paths.clear()
+
+    # 画像の読み込みと前処理はワーカープロセスで推論と並行して行う
+    # images are decoded and preprocessed in worker processes while the model is running
+    start_time = time.perf_counter()
+    num_workers = args.max_data_loader_n_workers
+    prefetch = args.batch_size * 2 + (num_workers or 0)
+    b_paths = []
+    b_imgs = np.zeros((args.batch_size, IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.float32)  # reused for all batches
+    for image_path, image in tqdm(iterate_images(image_paths, num_workers, prefetch), total=len(image_paths), smoothing=0.0):
+        if image is None:
+            continue
+        b_imgs[len(b_paths)] = image
+        b_paths.append(str(image_path))
+
+        if len(b_paths) >= args.batch_size:
+            flush_batch()
+
+    if len(b_paths) > 0:
+        flush_batch()
+    journal.close()
+
+    elapsed = time.perf_counter() - start_time
+    logger.info(f"tagged {len(image_paths)} images in {elapsed:.1f} sec ({len(image_paths) / max(elapsed, 1e-9):.2f} images/sec)")
 
     if args.frequency_tags:
+        tag_freq = {freq_names[i]: int(tag_counts[i]) for i in first_seen_ids}
         sorted_tags = sorted(tag_freq.items(), key=lambda x: x[1], reverse=True)
         print("Tag frequencies:")
         for tag, freq in sorted_tags:
@@ -407,7 +446,8 @@ def setup_parser() -> argparse.ArgumentParser:
         "--max_data_loader_n_workers",
         type=int,
         default=None,
-        help="enable image reading by DataLoader with this number of workers (faster) / DataLoaderによる画像読み込みを有効にしてこのワーカー数を適用する（読み込みを高速化）",
+        help="decode images in this number of worker processes in parallel with inference (faster)"
+        + " / このプロセス数で画像の読み込みを推論と並行して行う（読み込みを高速化）",
     )
     parser.add_argument(
         "--caption_extention",
@@ -488,6 +528,13 @@ def setup_parser() -> argparse.ArgumentParser:
         help="tag replacement in the format of `source1,target1;source2,target2; ...`. Escape `,` and `;` with `\`. e.g. `tag1,tag2;tag3,tag4`"
         + " / タグの置換を `置換元1,置換先1;置換元2,置換先2; ...`で指定する。`\` で `,` と `;` をエスケープできる。例: `tag1,tag2;tag3,tag4`",
     )
+    parser.add_argument(
+        "--journal_file",
+        type=str,
+        default=None,
+        help="journal of tagged images to resume an interrupted run, images in the journal are skipped. tag frequencies are"
+        + " counted for this run only / 中断した処理を再開するためのジャーナル、記録済みの画像はスキップされる。タグの出現頻度は今回の実行分のみ",
+    )
     parser.add_argument(
         "--character_tag_expand",
         action="store_true",
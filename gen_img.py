@@ -1,4 +1,3 @@
-import itertools
 import json
 from typing import Any, List, NamedTuple, Optional, Tuple, Union, Callable
 import glob
@@ -53,14 +52,17 @@ import library.model_util as model_util
 import library.train_util as train_util
 import library.sdxl_model_util as sdxl_model_util
 import library.sdxl_train_util as sdxl_train_util
+import library.prompt_attention as prompt_attention
 from networks.lora import LoRANetwork
+from networks.lora_bank import LoRABank
 import tools.original_control_net as original_control_net
 from tools.original_control_net import ControlNetInfo
 from library.original_unet import UNet2DConditionModel, InferUNet2DConditionModel
 from library.sdxl_original_unet import InferSdxlUNet2DConditionModel
 from library.original_unet import FlashAttentionFunction
 from networks.control_net_lllite import ControlNetLLLite
-from library.utils import GradualLatent, EulerAncestralDiscreteSchedulerGL
+from library.utils import GradualLatent, EulerAncestralDiscreteSchedulerGL, BatchPlanner, DynamicPromptVariants
+from library.utils import TextEmbeddingCache, encode_text_with_cache, ImageWriter, to_pil_image
 from library.utils import setup_logging, add_logging_arguments
 
 setup_logging()
@@ -307,6 +309,7 @@ class PipelineLike:
         self.is_sdxl = is_sdxl
         self.device = device
         self.clip_skip = clip_skip
+        self.text_embedding_cache: Optional[TextEmbeddingCache] = None
 
         if hasattr(scheduler.config, "steps_offset") and scheduler.config.steps_offset != 1:
             deprecation_message = (
@@ -507,6 +510,7 @@ class PipelineLike:
                 clip_skip=self.clip_skip,
                 token_replacer=token_replacer,
                 device=self.device,
+                text_embedding_cache=self.text_embedding_cache,
                 emb_normalize_mode=emb_normalize_mode,
                 **kwargs,
             )
@@ -660,6 +664,8 @@ class PipelineLike:
                 init_image = torch.cat(init_image)
             if isinstance(init_image, list):
                 init_image = torch.stack(init_image)
+            if init_image.ndim == 3:
+                init_image = init_image.unsqueeze(0)  # 1枚だけのtensor（highres fixの2nd stageなど）
 
             # mask image to tensor
             if mask_image is not None:
@@ -876,6 +882,9 @@ class PipelineLike:
                 )
             image = torch.cat(images)
 
+        if output_type == "tensor":
+            return image.clamp(-1, 1)  # keep on the device, e.g. for the 2nd stage of highres fix
+
         image = (image / 2 + 0.5).clamp(0, 1)
 
         # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
@@ -894,113 +903,9 @@ class PipelineLike:
         # return StableDiffusionPipelineOutput(images=image, nsfw_content_detected=has_nsfw_concept)
 
 
-re_attention = re.compile(
-    r"""
-\\\(|
-\\\)|
-\\\[|
-\\]|
-\\\\|
-\\|
-\(|
-\[|
-:([+-]?[.\d]+)\)|
-\)|
-]|
-[^\\()\[\]:]+|
-:
-""",
-    re.X,
-)
-
-
 def parse_prompt_attention(text):
-    """
-    Parses a string with attention tokens and returns a list of pairs: text and its associated weight.
-    Accepted tokens are:
-      (abc) - increases attention to abc by a multiplier of 1.1
-      (abc:3.12) - increases attention to abc by a multiplier of 3.12
-      [abc] - decreases attention to abc by a multiplier of 1.1
-      \( - literal character '('
-      \[ - literal character '['
-      \) - literal character ')'
-      \] - literal character ']'
-      \\ - literal character '\'
-      anything else - just text
-    >>> parse_prompt_attention('normal text')
-    [['normal text', 1.0]]
-    >>> parse_prompt_attention('an (important) word')
-    [['an ', 1.0], ['important', 1.1], [' word', 1.0]]
-    >>> parse_prompt_attention('(unbalanced')
-    [['unbalanced', 1.1]]
-    >>> parse_prompt_attention('\(literal\]')
-    [['(literal]', 1.0]]
-    >>> parse_prompt_attention('(unnecessary)(parens)')
-    [['unnecessaryparens', 1.1]]
-    >>> parse_prompt_attention('a (((house:1.3)) [on] a (hill:0.5), sun, (((sky))).')
-    [['a ', 1.0],
-     ['house', 1.5730000000000004],
-     [' ', 1.1],
-     ['on', 1.0],
-     [' a ', 1.1],
-     ['hill', 0.55],
-     [', sun, ', 1.1],
-     ['sky', 1.4641000000000006],
-     ['.', 1.1]]
-    """
-
-    res = []
-    round_brackets = []
-    square_brackets = []
-
-    round_bracket_multiplier = 1.1
-    square_bracket_multiplier = 1 / 1.1
-
-    def multiply_range(start_position, multiplier):
-        for p in range(start_position, len(res)):
-            res[p][1] *= multiplier
-
-    # keep break as separate token
-    text = text.replace("BREAK", "\\BREAK\\")
-
-    for m in re_attention.finditer(text):
-        text = m.group(0)
-        weight = m.group(1)
-
-        if text.startswith("\\"):
-            res.append([text[1:], 1.0])
-        elif text == "(":
-            round_brackets.append(len(res))
-        elif text == "[":
-            square_brackets.append(len(res))
-        elif weight is not None and len(round_brackets) > 0:
-            multiply_range(round_brackets.pop(), float(weight))
-        elif text == ")" and len(round_brackets) > 0:
-            multiply_range(round_brackets.pop(), round_bracket_multiplier)
-        elif text == "]" and len(square_brackets) > 0:
-            multiply_range(square_brackets.pop(), square_bracket_multiplier)
-        else:
-            res.append([text, 1.0])
-
-    for pos in round_brackets:
-        multiply_range(pos, round_bracket_multiplier)
-
-    for pos in square_brackets:
-        multiply_range(pos, square_bracket_multiplier)
-
-    if len(res) == 0:
-        res = [["", 1.0]]
-
-    # merge runs of identical weights
-    i = 0
-    while i + 1 < len(res):
-        if res[i][1] == res[i + 1][1] and res[i][0].strip() != "BREAK" and res[i + 1][0].strip() != "BREAK":
-            res[i][0] += res[i + 1][0]
-            res.pop(i + 1)
-        else:
-            i += 1
-
-    return res
+    # BREAK is kept as a separate item
+    return prompt_attention.parse_prompt_attention(text, keep_break=True)
 
 
 def get_prompts_with_weights(tokenizer: CLIPTokenizer, token_replacer, prompt: List[str], max_length: int):
@@ -1008,50 +913,7 @@ def get_prompts_with_weights(tokenizer: CLIPTokenizer, token_replacer, prompt: L
     Tokenize a list of prompts and return its tokens with weights of each token.
     No padding, starting or ending token is included.
     """
-    tokens = []
-    weights = []
-    truncated = False
-
-    for text in prompt:
-        texts_and_weights = parse_prompt_attention(text)
-        text_token = []
-        text_weight = []
-        for word, weight in texts_and_weights:
-            if word.strip() == "BREAK":
-                # pad until next multiple of tokenizer's max token length
-                pad_len = tokenizer.model_max_length - (len(text_token) % tokenizer.model_max_length)
-                logger.info(f"BREAK pad_len: {pad_len}")
-                for i in range(pad_len):
-                    # v2のときEOSをつけるべきかどうかわからないぜ
-                    # if i == 0:
-                    #     text_token.append(tokenizer.eos_token_id)
-                    # else:
-                    text_token.append(tokenizer.pad_token_id)
-                    text_weight.append(1.0)
-                continue
-
-            # tokenize and discard the starting and the ending token
-            token = tokenizer(word).input_ids[1:-1]
-
-            token = token_replacer(token)  # for Textual Inversion
-
-            text_token += token
-            # copy the weight by length of token
-            text_weight += [weight] * len(token)
-            # stop if the text is too long (longer than truncation limit)
-            if len(text_token) > max_length:
-                truncated = True
-                break
-        # truncate
-        if len(text_token) > max_length:
-            truncated = True
-            text_token = text_token[:max_length]
-            text_weight = text_weight[:max_length]
-        tokens.append(text_token)
-        weights.append(text_weight)
-    if truncated:
-        logger.warning("warning: Prompt was truncated. Try to shorten the prompt or increase max_embeddings_multiples")
-    return tokens, weights
+    return prompt_attention.get_prompts_with_weights(tokenizer, prompt, max_length, token_replacer, keep_break=True)
 
 
 def pad_tokens_and_weights(tokens, weights, max_length, bos, eos, pad, no_boseos_middle=True, chunk_length=77):
@@ -1159,6 +1021,7 @@ def get_weighted_text_embeddings(
     clip_skip: int = 1,
     token_replacer=None,
     device=None,
+    text_embedding_cache: Optional[TextEmbeddingCache] = None,
     emb_normalize_mode: Optional[str] = "original",  # "original", "abs", "none"
     **kwargs,
 ):
@@ -1227,29 +1090,20 @@ def get_weighted_text_embeddings(
         )
         uncond_tokens = torch.tensor(uncond_tokens, dtype=torch.long, device=device)
 
-    # get the embeddings
-    text_embeddings, text_pool = get_unweighted_text_embeddings(
-        is_sdxl,
-        text_encoder,
-        prompt_tokens,
-        tokenizer.model_max_length,
-        clip_skip,
-        eos,
-        pad,
-        no_boseos_middle=no_boseos_middle,
+    # get the embeddings. outputs of the same tokens are reused if the cache is given
+    def encode(text_input):
+        return get_unweighted_text_embeddings(
+            is_sdxl, text_encoder, text_input, tokenizer.model_max_length, clip_skip, eos, pad, no_boseos_middle=no_boseos_middle
+        )
+
+    text_embeddings, text_pool = encode_text_with_cache(
+        text_embedding_cache, text_encoder, prompt_tokens, encode, clip_skip, no_boseos_middle
     )
 
     prompt_weights = torch.tensor(prompt_weights, dtype=text_embeddings.dtype, device=device)
     if uncond_prompt is not None:
-        uncond_embeddings, uncond_pool = get_unweighted_text_embeddings(
-            is_sdxl,
-            text_encoder,
-            uncond_tokens,
-            tokenizer.model_max_length,
-            clip_skip,
-            eos,
-            pad,
-            no_boseos_middle=no_boseos_middle,
+        uncond_embeddings, uncond_pool = encode_text_with_cache(
+            text_embedding_cache, text_encoder, uncond_tokens, encode, clip_skip, no_boseos_middle
         )
         uncond_weights = torch.tensor(uncond_weights, dtype=uncond_embeddings.dtype, device=device)
 
@@ -1313,110 +1167,6 @@ def preprocess_mask(mask):
     return mask
 
 
-# regular expression for dynamic prompt:
-# starts and ends with "{" and "}"
-# contains at least one variant divided by "|"
-# optional framgments divided by "$$" at start
-# if the first fragment is "E" or "e", enumerate all variants
-# if the second fragment is a number or two numbers, repeat the variants in the range
-# if the third fragment is a string, use it as a separator
-
-RE_DYNAMIC_PROMPT = re.compile(r"\{((e|E)\$\$)?(([\d\-]+)\$\$)?(([^\|\}]+?)\$\$)?(.+?((\|).+?)*?)\}")
-
-
-def handle_dynamic_prompt_variants(prompt, repeat_count):
-    founds = list(RE_DYNAMIC_PROMPT.finditer(prompt))
-    if not founds:
-        return [prompt]
-
-    # make each replacement for each variant
-    enumerating = False
-    replacers = []
-    for found in founds:
-        # if "e$$" is found, enumerate all variants
-        found_enumerating = found.group(2) is not None
-        enumerating = enumerating or found_enumerating
-
-        separator = ", " if found.group(6) is None else found.group(6)
-        variants = found.group(7).split("|")
-
-        # parse count range
-        count_range = found.group(4)
-        if count_range is None:
-            count_range = [1, 1]
-        else:
-            count_range = count_range.split("-")
-            if len(count_range) == 1:
-                count_range = [int(count_range[0]), int(count_range[0])]
-            elif len(count_range) == 2:
-                count_range = [int(count_range[0]), int(count_range[1])]
-            else:
-                logger.warning(f"invalid count range: {count_range}")
-                count_range = [1, 1]
-            if count_range[0] > count_range[1]:
-                count_range = [count_range[1], count_range[0]]
-            if count_range[0] < 0:
-                count_range[0] = 0
-            if count_range[1] > len(variants):
-                count_range[1] = len(variants)
-
-        if found_enumerating:
-            # make function to enumerate all combinations
-            def make_replacer_enum(vari, cr, sep):
-                def replacer():
-                    values = []
-                    for count in range(cr[0], cr[1] + 1):
-                        for comb in itertools.combinations(vari, count):
-                            values.append(sep.join(comb))
-                    return values
-
-                return replacer
-
-            replacers.append(make_replacer_enum(variants, count_range, separator))
-        else:
-            # make function to choose random combinations
-            def make_replacer_single(vari, cr, sep):
-                def replacer():
-                    count = random.randint(cr[0], cr[1])
-                    comb = random.sample(vari, count)
-                    return [sep.join(comb)]
-
-                return replacer
-
-            replacers.append(make_replacer_single(variants, count_range, separator))
-
-    # make each prompt
-    if not enumerating:
-        # if not enumerating, repeat the prompt, replace each variant randomly
-        prompts = []
-        for _ in range(repeat_count):
-            current = prompt
-            for found, replacer in zip(founds, replacers):
-                current = current.replace(found.group(0), replacer()[0], 1)
-            prompts.append(current)
-    else:
-        # if enumerating, iterate all combinations for previous prompts
-        prompts = [prompt]
-
-        for found, replacer in zip(founds, replacers):
-            if found.group(2) is not None:
-                # make all combinations for existing prompts
-                new_prompts = []
-                for current in prompts:
-                    replecements = replacer()
-                    for replecement in replecements:
-                        new_prompts.append(current.replace(found.group(0), replecement, 1))
-                prompts = new_prompts
-
-        for found, replacer in zip(founds, replacers):
-            # make random selection for existing prompts
-            if found.group(2) is None:
-                for i in range(len(prompts)):
-                    prompts[i] = prompts[i].replace(found.group(0), replacer()[0], 1)
-
-    return prompts
-
-
 # endregion
 
 # def load_clip_l14_336(dtype):
@@ -1719,6 +1469,11 @@ def main(args):
         vae = sli_vae
         del sli_vae
 
+    if args.vae_tiling:
+        from library.tiled_vae import enable_vae_tiling
+
+        enable_vae_tiling(vae, args.vae_tile_size, args.vae_tile_overlap)
+
     vae_dtype = dtype
     if args.no_half_vae:
         logger.info("set vae_dtype to float32")
@@ -2038,6 +1793,14 @@ def main(args):
 
     if args.interactive:
         args.n_iter = 1
+        if args.regroup_batches:
+            logger.warning("--regroup_batches is ignored in interactive mode / 対話モードでは--regroup_batchesは無視されます")
+            args.regroup_batches = False
+
+    if args.server:
+        assert not args.interactive, "--server and --interactive cannot be used together / --serverと--interactiveは同時に使えません"
+        args.n_iter = 1
+        args.regroup_batches = True  # micro-batching of jobs
 
     # img2imgの前処理、画像の読み込みなど
     def load_images(path):
@@ -2101,7 +1864,7 @@ def main(args):
         mask_images = None
 
     # promptがないとき、画像のPngInfoから取得する
-    if init_images is not None and prompter is None and not args.interactive:
+    if init_images is not None and prompter is None and not args.interactive and not args.server:
         logger.info("get prompts from images' metadata")
         prompt_list = []
         for img in init_images:
@@ -2166,6 +1929,10 @@ def main(args):
             network.set_region(i, i == len(networks) - 1, mask)
         mask_images = None
 
+    # cache text encoder outputs for repeated prompts. LoRA for sub prompts depends on the position in the batch, so not used
+    if args.text_embedding_cache_size > 0 and not regional_network:
+        pipe.text_embedding_cache = TextEmbeddingCache(args.text_embedding_cache_size)
+
     prev_image = None  # for VGG16 guided
     if args.guide_image_path is not None:
         logger.info(f"load image for ControlNet guidance: {args.guide_image_path}")
@@ -2205,6 +1972,38 @@ def main(args):
     os.makedirs(args.outdir, exist_ok=True)
     max_embeddings_multiples = 1 if args.max_embeddings_multiples is None else args.max_embeddings_multiples
 
+    # encode and save images in background
+    image_writer = ImageWriter(args.image_save_workers, args.image_save_processes)
+
+    # server mode: models are kept loaded and prompts come from the job queue
+    server = None
+    server_jobs = {}  # global step -> job
+    if args.server:
+        from library.gen_server import GenerationServer
+
+        server = GenerationServer(args.batch_size, args.server_host, args.server_port, args.server_socket, args.server_timeout)
+        server.start()
+
+    # LoRAs of prompts (--lora) or jobs, merged to the model weights and switched between batches
+    lora_bank = LoRABank(
+        text_encoders,
+        unet,
+        dtype,
+        device,
+        args.lora_bank_cache_dir,
+        args.lora_bank_max_loras,
+        device if args.lora_bank_on_device else None,
+    )
+
+    def switch_loras(loras):
+        if loras and networks and network_pre_calc:
+            raise ValueError("--lora is not supported with --network_pre_calc / --loraと--network_pre_calcは併用できません")
+        elapsed = lora_bank.apply(loras)
+        if server is not None:
+            server.metrics.add_lora_swap(elapsed)
+        if pipe.text_embedding_cache is not None:
+            pipe.text_embedding_cache.clear()  # weights of text encoder may be changed
+
     for gen_iter in range(args.n_iter):
         logger.info(f"iteration {gen_iter+1}/{args.n_iter}")
         if args.iter_same_seed:
@@ -2216,107 +2015,119 @@ def main(args):
         if args.shuffle_prompts:
             prompter.shuffle()
 
-        # バッチ処理の関数
-        def process_batch(batch: List[BatchData], highres_fix, highres_1st=False):
-            batch_size = len(batch)
+        # highres fixの1st stageの出力を2nd stageへ渡す形式
+        # the upscaler module requires PIL images unless it supports latents, otherwise decoded images stay on the device
+        highres_1st_pil = upscaler is not None and not upscaler.support_latents()
+
+        def process_highres_1st(batch: List[BatchData]):
+            # 1st stageのバッチを作成して呼び出す：サイズを小さくして呼び出す
+            # the outputs are queued to the 2nd stage, which makes batches of its own size
+            is_1st_latent = upscaler.support_latents() if upscaler else args.highres_fix_latents_upscaling
+
+            logger.info("process 1st stage")
+            batch_1st = []
+            for _, base, ext in batch:
+
+                def scale_and_round(x):
+                    if x is None:
+                        return None
+                    return int(x * args.highres_fix_scale + 0.5)
+
+                width_1st = scale_and_round(ext.width)
+                height_1st = scale_and_round(ext.height)
+                width_1st = width_1st - width_1st % 32
+                height_1st = height_1st - height_1st % 32
+
+                original_width_1st = scale_and_round(ext.original_width)
+                original_height_1st = scale_and_round(ext.original_height)
+                original_width_negative_1st = scale_and_round(ext.original_width_negative)
+                original_height_negative_1st = scale_and_round(ext.original_height_negative)
+                crop_left_1st = scale_and_round(ext.crop_left)
+                crop_top_1st = scale_and_round(ext.crop_top)
+
+                strength_1st = ext.strength if args.highres_fix_strength is None else args.highres_fix_strength
+
+                ext_1st = BatchDataExt(
+                    width_1st,
+                    height_1st,
+                    original_width_1st,
+                    original_height_1st,
+                    original_width_negative_1st,
+                    original_height_negative_1st,
+                    crop_left_1st,
+                    crop_top_1st,
+                    args.highres_fix_steps,
+                    ext.scale,
+                    ext.negative_scale,
+                    strength_1st,
+                    ext.network_muls,
+                    ext.num_sub_prompts,
+                )
+                batch_1st.append(BatchData(is_1st_latent, base, ext_1st))
 
-            # highres_fixの処理
-            if highres_fix and not highres_1st:
-                # 1st stageのバッチを作成して呼び出す：サイズを小さくして呼び出す
-                is_1st_latent = upscaler.support_latents() if upscaler else args.highres_fix_latents_upscaling
-
-                logger.info("process 1st stage")
-                batch_1st = []
-                for _, base, ext in batch:
-
-                    def scale_and_round(x):
-                        if x is None:
-                            return None
-                        return int(x * args.highres_fix_scale + 0.5)
-
-                    width_1st = scale_and_round(ext.width)
-                    height_1st = scale_and_round(ext.height)
-                    width_1st = width_1st - width_1st % 32
-                    height_1st = height_1st - height_1st % 32
-
-                    original_width_1st = scale_and_round(ext.original_width)
-                    original_height_1st = scale_and_round(ext.original_height)
-                    original_width_negative_1st = scale_and_round(ext.original_width_negative)
-                    original_height_negative_1st = scale_and_round(ext.original_height_negative)
-                    crop_left_1st = scale_and_round(ext.crop_left)
-                    crop_top_1st = scale_and_round(ext.crop_top)
-
-                    strength_1st = ext.strength if args.highres_fix_strength is None else args.highres_fix_strength
-
-                    ext_1st = BatchDataExt(
-                        width_1st,
-                        height_1st,
-                        original_width_1st,
-                        original_height_1st,
-                        original_width_negative_1st,
-                        original_height_negative_1st,
-                        crop_left_1st,
-                        crop_top_1st,
-                        args.highres_fix_steps,
-                        ext.scale,
-                        ext.negative_scale,
-                        strength_1st,
-                        ext.network_muls,
-                        ext.num_sub_prompts,
-                    )
-                    batch_1st.append(BatchData(is_1st_latent, base, ext_1st))
-
-                pipe.set_enable_control_net(True)  # 1st stageではControlNetを有効にする
-                images_1st = process_batch(batch_1st, True, True)
-
-                # 2nd stageのバッチを作成して以下処理する
-                logger.info("process 2nd stage")
-                width_2nd, height_2nd = batch[0].ext.width, batch[0].ext.height
-
-                if upscaler:
-                    # upscalerを使って画像を拡大する
-                    lowreso_imgs = None if is_1st_latent else images_1st
-                    lowreso_latents = None if not is_1st_latent else images_1st
-
-                    # 戻り値はPIL.Image.Imageかtorch.Tensorのlatents
-                    batch_size = len(images_1st)
-                    vae_batch_size = (
-                        batch_size
-                        if args.vae_batch_size is None
-                        else (max(1, int(batch_size * args.vae_batch_size)) if args.vae_batch_size < 1 else args.vae_batch_size)
-                    )
-                    vae_batch_size = int(vae_batch_size)
-                    images_1st = upscaler.upscale(
-                        vae, lowreso_imgs, lowreso_latents, dtype, width_2nd, height_2nd, batch_size, vae_batch_size
-                    )
+            pipe.set_enable_control_net(True)  # 1st stageではControlNetを有効にする
+            images_1st = process_batch(batch_1st, True, True)
 
-                elif args.highres_fix_latents_upscaling:
+            # 2nd stageのキューに入れる。1st stageの出力はinit_imageとして持ち、2nd stageのバッチでまとめて拡大する
+            for bd, image in zip(batch, images_1st):
+                highres_planner.add(
+                    BatchData(False, BatchDataBase(*bd.base[0:3], bd.base.seed + 1, image, None, *bd.base[6:]), bd.ext)
+                )
+            return images_1st
+
+        def process_highres_2nd(batch: List[BatchData]):
+            # 2nd stageのバッチの1st stageの出力をまとめて拡大してから処理する
+            logger.info("process 2nd stage")
+            width_2nd, height_2nd = batch[0].ext.width, batch[0].ext.height
+            images_1st = [bd.base.init_image for bd in batch]
+
+            if upscaler:
+                # upscalerを使って画像を拡大する
+                is_1st_latent = upscaler.support_latents()
+                lowreso_imgs = None if is_1st_latent else images_1st
+                lowreso_latents = None if not is_1st_latent else torch.stack(images_1st)
+
+                # 戻り値はPIL.Image.Imageかtorch.Tensorのlatents
+                batch_size = len(images_1st)
+                vae_batch_size = (
+                    batch_size
+                    if args.vae_batch_size is None
+                    else (max(1, int(batch_size * args.vae_batch_size)) if args.vae_batch_size < 1 else args.vae_batch_size)
+                )
+                vae_batch_size = int(vae_batch_size)
+                images_2nd = upscaler.upscale(
+                    vae, lowreso_imgs, lowreso_latents, dtype, width_2nd, height_2nd, batch_size, vae_batch_size
+                )
+            else:
+                images_2nd = torch.stack(images_1st)
+                org_dtype = images_2nd.dtype
+                images_2nd = images_2nd.to(torch.float)  # interpolateがbf16をサポートしていない
+                if args.highres_fix_latents_upscaling:
                     # latentを拡大する
-                    org_dtype = images_1st.dtype
-                    if images_1st.dtype == torch.bfloat16:
-                        images_1st = images_1st.to(torch.float)  # interpolateがbf16をサポートしていない
-                    images_1st = torch.nn.functional.interpolate(
-                        images_1st, (batch[0].ext.height // 8, batch[0].ext.width // 8), mode="bilinear"
+                    images_2nd = torch.nn.functional.interpolate(
+                        images_2nd, (height_2nd // 8, width_2nd // 8), mode="bilinear"
                     )  # , antialias=True)
-                    images_1st = images_1st.to(org_dtype)
-
                 else:
-                    # 画像をLANCZOSで拡大する
-                    images_1st = [image.resize((width_2nd, height_2nd), resample=PIL.Image.LANCZOS) for image in images_1st]
+                    # decodeした画像をdevice上でまとめて拡大する（PIL.ImageのLANCZOSの代わりにbicubic）
+                    images_2nd = torch.nn.functional.interpolate(images_2nd, (height_2nd, width_2nd), mode="bicubic")
+                    images_2nd = images_2nd.clamp(-1, 1)
+                images_2nd = images_2nd.to(org_dtype)
 
-                batch_2nd = []
-                for i, (bd, image) in enumerate(zip(batch, images_1st)):
-                    bd_2nd = BatchData(False, BatchDataBase(*bd.base[0:3], bd.base.seed + 1, image, None, *bd.base[6:]), bd.ext)
-                    batch_2nd.append(bd_2nd)
-                batch = batch_2nd
+            batch = [BatchData(False, bd.base._replace(init_image=image), bd.ext) for bd, image in zip(batch, images_2nd)]
 
-                if args.highres_fix_disable_control_net:
-                    pipe.set_enable_control_net(False)  # オプション指定時、2nd stageではControlNetを無効にする
+            if args.highres_fix_disable_control_net:
+                pipe.set_enable_control_net(False)  # オプション指定時、2nd stageではControlNetを無効にする
+
+            return process_batch(batch, True)
+
+        # バッチ処理の関数
+        def process_batch(batch: List[BatchData], highres_fix, highres_1st=False):
+            batch_size = len(batch)
 
             # このバッチの情報を取り出す
             (
                 return_latents,
-                (step_first, _, _, _, init_image, mask_image, _, guide_image, _, _),
+                (_, _, _, _, init_image, mask_image, _, guide_image, _, _),
                 (
                     width,
                     height,
@@ -2347,6 +2158,7 @@ def main(args):
             ]
             seeds = []
             clip_prompts = []
+            image_steps = []  # global step of each image, may not be continuous when regrouped
 
             if init_image is not None:  # img2img?
                 i2i_noises = torch.zeros((batch_size, *noise_shape), device=device, dtype=dtype)
@@ -2372,13 +2184,14 @@ def main(args):
             all_guide_images_are_same = True
             for i, (
                 _,
-                (_, prompt, negative_prompt, seed, init_image, mask_image, clip_prompt, guide_image, raw_prompt, filename),
+                (image_step, prompt, negative_prompt, seed, init_image, mask_image, clip_prompt, guide_image, raw_prompt, filename),
                 _,
             ) in enumerate(batch):
                 prompts.append(prompt)
                 negative_prompts.append(negative_prompt)
                 seeds.append(seed)
                 clip_prompts.append(clip_prompt)
+                image_steps.append(image_step)
                 raw_prompts.append(raw_prompt)
                 filenames.append(filename)
 
@@ -2447,6 +2260,9 @@ def main(args):
                         n.pre_calculation()
                     logger.info("pre-calculation... done")
 
+            if pipe.text_embedding_cache is not None:
+                pipe.text_embedding_cache.set_state(tuple(network_muls) if network_muls else None)
+
             images = pipe(
                 prompts,
                 negative_prompts,
@@ -2465,7 +2281,7 @@ def main(args):
                 negative_scale,
                 strength,
                 latents=start_code,
-                output_type="pil",
+                output_type="pil" if highres_1st and highres_1st_pil else "tensor",
                 max_embeddings_multiples=max_embeddings_multiples,
                 img2img_noise=i2i_noises,
                 vae_batch_size=args.vae_batch_size,
@@ -2477,6 +2293,13 @@ def main(args):
             if highres_1st and not args.highres_fix_save_1st:  # return images or latents
                 return images
 
+            outputs = images  # the outputs of the 1st stage are passed to the 2nd stage on the device
+            if not return_latents and not (highres_1st and highres_1st_pil):
+                # decoded tensors: the image writer converts them to PIL images (float to uint8) in the workers
+                images = images.cpu()
+                if not highres_1st:
+                    outputs = images
+
             # save image
             highres_prefix = ("0" if highres_1st else "1") if highres_fix else ""
             ts_str = time.strftime("%Y%m%d%H%M%S", time.localtime())
@@ -2516,21 +2339,21 @@ def main(args):
                         else:
                             fln = os.path.splitext(os.path.basename(init_images.filename))[0] + ".png"
                     elif args.sequential_file_name:
-                        fln = f"im_{highres_prefix}{step_first + i + 1:06d}.png"
+                        fln = f"im_{highres_prefix}{image_steps[i] + 1:06d}.png"
                     else:
                         fln = f"im_{ts_str}_{highres_prefix}{i:03d}_{seed}.png"
 
                 if fln.endswith(".webp"):
-                    image.save(os.path.join(args.outdir, fln), pnginfo=metadata, quality=100)  # lossy
+                    image_writer.save(image, os.path.join(args.outdir, fln), pnginfo=metadata, quality=100)  # lossy
                 else:
-                    image.save(os.path.join(args.outdir, fln), pnginfo=metadata)
+                    image_writer.save(image, os.path.join(args.outdir, fln), pnginfo=metadata)
 
             if not args.no_preview and not highres_1st and args.interactive:
                 try:
                     import cv2
 
                     for prompt, image in zip(prompts, images):
-                        cv2.imshow(prompt[:128], np.array(image)[:, :, ::-1])  # プロンプトが長いと死ぬ
+                        cv2.imshow(prompt[:128], np.array(to_pil_image(image))[:, :, ::-1])  # プロンプトが長いと死ぬ
                         cv2.waitKey()
                         cv2.destroyAllWindows()
                 except ImportError:
@@ -2538,12 +2361,56 @@ def main(args):
                         "opencv-python is not installed, cannot preview / opencv-pythonがインストールされていないためプレビューできません"
                     )
 
-            return images
+            return outputs
 
         # 画像生成のプロンプトが一周するまでのループ
         prompt_index = 0
         global_step = 0
-        batch_data = []
+        def process_planned_batch(batch: List[BatchData], process_fn, final: bool = True):
+            # final is False for the 1st stage of highres fix: the images are delivered after the 2nd stage
+            if server is None:
+                return process_fn(batch)
+
+            # deliver the images to the jobs
+            if final:
+                server.metrics.add_batch(len(batch))
+            try:
+                images = process_fn(batch)
+            except Exception as e:
+                logger.exception(f"failed to generate / 生成に失敗しました: {e}")
+                for bd in batch:
+                    job = server_jobs.pop(bd.base.step)
+                    if job.fail(str(e)):
+                        server.finish_job(job)
+                return None
+
+            if final:
+                for bd, image in zip(batch, images):
+                    job = server_jobs.pop(bd.base.step)
+                    seed = bd.base.seed - 1 if highres_fix else bd.base.seed  # 2nd stage uses seed + 1
+                    if job.add_image(seed, image):
+                        server.finish_job(job)
+            return images
+
+        if highres_fix:
+            # 1st stageと2nd stageはそれぞれのバッチサイズでまとめる
+            highres_planner = BatchPlanner(
+                args.highres_fix_batch_size or args.batch_size,
+                lambda batch: process_planned_batch(batch, process_highres_2nd),
+                regroup=args.regroup_batches,
+            )
+            batch_planner = BatchPlanner(
+                args.batch_size,
+                lambda batch: process_planned_batch(batch, process_highres_1st, final=False),
+                regroup=args.regroup_batches,
+                next_stage=highres_planner,
+            )
+        else:
+            batch_planner = BatchPlanner(
+                args.batch_size,
+                lambda batch: process_planned_batch(batch, lambda b: process_batch(b, False)),
+                regroup=args.regroup_batches,
+            )
         while True:
             if args.interactive:
                 # interactive
@@ -2558,21 +2425,32 @@ def main(args):
                     valid = len(raw_prompt.strip().split(" --")[0].strip()) > 0
                 if not valid:  # EOF, end app
                     break
+            elif server is not None:
+                # wait for a job. partial batches are generated if they wait longer than --server_max_wait
+                batch_planner.flush(max_age=args.server_max_wait)
+                job = server.get_job(batch_planner.get_time_to_flush(args.server_max_wait))
+                if job is None:
+                    if server.shutdown_received:
+                        break
+                    continue
+
+                raw_prompt = job.prompt
             else:
                 raw_prompt = prompter(args, pipe, seed_random, iter_seed, prompt_index, global_step)
                 if raw_prompt is None:
                     break
 
             # sd-dynamic-prompts like variants:
-            # count is 1 (not dynamic) or images_per_prompt (no enumeration) or arbitrary (enumeration)
-            raw_prompts = handle_dynamic_prompt_variants(raw_prompt, args.images_per_prompt)
+            # count is images_per_prompt (no enumeration) or arbitrary (enumeration). prompts are expanded lazily
+            raw_prompts = DynamicPromptVariants(raw_prompt, args.images_per_prompt)
+            if server is not None:
+                job.num_images = len(raw_prompts)
 
             # repeat prompt
-            for pi in range(args.images_per_prompt if len(raw_prompts) == 1 else len(raw_prompts)):
-                raw_prompt = raw_prompts[pi] if len(raw_prompts) > 1 else raw_prompts[0]
+            for pi, raw_prompt in enumerate(raw_prompts):
                 filename = None
 
-                if pi == 0 or len(raw_prompts) > 1:
+                if pi == 0 or not raw_prompts.is_repeated:
                     # parse prompt: if prompt is not changed, skip parsing
                     width = args.W
                     height = args.H
@@ -2591,6 +2469,7 @@ def main(args):
                     negative_prompt = ""
                     clip_prompt = None
                     network_muls = None
+                    loras = job.loras if server is not None else ()
 
                     # Deep Shrink
                     ds_depth_1 = None  # means no override
@@ -2792,6 +2671,18 @@ def main(args):
                                 logger.info(f"gradual latent unsharp params: {gl_unsharp_params}")
                                 continue
 
+                            m = re.match(r"lora (.+)", parg, re.IGNORECASE)
+                            if m:  # LoRAs: path[:multiplier], separated by ";"
+                                loras = []
+                                for lora in m.group(1).split(";"):
+                                    path, _, multiplier = lora.strip().rpartition(":")
+                                    if path == "" or not re.fullmatch(r"[\d\.\-]+", multiplier):
+                                        path, multiplier = lora.strip(), "1.0"  # no multiplier, or ":" of Windows drive
+                                    loras.append((path, float(multiplier)))
+                                loras = tuple(loras)
+                                logger.info(f"LoRAs: {loras}")
+                                continue
+
                             m = re.match(r"f (.+)", parg, re.IGNORECASE)
                             if m:  # filename
                                 filename = m.group(1)
@@ -2804,12 +2695,14 @@ def main(args):
 
                 # override Deep Shrink
                 if ds_depth_1 is not None:
+                    batch_planner.flush()  # pending requests are generated with the current settings
                     if ds_depth_1 < 0:
                         ds_depth_1 = args.ds_depth_1 or 3
                     unet.set_deep_shrink(ds_depth_1, ds_timesteps_1, ds_depth_2, ds_timesteps_2, ds_ratio)
 
                 # override Gradual Latent
                 if gl_timesteps is not None:
+                    batch_planner.flush()
                     if gl_timesteps < 0:
                         gl_timesteps = args.gradual_latent_timesteps or 650
                     if gl_unsharp_params is not None:
@@ -2916,23 +2809,48 @@ def main(args):
                         num_sub_prompts,
                     ),
                 )
-                if len(batch_data) > 0 and batch_data[-1].ext != b1.ext:  # バッチ分割必要？
-                    process_batch(batch_data, highres_fix)
-                    batch_data.clear()
+                if loras != lora_bank.current:
+                    batch_planner.flush()  # LoRAs are merged to the model weights
+                    try:
+                        switch_loras(loras)
+                    except Exception as e:
+                        if server is None:
+                            raise
+                        logger.exception(f"failed to load LoRA / LoRAの読み込みに失敗しました: {e}")
+                        if job.fail(str(e)):
+                            server.finish_job(job)
+                        switch_loras(())
+                        break
 
-                batch_data.append(b1)
-                if len(batch_data) == args.batch_size:
-                    prev_image = process_batch(batch_data, highres_fix)[0]
-                    batch_data.clear()
+                # バッチ分割が必要なら処理する。regroup時は同じパラメータのプロンプトをまとめてバッチにする
+                if server is not None:
+                    server_jobs[global_step] = job
+                images = batch_planner.add(b1)
+                if images is not None:
+                    prev_image = images[0]
 
                 global_step += 1
 
             prompt_index += 1
 
-        if len(batch_data) > 0:
-            process_batch(batch_data, highres_fix)
-            batch_data.clear()
+        batch_planner.flush()
+        for stage, planner in [("", batch_planner), ("2nd stage ", batch_planner.next_stage)]:
+            if planner is not None and planner.num_batches > 0:
+                logger.info(
+                    f"{stage}batches: {planner.num_batches}, images: {planner.num_items},"
+                    + f" batch fill: {planner.get_fill_ratio() * 100:.1f}%"
+                )
 
+    if server is not None:
+        server.stop()
+        logger.info(f"server metrics: {server.metrics.to_dict(0)}")
+
+    if pipe.text_embedding_cache is not None:
+        logger.info(pipe.text_embedding_cache.get_stats_str())
+    if len(lora_bank.switch_times) > 0:
+        logger.info(lora_bank.get_stats_str())
+
+    image_writer.close()  # wait for all images to be saved
     logger.info("done!")
 
 
@@ -2975,6 +2893,27 @@ def setup_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="interactive mode (generates one image) / 対話モード（生成される画像は1枚になります）",
     )
+    parser.add_argument(
+        "--server",
+        action="store_true",
+        help="run as a local generation server with JSON API (POST /generate, GET /metrics), see library/gen_server.py"
+        + " / JSON APIのローカル生成サーバーとして動作する（POST /generate、GET /metrics）。library/gen_server.pyを参照",
+    )
+    parser.add_argument("--server_host", type=str, default="127.0.0.1", help="host of the server / サーバーのホスト")
+    parser.add_argument("--server_port", type=int, default=7860, help="port of the server / サーバーのポート")
+    parser.add_argument(
+        "--server_socket",
+        type=str,
+        default=None,
+        help="listen on this Unix socket instead of host/port / host/portの代わりにこのUnixソケットで待ち受ける",
+    )
+    parser.add_argument(
+        "--server_max_wait",
+        type=float,
+        default=0.1,
+        help="max seconds to wait for more jobs to fill a batch / バッチを埋めるために次のジョブを待つ最大秒数",
+    )
+    parser.add_argument("--server_timeout", type=float, default=600, help="timeout of a request in seconds / リクエストのタイムアウト秒数")
     parser.add_argument(
         "--no_preview", action="store_true", help="do not show generated image in interactive mode / 対話モードで画像を表示しない"
     )
@@ -3028,6 +2967,32 @@ def setup_parser() -> argparse.ArgumentParser:
         "--crop_left", type=int, default=None, help="crop left for SDXL conditioning / SDXLの条件付けに用いるcrop leftの値"
     )
     parser.add_argument("--batch_size", type=int, default=1, help="batch size / バッチサイズ")
+    parser.add_argument(
+        "--regroup_batches",
+        action="store_true",
+        help="group prompts with the same generation parameters (size, steps, scale etc.) into full batches across the prompt list."
+        + " file names and seeds are same as without this option"
+        + " / 同じ生成パラメータ（サイズ、ステップ数、スケール等）のプロンプトをプロンプトリスト全体からまとめてバッチにする。ファイル名とseedは指定しない場合と同じ",
+    )
+    parser.add_argument(
+        "--image_save_workers",
+        type=int,
+        default=2,
+        help="number of workers to encode and save images in background, 0 to save in main thread"
+        + " / バックグラウンドで画像をエンコード・保存するワーカー数、0でメインスレッドで保存する",
+    )
+    parser.add_argument(
+        "--image_save_processes",
+        action="store_true",
+        help="use processes instead of threads to save images / 画像の保存にスレッドではなくプロセスを使う",
+    )
+    parser.add_argument(
+        "--text_embedding_cache_size",
+        type=int,
+        default=256,
+        help="max number of text encoder outputs cached for repeated prompts, 0 to disable"
+        + " / 繰り返し使われるプロンプトのためにキャッシュするText Encoderの出力の最大数、0で無効",
+    )
     parser.add_argument(
         "--vae_batch_size",
         type=float,
@@ -3040,6 +3005,21 @@ def setup_parser() -> argparse.ArgumentParser:
         default=None,
         help="number of slices to split image into for VAE to reduce VRAM usage, None for no splitting (default), slower if specified. 16 or 32 recommended / VAE処理時にVRAM使用量削減のため画像を分割するスライス数、Noneの場合は分割しない（デフォルト）、指定すると遅くなる。16か32程度を推奨",
     )
+    parser.add_argument(
+        "--vae_tiling",
+        action="store_true",
+        help="encode/decode large images with VAE by overlapping tiles to reduce VRAM usage"
+        + " / VRAM使用量削減のため大きな画像をVAEで重なりのあるタイルに分割してencode/decodeする",
+    )
+    parser.add_argument(
+        "--vae_tile_size", type=int, default=64, help="tile size in latent for --vae_tiling / --vae_tilingのlatentでのタイルサイズ"
+    )
+    parser.add_argument(
+        "--vae_tile_overlap",
+        type=int,
+        default=8,
+        help="overlap of tiles in latent for --vae_tiling / --vae_tilingのlatentでのタイルの重なり",
+    )
     parser.add_argument(
         "--no_half_vae", action="store_true", help="do not use fp16/bf16 precision for VAE / VAE処理時にfp16/bf16を使わない"
     )
@@ -3153,6 +3133,24 @@ def setup_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--network_merge", action="store_true", help="merge network weights to original model / ネットワークの重みをマージする"
     )
+    parser.add_argument(
+        "--lora_bank_cache_dir",
+        type=str,
+        default=None,
+        help="directory to cache delta weights of LoRAs specified by --lora in prompts or server jobs"
+        + " / プロンプトの--loraやサーバーのジョブで指定したLoRAの差分の重みをキャッシュするディレクトリ",
+    )
+    parser.add_argument(
+        "--lora_bank_max_loras",
+        type=int,
+        default=4,
+        help="max number of LoRAs whose delta weights are kept in memory / 差分の重みをメモリに保持するLoRAの最大数",
+    )
+    parser.add_argument(
+        "--lora_bank_on_device",
+        action="store_true",
+        help="keep delta weights of LoRAs on the device (GPU) for faster switching / LoRAの差分の重みをGPU上に保持して切り替えを高速化する",
+    )
     parser.add_argument(
         "--network_pre_calc",
         action="store_true",
@@ -3212,6 +3210,12 @@ def setup_parser() -> argparse.ArgumentParser:
         default=None,
         help="1st stage img2img strength for highres fix / highres fixの最初のステージのimg2img時のstrength、省略時はstrengthと同じ",
     )
+    parser.add_argument(
+        "--highres_fix_batch_size",
+        type=int,
+        default=None,
+        help="batch size for 2nd stage of highres fix, default is --batch_size / highres fixの2nd stageのバッチサイズ、省略時は--batch_size",
+    )
     parser.add_argument(
         "--highres_fix_save_1st",
         action="store_true",
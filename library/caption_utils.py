@@ -0,0 +1,176 @@
+# common image pipeline for the captioning scripts (finetune/make_captions.py, finetune/make_captions_by_git.py)
+# images are preprocessed in DataLoader workers, optionally cached as preprocessed tensors, and captioned in full batches.
+# captioned images are recorded in a journal so that an interrupted run can be resumed.
+
+import contextlib
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+from library.utils import ProgressJournal, setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def get_image_size(image_path) -> tuple:
+    # only the header is read
+    try:
+        with Image.open(image_path) as image:
+            return image.size
+    except Exception:
+        return (0, 0)
+
+
+def sort_images_by_size(image_paths: List, num_workers: Optional[int] = None) -> List:
+    r"""
+    Sorts the images by size (width, height), so that images with the same size are decoded and resized together.
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        sizes = list(executor.map(get_image_size, image_paths))
+    order = sorted(range(len(image_paths)), key=lambda i: (sizes[i], str(image_paths[i])))
+    return [image_paths[i] for i in order]
+
+
+class PreprocessedTensorCache:
+    r"""
+    Caches the preprocessed tensors of images as .npy files. `key` identifies the preprocessing (model, image size etc.), and
+    a cache file is used only for the same key, image path and modification time.
+    """
+
+    def __init__(self, cache_dir: str, key: str):
+        self.cache_dir = cache_dir
+        self.key = key
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_cache_file(self, image_path) -> str:
+        image_path = os.path.abspath(image_path)
+        stat = os.stat(image_path)
+        digest = hashlib.sha256(f"{image_path}:{stat.st_mtime_ns}:{stat.st_size}:{self.key}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:32] + ".npy")
+
+    def load(self, image_path) -> Optional[torch.Tensor]:
+        cache_file = self.get_cache_file(image_path)
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            return torch.from_numpy(np.load(cache_file))
+        except Exception as e:
+            logger.warning(f"failed to load cache / キャッシュを読み込めません: {cache_file}, error: {e}")
+            return None
+
+    def save(self, image_path, tensor: torch.Tensor):
+        cache_file = self.get_cache_file(image_path)
+        tmp_file = cache_file + f".{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            np.save(f, tensor.numpy())
+        os.replace(tmp_file, cache_file)
+
+
+class CaptionImageDataset(torch.utils.data.Dataset):
+    def __init__(self, image_paths: List, preprocess: Callable, cache: Optional[PreprocessedTensorCache] = None):
+        self.images = image_paths
+        self.preprocess = preprocess  # PIL image -> tensor, must be picklable for the workers
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        img_path = self.images[idx]
+
+        tensor = self.cache.load(img_path) if self.cache is not None else None
+        if tensor is None:
+            try:
+                image = Image.open(img_path).convert("RGB")
+                tensor = self.preprocess(image)
+            except Exception as e:
+                logger.error(f"Could not load image path / 画像を読み込めません: {img_path}, error: {e}")
+                return None
+            if self.cache is not None:
+                self.cache.save(img_path, tensor)
+
+        return (tensor, str(img_path))
+
+
+def collate_fn_remove_corrupted(batch):
+    # the Nones (corrupted images) in the batch are removed
+    return [x for x in batch if x is not None]
+
+
+def get_autocast_context(device: torch.device, mixed_precision: str):
+    if mixed_precision == "fp16":
+        return torch.autocast(device.type, dtype=torch.float16)
+    if mixed_precision == "bf16":
+        return torch.autocast(device.type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def caption_images(
+    image_paths: List,
+    preprocess: Callable,
+    caption_batch: Callable[[torch.Tensor], List[str]],
+    write_caption: Callable[[str, str], None],
+    batch_size: int,
+    num_workers: Optional[int] = None,
+    cache: Optional[PreprocessedTensorCache] = None,
+    journal: Optional[ProgressJournal] = None,
+) -> int:
+    r"""
+    Captions the images in batches of `batch_size` and returns the number of captioned images.
+
+    `preprocess(PIL image)` returns a tensor, `caption_batch(stacked tensors)` returns the captions and
+    `write_caption(image path, caption)` saves a caption. Corrupted images are skipped and the batches are filled with the
+    following images, so all batches except the last one are full.
+    """
+    dataset = CaptionImageDataset(image_paths, preprocess, cache)
+    data = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=num_workers or 0,
+        collate_fn=collate_fn_remove_corrupted,
+        drop_last=False,
+    )
+
+    num_captioned = 0
+    b_paths = []
+    b_tensors = []
+
+    def flush_batch():
+        nonlocal num_captioned
+        captions = caption_batch(torch.stack(b_tensors))
+        for image_path, caption in zip(b_paths, captions):
+            write_caption(image_path, caption)
+            if journal is not None:
+                journal.add(image_path)
+        if journal is not None:
+            journal.flush()
+        num_captioned += len(b_paths)
+        b_paths.clear()
+        b_tensors.clear()
+
+    start_time = time.perf_counter()
+    with tqdm(total=len(image_paths), smoothing=0.0) as pbar:
+        for data_entry in data:
+            for tensor, image_path in data_entry:
+                b_tensors.append(tensor)
+                b_paths.append(image_path)
+                if len(b_paths) >= batch_size:
+                    flush_batch()
+            pbar.update(min(batch_size, pbar.total - pbar.n))  # including the corrupted images
+        if len(b_paths) > 0:
+            flush_batch()
+
+    elapsed = time.perf_counter() - start_time
+    logger.info(f"captioned {num_captioned} images in {elapsed:.1f} sec ({num_captioned / max(elapsed, 1e-9):.2f} captions/sec)")
+    return num_captioned
@@ -0,0 +1,309 @@
+# local generation server for gen_img.py: JSON API over HTTP or Unix socket
+# jobs are queued and the generation loop of gen_img.py takes them one by one, so the models stay loaded
+
+import base64
+import io
+import itertools
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from library.utils import setup_logging, to_pil_image
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationJob:
+    def __init__(self, job_id: int, prompt: str, loras: Tuple[Tuple[str, float], ...], return_images: bool):
+        self.id = job_id
+        self.prompt = prompt
+        self.loras = loras  # ((path, multiplier), ...)
+        self.return_images = return_images
+        self.num_images: Optional[int] = None  # set by the generation loop after expanding the prompt
+        self.images: List[Tuple[int, Any]] = []  # (seed, PIL image or decoded tensor)
+        self.error: Optional[str] = None
+        self.created_time = time.perf_counter()
+        self.started_time: Optional[float] = None
+        self.finished_time: Optional[float] = None
+        self.done = threading.Event()
+
+    def add_image(self, seed: int, image) -> bool:
+        # returns True if the job is completed by this image
+        if self.done.is_set():
+            return False
+        self.images.append((seed, image))
+        if self.num_images is None or len(self.images) < self.num_images:
+            return False
+        self.finished_time = time.perf_counter()
+        self.done.set()
+        return True
+
+    def fail(self, error: str) -> bool:
+        # returns True if the job is not finished yet
+        if self.done.is_set():
+            return False
+        self.error = error
+        self.finished_time = time.perf_counter()
+        self.done.set()
+        return True
+
+
+class ServerMetrics:
+    def __init__(self, batch_size: int, max_samples: int = 1000):
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.batch_size = batch_size
+        self.max_samples = max_samples
+        self.num_jobs = 0
+        self.num_completed = 0
+        self.num_failed = 0
+        self.num_images = 0
+        self.num_batches = 0
+        self.num_batch_items = 0
+        self.lora_swaps = 0
+        self.lora_swap_time = 0.0
+        self.latencies: List[float] = []  # latest job latencies (sec)
+        self.queue_waits: List[float] = []
+
+    def add_job(self):
+        with self.lock:
+            self.num_jobs += 1
+
+    def add_batch(self, num_items: int):
+        with self.lock:
+            self.num_batches += 1
+            self.num_batch_items += num_items
+
+    def add_lora_swap(self, elapsed: float):
+        with self.lock:
+            self.lora_swaps += 1
+            self.lora_swap_time += elapsed
+
+    def finish_job(self, job: GenerationJob):
+        with self.lock:
+            if job.error is not None:
+                self.num_failed += 1
+                return
+            self.num_completed += 1
+            self.num_images += len(job.images)
+            self.latencies = (self.latencies + [job.finished_time - job.created_time])[-self.max_samples :]
+            self.queue_waits = (self.queue_waits + [job.started_time - job.created_time])[-self.max_samples :]
+
+    @staticmethod
+    def percentile(values: List[float], p: float) -> Optional[float]:
+        if len(values) == 0:
+            return None
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    def to_dict(self, queue_size: int) -> Dict[str, Any]:
+        with self.lock:
+            elapsed = time.perf_counter() - self.start_time
+            return {
+                "uptime": elapsed,
+                "queue_size": queue_size,
+                "jobs": self.num_jobs,
+                "completed": self.num_completed,
+                "failed": self.num_failed,
+                "images": self.num_images,
+                "images_per_sec": self.num_images / max(elapsed, 1e-9),
+                "batches": self.num_batches,
+                "batch_fill": self.num_batch_items / (self.num_batches * self.batch_size) if self.num_batches > 0 else None,
+                "lora_swaps": self.lora_swaps,
+                "lora_swap_time_mean": self.lora_swap_time / self.lora_swaps if self.lora_swaps > 0 else None,
+                "latency_mean": sum(self.latencies) / len(self.latencies) if self.latencies else None,
+                "latency_p50": self.percentile(self.latencies, 0.5),
+                "latency_p95": self.percentile(self.latencies, 0.95),
+                "queue_wait_mean": sum(self.queue_waits) / len(self.queue_waits) if self.queue_waits else None,
+            }
+
+
+class GenerationServer:
+    r"""
+    Accepts generation jobs concurrently and hands them to the generation loop through a queue.
+
+    API (JSON):
+        POST /generate  {"prompt": "a cat --w 768 --d 1", "loras": [{"path": "x.safetensors", "multiplier": 1.0}], "return_images": true}
+                        -> {"id": 1, "images": [{"seed": 1, "png_base64": "..."}], "latency": 1.23}
+        GET  /metrics   -> latency/throughput metrics
+        GET  /health    -> {"status": "ok"}
+        POST /shutdown  -> finish queued jobs and stop the server
+
+    The prompt accepts the same options as --from_file.
+    """
+
+    SHUTDOWN = None  # sentinel in the queue
+
+    def __init__(
+        self,
+        batch_size: int,
+        host: str = "127.0.0.1",
+        port: int = 7860,
+        unix_socket: Optional[str] = None,
+        timeout: float = 600,
+    ):
+        self.jobs: "queue.Queue[Optional[GenerationJob]]" = queue.Queue()
+        self.metrics = ServerMetrics(batch_size)
+        self.timeout = timeout
+        self.job_ids = itertools.count(1)
+        self.job_ids_lock = threading.Lock()
+        self.shutting_down = False
+        self.shutdown_received = False  # the generation loop has taken all jobs before shutdown
+        self.num_active_requests = 0
+        self.active_requests_lock = threading.Lock()
+
+        handler = self.create_handler()
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+
+            class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+                daemon_threads = True
+
+            self.httpd = ThreadingUnixHTTPServer(unix_socket, handler)
+            self.address = unix_socket
+        else:
+            self.httpd = ThreadingHTTPServer((host, port), handler)
+            self.httpd.daemon_threads = True
+            self.address = f"http://{host}:{self.httpd.server_address[1]}"
+        self.unix_socket = unix_socket
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"generation server is listening on / 生成サーバーを起動しました: {self.address}")
+
+    def stop(self, wait: float = 10.0):
+        # fail the jobs not taken by the generation loop, and wait for the responses of running requests
+        self.shutting_down = True
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not self.SHUTDOWN and job.fail("server is stopped"):
+                self.finish_job(job)
+
+        deadline = time.perf_counter() + wait
+        while self.num_active_requests > 0 and time.perf_counter() < deadline:
+            time.sleep(0.05)
+
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.unix_socket is not None and os.path.exists(self.unix_socket):
+            os.remove(self.unix_socket)
+
+    def submit(self, prompt: str, loras: Tuple[Tuple[str, float], ...] = (), return_images: bool = True) -> GenerationJob:
+        if self.shutting_down:
+            raise RuntimeError("server is shutting down")
+        with self.job_ids_lock:
+            job = GenerationJob(next(self.job_ids), prompt, loras, return_images)
+        self.metrics.add_job()
+        self.jobs.put(job)
+        return job
+
+    def get_job(self, timeout: Optional[float] = None) -> Optional[GenerationJob]:
+        r"""
+        Called from the generation loop. Returns None if timed out or shutdown is requested (check `shutdown_received`).
+        """
+        try:
+            job = self.jobs.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if job is self.SHUTDOWN:
+            self.shutdown_received = True
+            return None
+        job.started_time = time.perf_counter()
+        return job
+
+    def request_shutdown(self):
+        self.shutting_down = True
+        self.jobs.put(self.SHUTDOWN)
+
+    def finish_job(self, job: GenerationJob):
+        self.metrics.finish_job(job)
+        if job.error is not None:
+            logger.warning(f"job {job.id} failed: {job.error}")
+        else:
+            logger.info(f"job {job.id} done: {len(job.images)} images, {job.finished_time - job.created_time:.2f} sec")
+
+    @staticmethod
+    def job_to_response(job: GenerationJob) -> Dict[str, Any]:
+        images = []
+        for seed, image in job.images:
+            item = {"seed": seed}
+            if job.return_images:
+                buf = io.BytesIO()
+                to_pil_image(image).save(buf, format="PNG")
+                item["png_base64"] = base64.b64encode(buf.getvalue()).decode("ascii")
+            images.append(item)
+        return {"id": job.id, "images": images, "latency": job.finished_time - job.created_time}
+
+    def create_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def send_json(self, status: int, obj: Dict[str, Any]):
+                body = json.dumps(obj).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == "/health":
+                    self.send_json(200, {"status": "ok"})
+                elif self.path == "/metrics":
+                    self.send_json(200, server.metrics.to_dict(server.jobs.qsize()))
+                else:
+                    self.send_json(404, {"error": "not found"})
+
+            def do_POST(self):
+                if self.path == "/shutdown":
+                    server.request_shutdown()
+                    self.send_json(200, {"status": "shutting down"})
+                    return
+                if self.path != "/generate":
+                    self.send_json(404, {"error": "not found"})
+                    return
+
+                with server.active_requests_lock:
+                    server.num_active_requests += 1
+                try:
+                    self.generate()
+                finally:
+                    with server.active_requests_lock:
+                        server.num_active_requests -= 1
+
+            def generate(self):
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    request = json.loads(self.rfile.read(length).decode("utf-8"))
+                    prompt = request["prompt"]
+                    loras = tuple((lora["path"], float(lora.get("multiplier", 1.0))) for lora in request.get("loras", []))
+                    job = server.submit(prompt, loras, bool(request.get("return_images", True)))
+                except Exception as e:
+                    self.send_json(400, {"error": str(e)})
+                    return
+
+                if not job.done.wait(server.timeout):
+                    self.send_json(504, {"id": job.id, "error": "timeout"})
+                elif job.error is not None:
+                    self.send_json(500, {"id": job.id, "error": job.error})
+                else:
+                    self.send_json(200, server.job_to_response(job))
+
+        return Handler
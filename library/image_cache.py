@@ -0,0 +1,138 @@
+# cache of decoded images resized to the bucket size, used when latents cannot be cached (color_aug, random_crop)
+# images are stored as uncompressed .npy files of uint8 and loaded with memory mapping, so only the cropped area is read and
+# the pages are shared among the DataLoader workers by the OS. the total size is bounded and the least recently used images
+# are evicted.
+
+import hashlib
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE_SUFFIX = ".npy"
+
+
+class DecodedImageCache:
+    r"""
+    Caches the images decoded and resized to `resized_size` of their buckets. An entry is identified by the image path,
+    the modification time and size of the image file, the original size, the resized size and the number of channels.
+
+    `max_size` is the upper limit of the total size of the cache files in bytes. The DataLoader workers share the cache
+    directory, so the limit is approximate: each process checks the directory again when its own estimate exceeds the limit
+    or after `rescan_interval` writes. The access time is recorded as the modification time of the cache file.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int, rescan_interval: int = 256):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.rescan_interval = rescan_interval
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.total_size = self.get_total_size()
+        self.num_writes_since_scan = 0
+
+    def list_cache_files(self):
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(CACHE_FILE_SUFFIX) and entry.is_file():
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue  # removed by another process
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def get_total_size(self) -> int:
+        return sum([size for _, size, _ in self.list_cache_files()])
+
+    def get_cache_file(
+        self, image_path: str, original_size: Tuple[int, int], resized_size: Tuple[int, int], num_channels: int
+    ) -> str:
+        image_path = os.path.abspath(image_path)
+        stat = os.stat(image_path)
+        key = f"{image_path}:{stat.st_mtime_ns}:{stat.st_size}:{original_size[0]}x{original_size[1]}"
+        key += f":{resized_size[0]}x{resized_size[1]}:{num_channels}"
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:32] + CACHE_FILE_SUFFIX)
+
+    def load(
+        self, image_path: str, original_size: Tuple[int, int], resized_size: Tuple[int, int], num_channels: int
+    ) -> Optional[np.ndarray]:
+        r"""
+        Returns the cached image as a read-only memory-mapped array of shape (H, W, C), or None if it is not cached.
+        `original_size` is (width, height) of the image file before resizing.
+        """
+        cache_file = self.get_cache_file(image_path, original_size, resized_size, num_channels)
+        try:
+            image = np.load(cache_file, mmap_mode="r")
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"failed to load cache / キャッシュを読み込めません: {cache_file}, error: {e}")
+            return None
+
+        if image.dtype != np.uint8 or image.shape != (resized_size[1], resized_size[0], num_channels):
+            logger.warning(f"unexpected cache / キャッシュの形式が異なります: {cache_file}, shape: {image.shape}")
+            return None
+
+        # LRUのためにアクセス時刻を更新する
+        try:
+            os.utime(cache_file)
+        except OSError:
+            pass
+        return image
+
+    def save(self, image_path: str, original_size: Tuple[int, int], image: np.ndarray):
+        height, width, num_channels = image.shape
+        cache_file = self.get_cache_file(image_path, original_size, (width, height), num_channels)
+        if image.nbytes > self.max_size:
+            return
+
+        tmp_file = cache_file + f".{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            np.save(f, np.ascontiguousarray(image, dtype=np.uint8))
+        size = os.path.getsize(tmp_file)
+        os.replace(tmp_file, cache_file)
+
+        self.total_size += size
+        self.num_writes_since_scan += 1
+        if self.total_size > self.max_size or self.num_writes_since_scan >= self.rescan_interval:
+            self.evict()
+
+    def evict(self):
+        r"""
+        Removes the least recently used cache files until the total size is 90% of `max_size` or less.
+        """
+        entries = self.list_cache_files()
+        total_size = sum([size for _, size, _ in entries])
+        self.num_writes_since_scan = 0
+        if total_size <= self.max_size:
+            self.total_size = total_size
+            return
+
+        target_size = int(self.max_size * 0.9)
+        entries.sort()
+        num_removed = 0
+        for _, size, path in entries:
+            if total_size <= target_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # removed by another process
+            except OSError:
+                continue  # memory mapped on Windows
+            total_size -= size
+            num_removed += 1
+
+        self.total_size = total_size
+        logger.debug(f"evicted {num_removed} images from the image cache, total size: {total_size / 1024**3:.2f} GB")
+
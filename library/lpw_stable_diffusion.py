@@ -2,7 +2,6 @@
 # and modify to support SD2.x
 
 import inspect
-import re
 from typing import Callable, List, Optional, Union
 
 import numpy as np
@@ -17,6 +16,9 @@ from diffusers.models import AutoencoderKL, UNet2DConditionModel
 from diffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput, StableDiffusionSafetyChecker
 from diffusers.utils import logging
 
+from library import prompt_attention
+from library.utils import TextEmbeddingCache, encode_text_with_cache
+
 try:
     from diffusers.utils import PIL_INTERPOLATION
 except ImportError:
@@ -40,110 +42,8 @@ except ImportError:
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
-re_attention = re.compile(
-    r"""
-\\\(|
-\\\)|
-\\\[|
-\\]|
-\\\\|
-\\|
-\(|
-\[|
-:([+-]?[.\d]+)\)|
-\)|
-]|
-[^\\()\[\]:]+|
-:
-""",
-    re.X,
-)
-
-
 def parse_prompt_attention(text):
-    """
-    Parses a string with attention tokens and returns a list of pairs: text and its associated weight.
-    Accepted tokens are:
-      (abc) - increases attention to abc by a multiplier of 1.1
-      (abc:3.12) - increases attention to abc by a multiplier of 3.12
-      [abc] - decreases attention to abc by a multiplier of 1.1
-      \( - literal character '('
-      \[ - literal character '['
-      \) - literal character ')'
-      \] - literal character ']'
-      \\ - literal character '\'
-      anything else - just text
-    >>> parse_prompt_attention('normal text')
-    [['normal text', 1.0]]
-    >>> parse_prompt_attention('an (important) word')
-    [['an ', 1.0], ['important', 1.1], [' word', 1.0]]
-    >>> parse_prompt_attention('(unbalanced')
-    [['unbalanced', 1.1]]
-    >>> parse_prompt_attention('\(literal\]')
-    [['(literal]', 1.0]]
-    >>> parse_prompt_attention('(unnecessary)(parens)')
-    [['unnecessaryparens', 1.1]]
-    >>> parse_prompt_attention('a (((house:1.3)) [on] a (hill:0.5), sun, (((sky))).')
-    [['a ', 1.0],
-     ['house', 1.5730000000000004],
-     [' ', 1.1],
-     ['on', 1.0],
-     [' a ', 1.1],
-     ['hill', 0.55],
-     [', sun, ', 1.1],
-     ['sky', 1.4641000000000006],
-     ['.', 1.1]]
-    """
-
-    res = []
-    round_brackets = []
-    square_brackets = []
-
-    round_bracket_multiplier = 1.1
-    square_bracket_multiplier = 1 / 1.1
-
-    def multiply_range(start_position, multiplier):
-        for p in range(start_position, len(res)):
-            res[p][1] *= multiplier
-
-    for m in re_attention.finditer(text):
-        text = m.group(0)
-        weight = m.group(1)
-
-        if text.startswith("\\"):
-            res.append([text[1:], 1.0])
-        elif text == "(":
-            round_brackets.append(len(res))
-        elif text == "[":
-            square_brackets.append(len(res))
-        elif weight is not None and len(round_brackets) > 0:
-            multiply_range(round_brackets.pop(), float(weight))
-        elif text == ")" and len(round_brackets) > 0:
-            multiply_range(round_brackets.pop(), round_bracket_multiplier)
-        elif text == "]" and len(square_brackets) > 0:
-            multiply_range(square_brackets.pop(), square_bracket_multiplier)
-        else:
-            res.append([text, 1.0])
-
-    for pos in round_brackets:
-        multiply_range(pos, round_bracket_multiplier)
-
-    for pos in square_brackets:
-        multiply_range(pos, square_bracket_multiplier)
-
-    if len(res) == 0:
-        res = [["", 1.0]]
-
-    # merge runs of identical weights
-    i = 0
-    while i + 1 < len(res):
-        if res[i][1] == res[i + 1][1]:
-            res[i][0] += res[i + 1][0]
-            res.pop(i + 1)
-        else:
-            i += 1
-
-    return res
+    return prompt_attention.parse_prompt_attention(text)
 
 
 def get_prompts_with_weights(pipe: StableDiffusionPipeline, prompt: List[str], max_length: int):
@@ -152,33 +52,7 @@ def get_prompts_with_weights(pipe: StableDiffusionPipeline, prompt: List[str], m
 
     No padding, starting or ending token is included.
     """
-    tokens = []
-    weights = []
-    truncated = False
-    for text in prompt:
-        texts_and_weights = parse_prompt_attention(text)
-        text_token = []
-        text_weight = []
-        for word, weight in texts_and_weights:
-            # tokenize and discard the starting and the ending token
-            token = pipe.tokenizer(word).input_ids[1:-1]
-            text_token += token
-            # copy the weight by length of token
-            text_weight += [weight] * len(token)
-            # stop if the text is too long (longer than truncation limit)
-            if len(text_token) > max_length:
-                truncated = True
-                break
-        # truncate
-        if len(text_token) > max_length:
-            truncated = True
-            text_token = text_token[:max_length]
-            text_weight = text_weight[:max_length]
-        tokens.append(text_token)
-        weights.append(text_weight)
-    if truncated:
-        logger.warning("Prompt was truncated. Try to shorten the prompt or increase max_embeddings_multiples")
-    return tokens, weights
+    return prompt_attention.get_prompts_with_weights(pipe.tokenizer, prompt, max_length)
 
 
 def pad_tokens_and_weights(tokens, weights, max_length, bos, eos, no_boseos_middle=True, chunk_length=77):
@@ -361,26 +235,20 @@ def get_weighted_text_embeddings(
         )
         uncond_tokens = torch.tensor(uncond_tokens, dtype=torch.long, device=pipe.device)
 
-    # get the embeddings
-    text_embeddings = get_unweighted_text_embeddings(
-        pipe,
-        prompt_tokens,
-        pipe.tokenizer.model_max_length,
-        clip_skip,
-        eos,
-        pad,
-        no_boseos_middle=no_boseos_middle,
+    # get the embeddings. outputs of the same tokens are reused if the cache is set to the pipeline
+    def encode(text_input):
+        return get_unweighted_text_embeddings(
+            pipe, text_input, pipe.tokenizer.model_max_length, clip_skip, eos, pad, no_boseos_middle=no_boseos_middle
+        )
+
+    text_embedding_cache = getattr(pipe, "text_embedding_cache", None)
+    text_embeddings = encode_text_with_cache(
+        text_embedding_cache, pipe.text_encoder, prompt_tokens, encode, clip_skip, no_boseos_middle
     )
     prompt_weights = torch.tensor(prompt_weights, dtype=text_embeddings.dtype, device=pipe.device)
     if uncond_prompt is not None:
-        uncond_embeddings = get_unweighted_text_embeddings(
-            pipe,
-            uncond_tokens,
-            pipe.tokenizer.model_max_length,
-            clip_skip,
-            eos,
-            pad,
-            no_boseos_middle=no_boseos_middle,
+        uncond_embeddings = encode_text_with_cache(
+            text_embedding_cache, pipe.text_encoder, uncond_tokens, encode, clip_skip, no_boseos_middle
         )
         uncond_weights = torch.tensor(uncond_weights, dtype=uncond_embeddings.dtype, device=pipe.device)
 
@@ -534,6 +402,7 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
             image_encoder=image_encoder,
         )
         self.custom_clip_skip = clip_skip
+        self.text_embedding_cache: Optional[TextEmbeddingCache] = None  # set to reuse outputs of the text encoder
         self.__init__additional__()
 
     def __init__additional__(self):
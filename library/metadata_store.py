@@ -0,0 +1,229 @@
+# metadata store for fine tuning: JSON Lines (.jsonl) in addition to JSON (.json)
+# each line of .jsonl is {"image_key": key, ...entry}. entries are read and written one by one, and unchanged lines are copied
+# without parsing, so that large metadata can be updated with small memory. .json is still supported for compatibility.
+# `python -m library.metadata_store in_file out_file` converts between .json and .jsonl.
+
+import argparse
+import json
+import os
+from collections import deque
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+KEY_FIELD = "image_key"
+LINE_PREFIX = '{"image_key": '
+_decoder = json.JSONDecoder()
+
+
+def is_jsonl(file_name: str) -> bool:
+    return os.path.splitext(file_name)[1].lower() == ".jsonl"
+
+
+def entry_to_line(image_key: str, entry: Dict[str, Any]) -> str:
+    return json.dumps({KEY_FIELD: image_key, **entry}, ensure_ascii=False) + "\n"
+
+
+def line_to_entry(line: str) -> Tuple[str, Dict[str, Any]]:
+    entry = json.loads(line)
+    return entry.pop(KEY_FIELD), entry
+
+
+def iterate_lines(file_name: str) -> Iterator[Tuple[str, str]]:
+    # yields (image key, line) of .jsonl. the key is decoded without parsing the whole line if the line starts with the key
+    with open(file_name, "rt", encoding="utf-8") as f:
+        for line in f:
+            if len(line.strip()) == 0:
+                continue
+            if not line.endswith("\n"):
+                line += "\n"
+            if line.startswith(LINE_PREFIX):
+                image_key = _decoder.raw_decode(line, len(LINE_PREFIX))[0]
+            else:
+                image_key = line_to_entry(line)[0]
+            yield image_key, line
+
+
+def iterate_metadata(file_name: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    # .json is loaded at once
+    if is_jsonl(file_name):
+        for _, line in iterate_lines(file_name):
+            yield line_to_entry(line)
+    else:
+        with open(file_name, "rt", encoding="utf-8") as f:
+            metadata = json.load(f)
+        yield from metadata.items()
+
+
+def load_metadata(file_name: str) -> Dict[str, Dict[str, Any]]:
+    return dict(iterate_metadata(file_name))
+
+
+class MetadataWriter:
+    r"""
+    Writes entries one by one to .jsonl or .json. The .json output is the same as `json.dump(metadata, f, indent=2)`.
+    The entries are written to a temporary file which is renamed on close, so the output file can be the input file.
+    """
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.jsonl = is_jsonl(file_name)
+        self.tmp_file_name = file_name + ".tmp"
+        self.file = open(self.tmp_file_name, "wt", encoding="utf-8")
+        self.num_entries = 0
+        if not self.jsonl:
+            self.file.write("{")
+
+    def write(self, image_key: str, entry: Dict[str, Any]):
+        if self.jsonl:
+            self.file.write(entry_to_line(image_key, entry))
+        else:
+            value = json.dumps(entry, indent=2).replace("\n", "\n  ")
+            self.file.write(("," if self.num_entries > 0 else "") + "\n  " + json.dumps(image_key) + ": " + value)
+        self.num_entries += 1
+
+    def write_line(self, line: str):
+        # a line of .jsonl as is
+        assert self.jsonl
+        self.file.write(line)
+        self.num_entries += 1
+
+    def close(self):
+        if not self.jsonl:
+            self.file.write("\n}" if self.num_entries > 0 else "}")
+        self.file.close()
+        os.replace(self.tmp_file_name, self.file_name)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_file_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def _transform_chunk(transform, items):
+    # runs in worker processes: parses the lines and returns the new entries, or None if not changed
+    results = []
+    for image_key, line, entry in items:
+        if entry is None:
+            entry = line_to_entry(line)[1]
+        results.append(transform(image_key, entry))
+    return results
+
+
+def update_metadata(
+    in_file: Optional[str],
+    out_file: str,
+    updates: Optional[Dict[str, Dict[str, Any]]] = None,
+    transform: Optional[Callable[[str, Dict[str, Any]], Optional[Dict[str, Any]]]] = None,
+    num_workers: Optional[int] = None,
+    chunk_size: int = 1000,
+) -> Tuple[int, int]:
+    r"""
+    Streams the entries of `in_file` (None for no input) to `out_file`, and returns (number of entries, changed entries).
+
+    `updates` (image key -> fields) are merged into the entries, and the new keys are appended in the order of `updates`.
+    `transform(image_key, entry)` returns a new entry or None if unchanged. With `num_workers`, it runs in worker processes
+    for each chunk of entries, so it must be a top level function. Unchanged lines are copied as is from .jsonl to .jsonl.
+    """
+    updates = updates or {}
+    copy_lines = in_file is not None and is_jsonl(in_file) and is_jsonl(out_file)
+
+    def chunks():
+        if in_file is None:
+            return
+        if is_jsonl(in_file):
+            items = ((image_key, line, None) for image_key, line in iterate_lines(in_file))
+        else:
+            items = ((image_key, None, entry) for image_key, entry in iterate_metadata(in_file))
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def transformed_chunks():
+        if transform is None:
+            for chunk in chunks():
+                yield chunk, [None] * len(chunk)
+        elif not num_workers:
+            for chunk in chunks():
+                yield chunk, _transform_chunk(transform, chunk)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+
+            # keep the order of the entries, with a limited number of chunks in flight
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                futures = deque()
+                for chunk in chunks():
+                    futures.append((chunk, executor.submit(_transform_chunk, transform, chunk)))
+                    if len(futures) >= num_workers * 2:
+                        chunk, future = futures.popleft()
+                        yield chunk, future.result()
+                while len(futures) > 0:
+                    chunk, future = futures.popleft()
+                    yield chunk, future.result()
+
+    num_changed = 0
+    updated_keys = set()
+    with MetadataWriter(out_file) as writer:
+        for chunk, results in transformed_chunks():
+            for (image_key, line, entry), result in zip(chunk, results):
+                if image_key in updates:
+                    updated_keys.add(image_key)
+                if result is None and image_key not in updates:
+                    if copy_lines:
+                        writer.write_line(line)
+                    else:
+                        writer.write(image_key, entry if entry is not None else line_to_entry(line)[1])
+                    continue
+
+                if result is None:
+                    result = entry if entry is not None else line_to_entry(line)[1]
+                if image_key in updates:
+                    result = {**result, **updates[image_key]}
+                writer.write(image_key, result)
+                num_changed += 1
+
+        for image_key, fields in updates.items():
+            if image_key not in updated_keys:
+                writer.write(image_key, dict(fields))
+                num_changed += 1
+
+    return writer.num_entries, num_changed
+
+
+def main(args):
+    logger.info(f"converting metadata: {args.in_file} -> {args.out_file}")
+    num_entries, _ = update_metadata(args.in_file, args.out_file)
+    logger.info(f"done! {num_entries} entries")
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("in_file", type=str, help="metadata file to input, .json or .jsonl / 読み込むメタデータファイル")
+    parser.add_argument("out_file", type=str, help="metadata file to output, .json or .jsonl / メタデータファイル書き出し先")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,394 @@
+# prompt attention parser and tokenizer shared by generation scripts, lpw pipelines and --weighted_captions training
+# parsed prompts and tokenized fragments are memoized, because the same prompts and captions are used repeatedly.
+# run `python -m library.prompt_attention` for a microbenchmark against the previous implementation.
+
+import argparse
+import functools
+import random
+import re
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+re_attention = re.compile(
+    r"""
+\\\(|
+\\\)|
+\\\[|
+\\]|
+\\\\|
+\\|
+\(|
+\[|
+:([+-]?[.\d]+)\)|
+\)|
+]|
+[^\\()\[\]:]+|
+:
+""",
+    re.X,
+)
+
+ROUND_BRACKET_MULTIPLIER = 1.1
+SQUARE_BRACKET_MULTIPLIER = 1 / 1.1
+
+PARSE_CACHE_SIZE = 4096
+TOKEN_CACHE_SIZE = 65536
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_prompt_attention(text: str, keep_break: bool) -> Tuple[Tuple[str, float], ...]:
+    # single pass: each fragment records the brackets open at that time, and the weights are calculated at the end.
+    # the multipliers are applied in the same order as the original implementation (closed order, then unclosed round and
+    # square brackets), so that the weights are exactly the same
+    if keep_break:
+        text = text.replace("BREAK", "\\BREAK\\")  # keep break as separate token
+
+    fragments = []  # (text, indices of open brackets)
+    multipliers = []  # multiplier of each bracket
+    orders = []  # order of applying the multiplier of each bracket
+    round_brackets = []
+    square_brackets = []
+
+    def close(bracket, multiplier):
+        multipliers[bracket] = multiplier
+        orders[bracket] = close.count
+        close.count += 1
+
+    close.count = 0
+
+    for m in re_attention.finditer(text):
+        token = m.group(0)
+        weight = m.group(1)
+
+        if token.startswith("\\"):
+            fragments.append((token[1:], tuple(round_brackets + square_brackets)))
+        elif token == "(" or token == "[":
+            (round_brackets if token == "(" else square_brackets).append(len(multipliers))
+            multipliers.append(1.0)
+            orders.append(None)
+        elif weight is not None and len(round_brackets) > 0:
+            close(round_brackets.pop(), float(weight))
+        elif token == ")" and len(round_brackets) > 0:
+            close(round_brackets.pop(), ROUND_BRACKET_MULTIPLIER)
+        elif token == "]" and len(square_brackets) > 0:
+            close(square_brackets.pop(), SQUARE_BRACKET_MULTIPLIER)
+        else:
+            fragments.append((token, tuple(round_brackets + square_brackets)))
+
+    for bracket in round_brackets:
+        close(bracket, ROUND_BRACKET_MULTIPLIER)
+    for bracket in square_brackets:
+        close(bracket, SQUARE_BRACKET_MULTIPLIER)
+
+    res = []
+    for fragment, brackets in fragments:
+        weight = 1.0
+        for bracket in sorted(brackets, key=orders.__getitem__):
+            weight *= multipliers[bracket]
+        res.append([fragment, weight])
+
+    if len(res) == 0:
+        res = [["", 1.0]]
+
+    # merge runs of identical weights
+    i = 0
+    while i + 1 < len(res):
+        if res[i][1] == res[i + 1][1] and (not keep_break or (res[i][0].strip() != "BREAK" and res[i + 1][0].strip() != "BREAK")):
+            res[i][0] += res[i + 1][0]
+            res.pop(i + 1)
+        else:
+            i += 1
+
+    return tuple((fragment, weight) for fragment, weight in res)
+
+
+def parse_prompt_attention(text: str, keep_break: bool = False) -> List[list]:
+    r"""
+    Parses a string with attention tokens and returns a list of pairs: text and its associated weight.
+    Accepted tokens are:
+      (abc) - increases attention to abc by a multiplier of 1.1
+      (abc:3.12) - increases attention to abc by a multiplier of 3.12
+      [abc] - decreases attention to abc by a multiplier of 1.1
+      \( - literal character '('
+      \[ - literal character '['
+      \) - literal character ')'
+      \] - literal character ']'
+      \\ - literal character '\'
+      anything else - just text
+    If `keep_break` is True, "BREAK" is returned as a separate item.
+    >>> parse_prompt_attention('normal text')
+    [['normal text', 1.0]]
+    >>> parse_prompt_attention('an (important) word')
+    [['an ', 1.0], ['important', 1.1], [' word', 1.0]]
+    >>> parse_prompt_attention('(unbalanced')
+    [['unbalanced', 1.1]]
+    >>> parse_prompt_attention('\(literal\]')
+    [['(literal]', 1.0]]
+    >>> parse_prompt_attention('(unnecessary)(parens)')
+    [['unnecessaryparens', 1.1]]
+    >>> parse_prompt_attention('a (((house:1.3)) [on] a (hill:0.5), sun, (((sky))).')
+    [['a ', 1.0],
+     ['house', 1.5730000000000004],
+     [' ', 1.1],
+     ['on', 1.0],
+     [' a ', 1.1],
+     ['hill', 0.55],
+     [', sun, ', 1.1],
+     ['sky', 1.4641000000000006],
+     ['.', 1.1]]
+    """
+    return [[fragment, weight] for fragment, weight in _parse_prompt_attention(text, keep_break)]
+
+
+# tokenizer id -> (tokenizer, fragment -> tokens). the tokenizer is kept to avoid reuse of the id
+_token_caches: Dict[int, Tuple[object, "OrderedDict[str, List[int]]"]] = {}
+
+
+def tokenize_fragments(tokenizer, fragments: Iterable[str]) -> Dict[str, List[int]]:
+    r"""
+    Tokenizes the fragments without the starting and the ending token. Fragments not in the cache are tokenized in one call.
+    """
+    if id(tokenizer) not in _token_caches:
+        _token_caches[id(tokenizer)] = (tokenizer, OrderedDict())
+    cache = _token_caches[id(tokenizer)][1]
+
+    fragments = list(dict.fromkeys(fragments))  # unique, keep order
+    missing = [fragment for fragment in fragments if fragment not in cache]
+    if len(missing) > 0:
+        for fragment, input_ids in zip(missing, tokenizer(missing).input_ids):
+            cache[fragment] = input_ids[1:-1]
+
+    result = {}
+    for fragment in fragments:
+        cache.move_to_end(fragment)
+        result[fragment] = cache[fragment]
+    while len(cache) > TOKEN_CACHE_SIZE:
+        cache.popitem(last=False)
+    return result
+
+
+def clear_caches():
+    _parse_prompt_attention.cache_clear()
+    _token_caches.clear()
+
+
+def get_prompts_with_weights(
+    tokenizer,
+    prompt: List[str],
+    max_length: int,
+    token_replacer: Optional[Callable[[List[int]], List[int]]] = None,
+    keep_break: bool = False,
+):
+    r"""
+    Tokenize a list of prompts and return its tokens with weights of each token.
+    No padding, starting or ending token is included.
+
+    `token_replacer` replaces the tokens of each fragment, e.g. for Textual Inversion. With `keep_break`, "BREAK" pads the
+    tokens until the next multiple of the tokenizer's max length.
+    """
+    parsed = [_parse_prompt_attention(text, keep_break) for text in prompt]
+    is_break = lambda word: keep_break and word.strip() == "BREAK"
+    fragment_tokens = tokenize_fragments(tokenizer, (word for p in parsed for word, _ in p if not is_break(word)))
+
+    tokens = []
+    weights = []
+    truncated = False
+    for texts_and_weights in parsed:
+        text_token = []
+        text_weight = []
+        for word, weight in texts_and_weights:
+            if is_break(word):
+                # pad until next multiple of tokenizer's max token length
+                pad_len = tokenizer.model_max_length - (len(text_token) % tokenizer.model_max_length)
+                logger.info(f"BREAK pad_len: {pad_len}")
+                text_token += [tokenizer.pad_token_id] * pad_len
+                text_weight += [1.0] * pad_len
+                continue
+
+            token = fragment_tokens[word]
+            if token_replacer is not None:
+                token = token_replacer(list(token))  # for Textual Inversion
+
+            text_token += token
+            # copy the weight by length of token
+            text_weight += [weight] * len(token)
+            # stop if the text is too long (longer than truncation limit)
+            if len(text_token) > max_length:
+                truncated = True
+                break
+        # truncate
+        if len(text_token) > max_length:
+            truncated = True
+            text_token = text_token[:max_length]
+            text_weight = text_weight[:max_length]
+        tokens.append(text_token)
+        weights.append(text_weight)
+    if truncated:
+        logger.warning("Prompt was truncated. Try to shorten the prompt or increase max_embeddings_multiples")
+    return tokens, weights
+
+
+# region benchmark
+
+
+def parse_prompt_attention_reference(text: str, keep_break: bool = False) -> List[list]:
+    # previous implementation, for the benchmark and the check of the results
+    res = []
+    round_brackets = []
+    square_brackets = []
+
+    def multiply_range(start_position, multiplier):
+        for p in range(start_position, len(res)):
+            res[p][1] *= multiplier
+
+    if keep_break:
+        text = text.replace("BREAK", "\\BREAK\\")
+
+    for m in re_attention.finditer(text):
+        text = m.group(0)
+        weight = m.group(1)
+
+        if text.startswith("\\"):
+            res.append([text[1:], 1.0])
+        elif text == "(":
+            round_brackets.append(len(res))
+        elif text == "[":
+            square_brackets.append(len(res))
+        elif weight is not None and len(round_brackets) > 0:
+            multiply_range(round_brackets.pop(), float(weight))
+        elif text == ")" and len(round_brackets) > 0:
+            multiply_range(round_brackets.pop(), ROUND_BRACKET_MULTIPLIER)
+        elif text == "]" and len(square_brackets) > 0:
+            multiply_range(square_brackets.pop(), SQUARE_BRACKET_MULTIPLIER)
+        else:
+            res.append([text, 1.0])
+
+    for pos in round_brackets:
+        multiply_range(pos, ROUND_BRACKET_MULTIPLIER)
+    for pos in square_brackets:
+        multiply_range(pos, SQUARE_BRACKET_MULTIPLIER)
+
+    if len(res) == 0:
+        res = [["", 1.0]]
+
+    i = 0
+    while i + 1 < len(res):
+        if res[i][1] == res[i + 1][1] and (not keep_break or (res[i][0].strip() != "BREAK" and res[i + 1][0].strip() != "BREAK")):
+            res[i][0] += res[i + 1][0]
+            res.pop(i + 1)
+        else:
+            i += 1
+    return res
+
+
+def make_random_prompts(num_prompts: int, num_unique: int, seed: int) -> List[str]:
+    # captions like "1girl, (solo:1.2), [[blurry]], \(text\), BREAK ..."
+    rng = random.Random(seed)
+    words = ["1girl", "solo", "long hair", "smile", "looking at viewer", "outdoors", "sky", "cloud", "tree", "dress"]
+    words += ["masterpiece", "best quality", "blurry", "simple background", "\\(text\\)", "BREAK", "night", "city lights"]
+
+    def make_prompt():
+        parts = []
+        for _ in range(rng.randint(5, 30)):
+            word = rng.choice(words)
+            r = rng.random()
+            if r < 0.2:
+                word = f"({word}:{rng.uniform(0.5, 1.5):.2f})"
+            elif r < 0.3:
+                word = "(" * rng.randint(1, 3) + word + ")" * rng.randint(0, 3)
+            elif r < 0.4:
+                word = "[" * rng.randint(1, 2) + word + "]" * rng.randint(1, 2)
+            parts.append(word)
+        return ", ".join(parts)
+
+    unique = [make_prompt() for _ in range(num_unique)]
+    return [rng.choice(unique) for _ in range(num_prompts)]
+
+
+def benchmark(name: str, fn: Callable[[], None], repeat: int) -> float:
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = (time.perf_counter() - start_time) / repeat
+    logger.info(f"{name}: {elapsed * 1000:.2f} ms")
+    return elapsed
+
+
+def main(args):
+    if args.prompt_file is not None:
+        with open(args.prompt_file, "r", encoding="utf-8") as f:
+            prompts = [line.strip() for line in f if line.strip()]
+    else:
+        prompts = make_random_prompts(args.num_prompts, args.num_unique, args.seed)
+    logger.info(f"{len(prompts)} prompts, {len(set(prompts))} unique")
+
+    # check the results
+    for keep_break in [False, True]:
+        for prompt in set(prompts):
+            expected = parse_prompt_attention_reference(prompt, keep_break)
+            assert parse_prompt_attention(prompt, keep_break) == expected, f"mismatch: {prompt}"
+    logger.info("results are same as the previous implementation")
+
+    def parse_new():
+        _parse_prompt_attention.cache_clear()
+        for prompt in prompts:
+            parse_prompt_attention(prompt, True)
+
+    benchmark("parse (previous)", lambda: [parse_prompt_attention_reference(p, True) for p in prompts], args.repeat)
+    benchmark("parse (single pass, no cache)", parse_new, args.repeat)
+    benchmark("parse (memoized)", lambda: [parse_prompt_attention(p, True) for p in prompts], args.repeat)
+
+    if args.tokenizer is None:
+        return
+
+    from transformers import CLIPTokenizer
+
+    tokenizer = CLIPTokenizer.from_pretrained(args.tokenizer)
+    max_length = tokenizer.model_max_length * args.max_embeddings_multiples - 2
+
+    def tokenize_previous():
+        for prompt in prompts:
+            for word, _ in parse_prompt_attention_reference(prompt, False):
+                tokenizer(word).input_ids[1:-1]
+
+    def tokenize_new():
+        clear_caches()
+        get_prompts_with_weights(tokenizer, prompts, max_length)
+
+    benchmark("tokenize per fragment (previous)", tokenize_previous, args.repeat)
+    benchmark("tokenize batched (no cache)", tokenize_new, args.repeat)
+    benchmark("tokenize batched (memoized)", lambda: get_prompts_with_weights(tokenizer, prompts, max_length), args.repeat)
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompt_file", type=str, default=None, help="prompts for benchmark, random if omitted / ベンチマーク用のプロンプト")
+    parser.add_argument("--num_prompts", type=int, default=1000, help="number of random prompts / ランダムなプロンプトの数")
+    parser.add_argument("--num_unique", type=int, default=100, help="number of unique random prompts / ユニークなプロンプトの数")
+    parser.add_argument("--seed", type=int, default=42, help="random seed / 乱数シード")
+    parser.add_argument("--repeat", type=int, default=5, help="number of repeats / 繰り返し回数")
+    parser.add_argument(
+        "--tokenizer",
+        type=str,
+        default=None,
+        help="tokenizer for benchmark of tokenization, e.g. openai/clip-vit-large-patch14 / トークナイズのベンチマーク用のトークナイザ",
+    )
+    parser.add_argument("--max_embeddings_multiples", type=int, default=3, help="max embeddings multiples / トークン長の倍数")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+
+    args = parser.parse_args()
+    main(args)
+
+# endregion
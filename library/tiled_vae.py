@@ -0,0 +1,222 @@
+# tiled VAE encode/decode with overlap blending for large images
+# each tile is encoded/decoded separately and the overlapping areas are blended linearly, so the peak memory depends on
+# the tile size instead of the image size. it works with diffusers' AutoencoderKL and SlicingAutoencoderKL.
+
+import argparse
+import time
+from types import SimpleNamespace
+from typing import Callable, List, Optional
+
+import torch
+from diffusers.models.vae import DiagonalGaussianDistribution
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def get_tile_starts(size: int, tile_size: int, overlap: int) -> List[int]:
+    if size <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, size - tile_size, stride))
+    starts.append(size - tile_size)
+    return starts
+
+
+def get_blend_weight(height: int, width: int, overlap: int, top: bool, bottom: bool, left: bool, right: bool, device):
+    # linear ramp in the overlapping area, except the edges of the image
+    def ramp(size, start, end):
+        w = torch.ones(size, device=device)
+        if overlap > 0:
+            r = torch.arange(1, overlap + 1, device=device, dtype=torch.float32) / (overlap + 1)
+            if start:
+                w[:overlap] = r
+            if end:
+                w[-overlap:] = r.flip(0)
+        return w
+
+    return ramp(height, top, bottom)[:, None] * ramp(width, left, right)[None, :]
+
+
+def tiled_apply(
+    x: torch.Tensor, fn: Callable[[torch.Tensor], torch.Tensor], tile_size: int, overlap: int, scale: float, out_channels: int
+) -> torch.Tensor:
+    r"""
+    Applies `fn` to overlapping tiles of `x` (B,C,H,W) and blends the outputs. The output size is `scale` times of the input.
+    """
+    b, _, h, w = x.shape
+    out_h, out_w = int(h * scale), int(w * scale)
+    out_overlap = int(overlap * scale)
+    output = None
+    weight_sum = torch.zeros((out_h, out_w), device=x.device, dtype=torch.float32)
+
+    ys = get_tile_starts(h, tile_size, overlap)
+    xs = get_tile_starts(w, tile_size, overlap)
+    for y in ys:
+        for x0 in xs:
+            tile = x[:, :, y : y + tile_size, x0 : x0 + tile_size]
+            out_tile = fn(tile).float()
+            if output is None:
+                output = torch.zeros((b, out_channels, out_h, out_w), device=out_tile.device, dtype=torch.float32)
+
+            oy, ox = int(y * scale), int(x0 * scale)
+            th, tw = out_tile.shape[2:]
+            weight = get_blend_weight(th, tw, out_overlap, y > 0, y != ys[-1], x0 > 0, x0 != xs[-1], out_tile.device)
+            output[:, :, oy : oy + th, ox : ox + tw] += out_tile * weight
+            weight_sum[oy : oy + th, ox : ox + tw] += weight
+            del out_tile
+
+    return output / weight_sum.to(output.device)
+
+
+def get_scale_factor(vae) -> int:
+    config = getattr(vae, "config", None)
+    block_out_channels = getattr(config, "block_out_channels", None) if config is not None else None
+    return 2 ** (len(block_out_channels) - 1) if block_out_channels else 8
+
+
+def enable_vae_tiling(vae, tile_size: int = 64, overlap: int = 8):
+    r"""
+    Replaces `vae.encode` and `vae.decode` with tiled versions. `tile_size` and `overlap` are in latent pixels.
+    Images smaller than the tile are processed as before.
+    """
+    assert 0 <= overlap < tile_size, "overlap must be smaller than tile size / overlapはタイルサイズより小さくしてください"
+    if hasattr(vae, "_org_encode"):
+        disable_vae_tiling(vae)
+
+    scale_factor = get_scale_factor(vae)
+    org_encode = vae.encode
+    org_decode = vae.decode
+
+    def encode(x: torch.Tensor, return_dict: bool = True):
+        if x.shape[2] <= tile_size * scale_factor and x.shape[3] <= tile_size * scale_factor:
+            return org_encode(x, return_dict=return_dict)
+
+        # blend moments (mean and logvar) of the tiles
+        moments = tiled_apply(
+            x,
+            lambda t: vae.quant_conv(vae.encoder(t)),
+            tile_size * scale_factor,
+            overlap * scale_factor,
+            1 / scale_factor,
+            vae.quant_conv.out_channels,
+        ).to(x.dtype)
+        posterior = DiagonalGaussianDistribution(moments)
+        if not return_dict:
+            return (posterior,)
+        return SimpleNamespace(latent_dist=posterior)
+
+    def decode(z: torch.Tensor, return_dict: bool = True):
+        if z.shape[2] <= tile_size and z.shape[3] <= tile_size:
+            return org_decode(z, return_dict=return_dict)
+
+        out_channels = vae.decoder.conv_out.out_channels
+        dec = tiled_apply(z, lambda t: org_decode(t).sample, tile_size, overlap, scale_factor, out_channels).to(z.dtype)
+        if not return_dict:
+            return (dec,)
+        return SimpleNamespace(sample=dec)
+
+    vae._org_encode = org_encode
+    vae._org_decode = org_decode
+    vae.encode = encode
+    vae.decode = decode
+    logger.info(f"enable tiled VAE: tile size {tile_size}, overlap {overlap} (latent)")
+
+
+def disable_vae_tiling(vae):
+    if hasattr(vae, "_org_encode"):
+        vae.encode = vae._org_encode
+        vae.decode = vae._org_decode
+        del vae._org_encode, vae._org_decode
+
+
+def get_max_rss() -> Optional[int]:
+    try:
+        import resource  # not available on Windows
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KB on Linux
+
+
+def measure(fn: Callable, device: torch.device):
+    # returns (output, seconds, peak memory increase in MB). on CPU, the increase of max RSS is reported
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+    else:
+        base = get_max_rss()
+    start_time = time.perf_counter()
+    output = fn()
+    elapsed = time.perf_counter() - start_time
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        elapsed = time.perf_counter() - start_time
+        peak = torch.cuda.max_memory_allocated(device) - base
+    else:
+        peak = get_max_rss() - base if base is not None else None
+    return output, elapsed, peak / 1024 / 1024 if peak is not None else float("nan")
+
+
+def main(args):
+    from diffusers import AutoencoderKL
+
+    device = torch.device(args.device)
+    dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(args.precision, torch.float32)
+
+    if args.vae is not None:
+        from library import model_util
+
+        vae = model_util.load_vae(args.vae, dtype)
+    else:
+        # same architecture as SD with random weights, for testing
+        vae = AutoencoderKL(
+            block_out_channels=(128, 256, 512, 512),
+            down_block_types=["DownEncoderBlock2D"] * 4,
+            up_block_types=["UpDecoderBlock2D"] * 4,
+            latent_channels=4,
+            layers_per_block=2,
+        )
+    vae.to(device, dtype=dtype).eval()
+
+    scale_factor = get_scale_factor(vae)
+    torch.manual_seed(0)
+    latents = torch.randn(1, 4, args.height // scale_factor, args.width // scale_factor, device=device, dtype=dtype)
+
+    # tiled first: on CPU, max RSS only increases
+    enable_vae_tiling(vae, args.tile_size, args.tile_overlap)
+    with torch.no_grad():
+        tiled, tiled_time, tiled_peak = measure(lambda: vae.decode(latents).sample, device)
+    logger.info(f"tiled decode: {tiled_time:.2f} sec, peak memory +{tiled_peak:.1f} MB")
+
+    disable_vae_tiling(vae)
+    if not args.skip_full:
+        with torch.no_grad():
+            full, full_time, full_peak = measure(lambda: vae.decode(latents).sample, device)
+        logger.info(f"full decode: {full_time:.2f} sec, peak memory +{full_peak:.1f} MB")
+        diff = (tiled.float() - full.float()).abs()
+        logger.info(f"difference from full decode: max {diff.max().item():.4f}, mean {diff.mean().item():.5f}")
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vae", type=str, default=None, help="VAE to test, random weights if omitted / テストするVAE、省略時はランダムな重み")
+    parser.add_argument("--width", type=int, default=1024, help="image width / 画像の幅")
+    parser.add_argument("--height", type=int, default=1024, help="image height / 画像の高さ")
+    parser.add_argument("--tile_size", type=int, default=64, help="tile size in latent / latentでのタイルサイズ")
+    parser.add_argument("--tile_overlap", type=int, default=8, help="overlap of tiles in latent / latentでのタイルの重なり")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="device / デバイス")
+    parser.add_argument("--precision", type=str, default="float", choices=["float", "fp16", "bf16"], help="precision / 精度")
+    parser.add_argument("--skip_full", action="store_true", help="skip full decode for comparison / 比較用の通常のdecodeを行わない")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+
+    args = parser.parse_args()
+    main(args)
@@ -62,7 +62,8 @@ from diffusers import (
     KDPM2AncestralDiscreteScheduler,
     AutoencoderKL,
 )
-from library import custom_train_functions
+from library import custom_train_functions, metadata_store
+from library.image_cache import DecodedImageCache
 from library.original_unet import UNet2DConditionModel
 from huggingface_hub import hf_hub_download
 import numpy as np
@@ -75,7 +76,7 @@ import library.model_util as model_util
 import library.huggingface_util as huggingface_util
 import library.sai_model_spec as sai_model_spec
 import library.deepspeed_utils as deepspeed_utils
-from library.utils import setup_logging, pil_resize
+from library.utils import setup_logging, pil_resize, TextEmbeddingCache, ImageWriter, to_pil_image
 
 setup_logging()
 import logging
@@ -139,6 +140,7 @@ IMAGE_TRANSFORMS = transforms.Compose(
 )
 
 TEXT_ENCODER_OUTPUTS_CACHE_SUFFIX = "_te_outputs.npz"
+CONDITIONING_IMAGE_CACHE_SUFFIX = "_cond.npz"
 
 
 class ImageInfo:
@@ -157,6 +159,7 @@ class ImageInfo:
         self.latents_original_size: Tuple[int, int] = None  # original image size, not latents size
         self.latents_crop_ltrb: Tuple[int, int] = None  # crop left top right bottom in original pixel size, not latents size
         self.cond_img_path: str = None
+        self.cond_img_npz: Optional[str] = None  # resized and cropped conditioning image, for ControlNetDataset
         self.image: Optional[Image.Image] = None  # optional, original PIL Image
         # SDXL, optional
         self.text_encoder_outputs_npz: Optional[str] = None
@@ -362,6 +365,73 @@ class AugHelper:
         return self.color_aug if use_color_aug else None
 
 
+def rgb_to_hsv(images: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # images: [B,3,H,W], 0.0~1.0. returns hue (0.0~1.0), saturation and value: [B,H,W]
+    r, g, b = images.unbind(1)
+    max_c, _ = images.max(dim=1)
+    min_c, _ = images.min(dim=1)
+    delta = max_c - min_c
+    delta_nonzero = torch.where(delta > 0, delta, torch.ones_like(delta))
+
+    hue = torch.where(
+        max_c == r, ((g - b) / delta_nonzero) % 6, torch.where(max_c == g, (b - r) / delta_nonzero + 2, (r - g) / delta_nonzero + 4)
+    )
+    hue = torch.where(delta > 0, hue / 6, torch.zeros_like(hue))
+    saturation = torch.where(max_c > 0, delta / torch.where(max_c > 0, max_c, torch.ones_like(max_c)), torch.zeros_like(max_c))
+    return hue, saturation, max_c
+
+
+def hsv_to_rgb(hue: torch.Tensor, saturation: torch.Tensor, value: torch.Tensor) -> torch.Tensor:
+    # inverse of rgb_to_hsv, returns [B,3,H,W]
+    n = torch.tensor([5.0, 3.0, 1.0], device=hue.device, dtype=hue.dtype).view(1, 3, 1, 1)
+    k = (n + hue.unsqueeze(1) * 6) % 6
+    value = value.unsqueeze(1)
+    return value - value * saturation.unsqueeze(1) * torch.clamp(torch.minimum(k, 4 - k), 0, 1)
+
+
+class BatchAugHelper:
+    r"""
+    Applies color augmentation and flip to a batch of images [B,C,H,W] normalized to -1.0~1.0, with tensor operations on any
+    device. The random values are taken from `generator`, so the augmentation is reproducible with the same seed.
+    The probabilities and ranges are the same as AugHelper.
+    """
+
+    hue_shift_limit = 8 / 180  # AugHelperはOpenCVのH(0~180)で8
+    gamma_range = (0.95, 1.05)
+
+    def color_aug(self, images: torch.Tensor, use_color_aug: torch.Tensor, generator: torch.Generator) -> torch.Tensor:
+        # use_color_aug: [B] bool, color_aug of the subset of each image
+        batch_size = images.shape[0]
+        apply = use_color_aug & (torch.rand(batch_size, generator=generator) <= 0.33)
+        use_hue_shift = torch.rand(batch_size, generator=generator) > 0.5
+        hue_shifts = (torch.rand(batch_size, generator=generator) * 2 - 1) * self.hue_shift_limit
+        gammas = self.gamma_range[0] + torch.rand(batch_size, generator=generator) * (self.gamma_range[1] - self.gamma_range[0])
+
+        # augment RGB channels only
+        indices = torch.nonzero(apply & use_hue_shift).squeeze(1)
+        if len(indices) > 0:
+            rgb = (images[indices, :3] + 1) / 2
+            hue, saturation, value = rgb_to_hsv(rgb)
+            hue = (hue + hue_shifts[indices].to(images.device, images.dtype).view(-1, 1, 1)) % 1.0
+            images[indices, :3] = hsv_to_rgb(hue, saturation, value) * 2 - 1
+
+        indices = torch.nonzero(apply & ~use_hue_shift).squeeze(1)
+        if len(indices) > 0:
+            # AugHelperと同じく0~255の画素値をgamma乗する
+            rgb = (images[indices, :3] + 1) * 127.5
+            rgb = torch.clamp(rgb ** gammas[indices].to(images.device, images.dtype).view(-1, 1, 1, 1), 0, 255)
+            images[indices, :3] = rgb / 127.5 - 1
+
+        return images
+
+    def flip(self, images: torch.Tensor, flipped: torch.Tensor) -> torch.Tensor:
+        # images: [B,...,W], flipped: [B] bool
+        indices = torch.nonzero(flipped).squeeze(1)
+        if len(indices) > 0:
+            images[indices] = torch.flip(images[indices], [-1])
+        return images
+
+
 class BaseSubset:
     def __init__(
         self,
@@ -641,7 +711,7 @@ class BaseDataset(torch.utils.data.Dataset):
         self.seed: int = 0
 
         # augmentation
-        self.aug_helper = AugHelper()
+        self.batch_aug_helper = BatchAugHelper()
 
         self.image_transforms = IMAGE_TRANSFORMS
 
@@ -652,6 +722,7 @@ class BaseDataset(torch.utils.data.Dataset):
 
         # caching
         self.caching_mode = None  # None, 'latents', 'text'
+        self.image_cache: Optional[DecodedImageCache] = None
 
     def adjust_min_max_bucket_reso_by_steps(
         self, resolution: Tuple[int, int], min_bucket_reso: int, max_bucket_reso: int, bucket_reso_steps: int
@@ -684,9 +755,15 @@ class BaseDataset(torch.utils.data.Dataset):
     def set_seed(self, seed):
         self.seed = seed
 
+    def get_augmentation_seed(self, index: int) -> int:
+        return ((self.seed * 1000003 + self.current_epoch) * 1000003 + index) % (2**63)
+
     def set_caching_mode(self, mode):
         self.caching_mode = mode
 
+    def enable_image_cache(self, image_cache: DecodedImageCache):
+        self.image_cache = image_cache
+
     def set_current_epoch(self, epoch):
         if not self.current_epoch == epoch:  # epochが切り替わったらバケツをシャッフルする
             if epoch > self.current_epoch:
@@ -1175,8 +1252,30 @@ class BaseDataset(torch.utils.data.Dataset):
 
         return img, face_cx, face_cy, face_w, face_h
 
+    def load_and_trim_image(self, subset: BaseSubset, image_info: ImageInfo, rng=random):
+        # bucketの解像度にリサイズ、cropする
+        if self.image_cache is None:
+            img = load_image(image_info.absolute_path, subset.alpha_mask)
+            return trim_and_resize_if_required(subset.random_crop, img, image_info.bucket_reso, image_info.resized_size, rng)
+
+        # キャッシュにはリサイズ済み、crop前の画像を保存するので、random cropやcolor augはリサイズ後の小さい画像に対して行われる
+        original_size = tuple(image_info.image_size)
+        num_channels = 4 if subset.alpha_mask else 3
+        img = self.image_cache.load(image_info.absolute_path, original_size, image_info.resized_size, num_channels)
+        if img is not None:
+            img, original_size, crop_ltrb = trim_image_if_required(
+                subset.random_crop, img, image_info.bucket_reso, original_size, rng
+            )
+            return np.array(img), original_size, crop_ltrb  # memory-mapped fileからコピーして書き込み可能にする
+
+        img = load_image(image_info.absolute_path, subset.alpha_mask)
+        original_size = (img.shape[1], img.shape[0])
+        img = resize_image_if_required(img, image_info.resized_size)
+        self.image_cache.save(image_info.absolute_path, original_size, img)
+        return trim_image_if_required(subset.random_crop, img, image_info.bucket_reso, original_size, rng)
+
     # いい感じに切り出す
-    def crop_target(self, subset: BaseSubset, image, face_cx, face_cy, face_w, face_h):
+    def crop_target(self, subset: BaseSubset, image, face_cx, face_cy, face_w, face_h, rng=random):
         height, width = image.shape[0:2]
         if height == self.height and width == self.width:
             return image
@@ -1190,7 +1289,7 @@ class BaseDataset(torch.utils.data.Dataset):
         if min_scale >= max_scale:  # range指定がmin==max
             scale = min_scale
         else:
-            scale = random.uniform(min_scale, max_scale)
+            scale = rng.uniform(min_scale, max_scale)
 
         nh = int(height * scale + 0.5)
         nw = int(width * scale + 0.5)
@@ -1207,12 +1306,12 @@ class BaseDataset(torch.utils.data.Dataset):
             if subset.random_crop:
                 # 背景も含めるために顔を中心に置く確率を高めつつずらす
                 range = max(length - face_p, face_p)  # 画像の端から顔中心までの距離の長いほう
-                p1 = p1 + (random.randint(0, range) + random.randint(0, range)) - range  # -range ~ +range までのいい感じの乱数
+                p1 = p1 + (rng.randint(0, range) + rng.randint(0, range)) - range  # -range ~ +range までのいい感じの乱数
             else:
                 # range指定があるときのみ、すこしだけランダムに（わりと適当）
                 if subset.face_crop_aug_range[0] != subset.face_crop_aug_range[1]:
                     if face_size > size // 10 and face_size >= 40:
-                        p1 = p1 + random.randint(-face_size // 20, +face_size // 20)
+                        p1 = p1 + rng.randint(-face_size // 20, +face_size // 20)
 
             p1 = max(0, min(p1, length - target_size))
 
@@ -1234,6 +1333,10 @@ class BaseDataset(torch.utils.data.Dataset):
         if self.caching_mode is not None:  # return batch for latents/text encoder outputs caching
             return self.get_item_for_caching(bucket, bucket_batch_size, image_index)
 
+        # flip、crop、color augの乱数はseed、epoch、indexから決めるので、ワーカー数やresumeに関係なく再現できる
+        augmentation_seed = self.get_augmentation_seed(index)
+        rng = random.Random(augmentation_seed)
+
         loss_weights = []
         captions = []
         input_ids_list = []
@@ -1245,6 +1348,7 @@ class BaseDataset(torch.utils.data.Dataset):
         crop_top_lefts = []
         target_sizes_hw = []
         flippeds = []  # 変数名が微妙
+        color_augs = []
         text_encoder_outputs1_list = []
         text_encoder_outputs2_list = []
         text_encoder_pool2_list = []
@@ -1256,7 +1360,7 @@ class BaseDataset(torch.utils.data.Dataset):
                 self.prior_loss_weight if image_info.is_reg else 1.0
             )  # in case of fine tuning, is_reg is always False
 
-            flipped = subset.flip_aug and random.random() < 0.5  # not flipped or flipped with 50% chance
+            flipped = subset.flip_aug and rng.random() < 0.5  # not flipped or flipped with 50% chance
 
             # image/latentsを処理する
             if image_info.latents is not None:  # cache_latents=Trueの場合
@@ -1283,27 +1387,25 @@ class BaseDataset(torch.utils.data.Dataset):
                 image = None
             else:
                 # 画像を読み込み、必要ならcropする
-                img, face_cx, face_cy, face_w, face_h = self.load_image_with_face_info(
-                    subset, image_info.absolute_path, subset.alpha_mask
-                )
-                im_h, im_w = img.shape[0:2]
-
                 if self.enable_bucket:
-                    img, original_size, crop_ltrb = trim_and_resize_if_required(
-                        subset.random_crop, img, image_info.bucket_reso, image_info.resized_size
-                    )
+                    img, original_size, crop_ltrb = self.load_and_trim_image(subset, image_info, rng)
                 else:
+                    img, face_cx, face_cy, face_w, face_h = self.load_image_with_face_info(
+                        subset, image_info.absolute_path, subset.alpha_mask
+                    )
+                    im_h, im_w = img.shape[0:2]
+
                     if face_cx > 0:  # 顔位置情報あり
-                        img = self.crop_target(subset, img, face_cx, face_cy, face_w, face_h)
+                        img = self.crop_target(subset, img, face_cx, face_cy, face_w, face_h, rng)
                     elif im_h > self.height or im_w > self.width:
                         assert (
                             subset.random_crop
                         ), f"image too large, but cropping and bucketing are disabled / 画像サイズが大きいのでface_crop_aug_rangeかrandom_crop、またはbucketを有効にしてください: {image_info.absolute_path}"
                         if im_h > self.height:
-                            p = random.randint(0, im_h - self.height)
+                            p = rng.randint(0, im_h - self.height)
                             img = img[p : p + self.height]
                         if im_w > self.width:
-                            p = random.randint(0, im_w - self.width)
+                            p = rng.randint(0, im_w - self.width)
                             img = img[:, p : p + self.width]
 
                     im_h, im_w = img.shape[0:2]
@@ -1314,17 +1416,7 @@ class BaseDataset(torch.utils.data.Dataset):
                     original_size = [im_w, im_h]
                     crop_ltrb = (0, 0, 0, 0)
 
-                # augmentation
-                aug = self.aug_helper.get_augmentor(subset.color_aug)
-                if aug is not None:
-                    # augment RGB channels only
-                    img_rgb = img[:, :, :3]
-                    img_rgb = aug(image=img_rgb)["image"]
-                    img[:, :, :3] = img_rgb
-
-                if flipped:
-                    img = img[:, ::-1, :].copy()  # copy to avoid negative stride problem
-
+                # color augとflipは後でバッチ単位でまとめて行う
                 if subset.alpha_mask:
                     if img.shape[2] == 4:
                         alpha_mask = img[:, :, 3]  # [H,W]
@@ -1357,6 +1449,7 @@ class BaseDataset(torch.utils.data.Dataset):
             crop_top_lefts.append((int(crop_left_top[1]), int(crop_left_top[0])))
             target_sizes_hw.append((int(target_size[1]), int(target_size[0])))
             flippeds.append(flipped)
+            color_augs.append(subset.color_aug)
 
             # captionとtext encoder outputを処理する
             caption = image_info.caption  # default
@@ -1449,6 +1542,14 @@ class BaseDataset(torch.utils.data.Dataset):
         if images[0] is not None:
             images = torch.stack(images)
             images = images.to(memory_format=torch.contiguous_format).float()
+
+            # color augとflipをバッチ単位でまとめて行う
+            generator = torch.Generator().manual_seed(augmentation_seed)
+            flipped_tensor = torch.tensor(flippeds, dtype=torch.bool)
+            images = self.batch_aug_helper.color_aug(images, torch.tensor(color_augs, dtype=torch.bool), generator)
+            images = self.batch_aug_helper.flip(images, flipped_tensor)
+            if example["alpha_masks"] is not None:
+                example["alpha_masks"] = self.batch_aug_helper.flip(example["alpha_masks"], flipped_tensor)
         else:
             images = None
         example["images"] = images
@@ -1794,8 +1895,7 @@ class FineTuningDataset(BaseDataset):
             # メタデータを読み込む
             if os.path.exists(subset.metadata_file):
                 logger.info(f"loading existing metadata: {subset.metadata_file}")
-                with open(subset.metadata_file, "rt", encoding="utf-8") as f:
-                    metadata = json.load(f)
+                metadata = metadata_store.load_metadata(subset.metadata_file)  # .json or .jsonl
             else:
                 raise ValueError(f"no metadata / メタデータファイルがありません: {subset.metadata_file}")
 
@@ -2103,8 +2203,71 @@ class ControlNetDataset(BaseDataset):
         self.bucket_manager = self.dreambooth_dataset_delegate.bucket_manager
         self.buckets_indices = self.dreambooth_dataset_delegate.buckets_indices
 
+    def enable_image_cache(self, image_cache: DecodedImageCache):
+        self.dreambooth_dataset_delegate.enable_image_cache(image_cache)
+
+    def set_seed(self, seed):
+        super().set_seed(seed)
+        self.dreambooth_dataset_delegate.set_seed(seed)
+
+    def set_current_epoch(self, epoch):
+        super().set_current_epoch(epoch)
+        # augmentationの乱数のためにepochを伝える。bucketは共有しているのでここでシャッフル済み
+        self.dreambooth_dataset_delegate.current_epoch = self.current_epoch
+
     def cache_latents(self, vae, vae_batch_size=1, cache_to_disk=False, is_main_process=True):
-        return self.dreambooth_dataset_delegate.cache_latents(vae, vae_batch_size, cache_to_disk, is_main_process)
+        self.dreambooth_dataset_delegate.cache_latents(vae, vae_batch_size, cache_to_disk, is_main_process)
+
+        # 制御用画像もリサイズ、crop済みのものをディスクにキャッシュして、毎ステップの読み込みとリサイズを省く
+        if cache_to_disk:
+            self.cache_conditioning_images_to_disk(is_main_process)
+
+    def cache_conditioning_images_to_disk(self, is_main_process=True):
+        logger.info("caching conditioning images.")
+        for image_info in tqdm(list(self.dreambooth_dataset_delegate.image_data.values())):
+            image_info.cond_img_npz = os.path.splitext(image_info.cond_img_path)[0] + CONDITIONING_IMAGE_CACHE_SUFFIX
+            if not is_main_process:  # store to info only
+                continue
+
+            target_size_hw = (image_info.bucket_reso[1], image_info.bucket_reso[0])
+            if is_disk_cached_conditioning_image_is_expected(
+                image_info.cond_img_npz, image_info.cond_img_path, target_size_hw, image_info.resized_size
+            ):
+                continue
+
+            original_size_hw = (image_info.image_size[1], image_info.image_size[0])
+            cond_img = self.load_conditioning_image(image_info, target_size_hw, original_size_hw)
+            np.savez(image_info.cond_img_npz, conditioning_image=cond_img, resized_size=np.array(image_info.resized_size))
+
+    def load_conditioning_image(self, image_info: ImageInfo, target_size_hw, original_size_hw) -> np.ndarray:
+        # 制御用画像を読み込み、学習画像と同じようにリサイズ、cropする（flipは除く）
+        cond_img = load_image(image_info.cond_img_path)
+
+        if self.dreambooth_dataset_delegate.enable_bucket:
+            if cond_img.shape[0] == target_size_hw[0] and cond_img.shape[1] == target_size_hw[1]:
+                return cond_img  # tools/canny.py --resolution 等でbucketの解像度に変換済み
+
+            assert (
+                cond_img.shape[0] == original_size_hw[0] and cond_img.shape[1] == original_size_hw[1]
+            ), f"size of conditioning image is not match / 画像サイズが合いません: {image_info.absolute_path}"
+            cond_img = cv2.resize(
+                cond_img, image_info.resized_size, interpolation=cv2.INTER_AREA
+            )  # INTER_AREAでやりたいのでcv2でリサイズ
+
+            # TODO support random crop
+            # 現在サポートしているcropはrandomではなく中央のみ
+            h, w = target_size_hw
+            ct = (cond_img.shape[0] - h) // 2
+            cl = (cond_img.shape[1] - w) // 2
+            cond_img = cond_img[ct : ct + h, cl : cl + w]
+        else:
+            # assert (
+            #     cond_img.shape[0] == self.height and cond_img.shape[1] == self.width
+            # ), f"image size is small / 画像サイズが小さいようです: {image_info.absolute_path}"
+            # resize to target
+            if cond_img.shape[0] != target_size_hw[0] or cond_img.shape[1] != target_size_hw[1]:
+                cond_img = pil_resize(cond_img, (int(target_size_hw[1]), int(target_size_hw[0])))
+        return cond_img
 
     def __len__(self):
         return self.dreambooth_dataset_delegate.__len__()
@@ -2126,38 +2289,18 @@ class ControlNetDataset(BaseDataset):
             target_size_hw = example["target_sizes_hw"][i]
             original_size_hw = example["original_sizes_hw"][i]
             crop_top_left = example["crop_top_lefts"][i]
-            flipped = example["flippeds"][i]
-            cond_img = load_image(image_info.cond_img_path)
-
-            if self.dreambooth_dataset_delegate.enable_bucket:
-                assert (
-                    cond_img.shape[0] == original_size_hw[0] and cond_img.shape[1] == original_size_hw[1]
-                ), f"size of conditioning image is not match / 画像サイズが合いません: {image_info.absolute_path}"
-                cond_img = cv2.resize(
-                    cond_img, image_info.resized_size, interpolation=cv2.INTER_AREA
-                )  # INTER_AREAでやりたいのでcv2でリサイズ
-
-                # TODO support random crop
-                # 現在サポートしているcropはrandomではなく中央のみ
-                h, w = target_size_hw
-                ct = (cond_img.shape[0] - h) // 2
-                cl = (cond_img.shape[1] - w) // 2
-                cond_img = cond_img[ct : ct + h, cl : cl + w]
+            if image_info.cond_img_npz is not None:  # cache_latents_to_disk=Trueの場合
+                cond_img = load_conditioning_image_from_disk(image_info.cond_img_npz)
             else:
-                # assert (
-                #     cond_img.shape[0] == self.height and cond_img.shape[1] == self.width
-                # ), f"image size is small / 画像サイズが小さいようです: {image_info.absolute_path}"
-                # resize to target
-                if cond_img.shape[0] != target_size_hw[0] or cond_img.shape[1] != target_size_hw[1]:
-                    cond_img = pil_resize(cond_img, (int(target_size_hw[1]), int(target_size_hw[0])))
-
-            if flipped:
-                cond_img = cond_img[:, ::-1, :].copy()  # copy to avoid negative stride
+                cond_img = self.load_conditioning_image(image_info, target_size_hw, original_size_hw)
 
             cond_img = self.conditioning_image_transforms(cond_img)
             conditioning_images.append(cond_img)
 
-        example["conditioning_images"] = torch.stack(conditioning_images).to(memory_format=torch.contiguous_format).float()
+        conditioning_images = torch.stack(conditioning_images).to(memory_format=torch.contiguous_format).float()
+        example["conditioning_images"] = self.batch_aug_helper.flip(
+            conditioning_images, torch.tensor(example["flippeds"], dtype=torch.bool)
+        )
 
         return example
 
@@ -2209,6 +2352,13 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
         for dataset in self.datasets:
             dataset.set_caching_mode(caching_mode)
 
+    def enable_image_cache(self, cache_dir: str, max_size_gb: float):
+        # すべてのデータセットで同じキャッシュを共有する
+        logger.info(f"enable image cache: {cache_dir}, max size: {max_size_gb} GB")
+        image_cache = DecodedImageCache(cache_dir, int(max_size_gb * 1024**3))
+        for dataset in self.datasets:
+            dataset.enable_image_cache(image_cache)
+
     def verify_bucket_reso_steps(self, min_steps: int):
         for dataset in self.datasets:
             dataset.verify_bucket_reso_steps(min_steps)
@@ -2236,6 +2386,31 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
             dataset.disable_token_padding()
 
 
+def is_disk_cached_conditioning_image_is_expected(npz_path: str, cond_img_path: str, target_size_hw, resized_size) -> bool:
+    # 制御用画像が更新されていれば作り直す
+    if not os.path.exists(npz_path) or os.path.getmtime(npz_path) < os.path.getmtime(cond_img_path):
+        return False
+
+    try:
+        npz = np.load(npz_path)
+        if "conditioning_image" not in npz or "resized_size" not in npz:
+            return False
+        if npz["conditioning_image"].shape[0:2] != tuple(target_size_hw):
+            return False
+        if tuple(npz["resized_size"].tolist()) != tuple(resized_size):
+            return False
+    except Exception as e:
+        logger.error(f"Error loading file: {npz_path}")
+        raise e
+
+    return True
+
+
+def load_conditioning_image_from_disk(npz_path: str) -> np.ndarray:
+    npz = np.load(npz_path)
+    return npz["conditioning_image"]
+
+
 def is_disk_cached_latents_is_expected(reso, npz_path: str, flip_aug: bool, alpha_mask: bool):
     expected_latents_size = (reso[1] // 8, reso[0] // 8)  # bucket_resoはWxHなので注意
 
@@ -2436,6 +2611,9 @@ class MinimalDataset(BaseDataset):
     def is_latent_cacheable(self) -> bool:
         return False
 
+    def enable_image_cache(self, *args, **kwargs):
+        logger.warning("image cache is not supported for the dataset class / dataset_classでは画像キャッシュは使えません")
+
     def __len__(self):
         raise NotImplementedError
 
@@ -2504,11 +2682,8 @@ def load_image(image_path, alpha=False):
 
 
 # 画像を読み込む。戻り値はnumpy.ndarray,(original width, original height),(crop left, crop top, crop right, crop bottom)
-def trim_and_resize_if_required(
-    random_crop: bool, image: np.ndarray, reso, resized_size: Tuple[int, int]
-) -> Tuple[np.ndarray, Tuple[int, int], Tuple[int, int, int, int]]:
+def resize_image_if_required(image: np.ndarray, resized_size: Tuple[int, int]) -> np.ndarray:
     image_height, image_width = image.shape[0:2]
-    original_size = (image_width, image_height)  # size before resize
 
     if image_width != resized_size[0] or image_height != resized_size[1]:
         # リサイズする
@@ -2517,16 +2692,22 @@ def trim_and_resize_if_required(
         else:
             image = pil_resize(image, resized_size)
 
+    return image
+
+
+def trim_image_if_required(
+    random_crop: bool, image: np.ndarray, reso, original_size: Tuple[int, int], rng=random
+) -> Tuple[np.ndarray, Tuple[int, int], Tuple[int, int, int, int]]:
     image_height, image_width = image.shape[0:2]
 
     if image_width > reso[0]:
         trim_size = image_width - reso[0]
-        p = trim_size // 2 if not random_crop else random.randint(0, trim_size)
+        p = trim_size // 2 if not random_crop else rng.randint(0, trim_size)
         # logger.info(f"w {trim_size} {p}")
         image = image[:, p : p + reso[0]]
     if image_height > reso[1]:
         trim_size = image_height - reso[1]
-        p = trim_size // 2 if not random_crop else random.randint(0, trim_size)
+        p = trim_size // 2 if not random_crop else rng.randint(0, trim_size)
         # logger.info(f"h {trim_size} {p})
         image = image[p : p + reso[1]]
 
@@ -2539,6 +2720,16 @@ def trim_and_resize_if_required(
     return image, original_size, crop_ltrb
 
 
+def trim_and_resize_if_required(
+    random_crop: bool, image: np.ndarray, reso, resized_size: Tuple[int, int], rng=random
+) -> Tuple[np.ndarray, Tuple[int, int], Tuple[int, int, int, int]]:
+    image_height, image_width = image.shape[0:2]
+    original_size = (image_width, image_height)  # size before resize
+
+    image = resize_image_if_required(image, resized_size)
+    return trim_image_if_required(random_crop, image, reso, original_size, rng)
+
+
 def cache_batch_latents(
     vae: AutoencoderKL, cache_to_disk: bool, image_infos: List[ImageInfo], flip_aug: bool, use_alpha_mask: bool, random_crop: bool
 ) -> None:
@@ -3854,11 +4045,39 @@ def add_dataset_arguments(
     parser.add_argument(
         "--vae_batch_size", type=int, default=1, help="batch size for caching latents / latentのcache時のバッチサイズ"
     )
+    parser.add_argument(
+        "--vae_tiling",
+        action="store_true",
+        help="encode/decode large images with VAE by overlapping tiles to reduce VRAM usage (caching latents, sample images)"
+        + " / VRAM使用量削減のため大きな画像をVAEで重なりのあるタイルに分割してencode/decodeする（latentのcache、サンプル画像）",
+    )
+    parser.add_argument(
+        "--vae_tile_size", type=int, default=64, help="tile size in latent for --vae_tiling / --vae_tilingのlatentでのタイルサイズ"
+    )
+    parser.add_argument(
+        "--vae_tile_overlap",
+        type=int,
+        default=8,
+        help="overlap of tiles in latent for --vae_tiling / --vae_tilingのlatentでのタイルの重なり",
+    )
     parser.add_argument(
         "--cache_latents_to_disk",
         action="store_true",
         help="cache latents to disk to reduce VRAM usage (augmentations must be disabled) / VRAM削減のためにlatentをディスクにcacheする（augmentationは使用不可）",
     )
+    parser.add_argument(
+        "--image_cache_dir",
+        type=str,
+        default=None,
+        help="directory to cache the images resized to the bucket resolution, to speed up loading when latents are not cached (with color_aug or random_crop)"
+        + " / bucketの解像度にリサイズした画像をキャッシュするディレクトリ、latentをキャッシュしない場合（color_aug、random_crop使用時）の読み込みを高速化する",
+    )
+    parser.add_argument(
+        "--image_cache_max_size",
+        type=float,
+        default=10.0,
+        help="max size of the image cache in GB, least recently used images are removed / 画像キャッシュの最大サイズ（GB）、最も長く使われていない画像から削除される",
+    )
     parser.add_argument(
         "--enable_bucket",
         action="store_true",
@@ -3943,7 +4162,7 @@ def add_dataset_arguments(
     if support_caption:
         # caption dataset
         parser.add_argument(
-            "--in_json", type=str, default=None, help="json metadata for dataset / データセットのmetadataのjsonファイル"
+            "--in_json", type=str, default=None, help="json metadata for dataset, .json or .jsonl / データセットのmetadataのjsonファイル、.jsonまたは.jsonl"
         )
         parser.add_argument(
             "--dataset_repeats",
@@ -4732,9 +4951,18 @@ def load_target_model(args, weight_dtype, accelerator, unet_use_linear_projectio
 
             clean_memory_on_device(accelerator.device)
         accelerator.wait_for_everyone()
+
+    enable_vae_tiling_if_specified(args, vae)
     return text_encoder, vae, unet, load_stable_diffusion_format
 
 
+def enable_vae_tiling_if_specified(args: argparse.Namespace, vae):
+    if getattr(args, "vae_tiling", False):
+        from library.tiled_vae import enable_vae_tiling
+
+        enable_vae_tiling(vae, args.vae_tile_size, args.vae_tile_overlap)
+
+
 def patch_accelerator_for_fp16_training(accelerator):
     org_unscale_grads = accelerator.scaler._unscale_grads_
 
@@ -5504,6 +5732,11 @@ def sample_images_common(
         clip_skip=args.clip_skip,
     )
     pipeline.to(distributed_state.device)
+
+    # reuse text encoder outputs for repeated prompts and negative prompts. the text encoder may be trained, so only in this call
+    pipeline.text_embedding_cache = TextEmbeddingCache()
+    image_writer = ImageWriter()  # save images in background while generating the next one
+
     save_dir = args.output_dir + "/sample"
     os.makedirs(save_dir, exist_ok=True)
 
@@ -5532,7 +5765,16 @@ def sample_images_common(
         with torch.no_grad():
             for prompt_dict in prompts:
                 sample_image_inference(
-                    accelerator, args, pipeline, save_dir, prompt_dict, epoch, steps, prompt_replacement, controlnet=controlnet
+                    accelerator,
+                    args,
+                    pipeline,
+                    save_dir,
+                    prompt_dict,
+                    epoch,
+                    steps,
+                    prompt_replacement,
+                    controlnet=controlnet,
+                    image_writer=image_writer,
                 )
     else:
         # Creating list with N elements, where each element is a list of prompt_dicts, and N is the number of processes available (number of devices available)
@@ -5545,9 +5787,21 @@ def sample_images_common(
             with distributed_state.split_between_processes(per_process_prompts) as prompt_dict_lists:
                 for prompt_dict in prompt_dict_lists[0]:
                     sample_image_inference(
-                        accelerator, args, pipeline, save_dir, prompt_dict, epoch, steps, prompt_replacement, controlnet=controlnet
+                        accelerator,
+                        args,
+                        pipeline,
+                        save_dir,
+                        prompt_dict,
+                        epoch,
+                        steps,
+                        prompt_replacement,
+                        controlnet=controlnet,
+                        image_writer=image_writer,
                     )
 
+    image_writer.close()  # all images are saved before returning to training
+    logger.info(pipeline.text_embedding_cache.get_stats_str())
+
     # clear pipeline and cache to reduce vram usage
     del pipeline
 
@@ -5572,6 +5826,7 @@ def sample_image_inference(
     steps,
     prompt_replacement,
     controlnet=None,
+    image_writer: Optional[ImageWriter] = None,
 ):
     assert isinstance(prompt_dict, dict)
     negative_prompt = prompt_dict.get("negative_prompt")
@@ -5636,7 +5891,8 @@ def sample_image_inference(
         with torch.cuda.device(torch.cuda.current_device()):
             torch.cuda.empty_cache()
 
-    image = pipeline.latents_to_image(latents)[0]
+    # decoded image (H, W, C) in [0, 1]: converted to a PIL image (float to uint8) in the image writer
+    image = pipeline.decode_latents(latents.to(pipeline.vae.dtype))[0]
 
     # adding accelerator.wait_for_everyone() here should sync up and ensure that sample images are saved in the same order as the original prompt list
     # but adding 'enum' to the filename should be enough
@@ -5646,7 +5902,10 @@ def sample_image_inference(
     seed_suffix = "" if seed is None else f"_{seed}"
     i: int = prompt_dict["enum"]
     img_filename = f"{'' if args.output_name is None else args.output_name + '_'}{num_suffix}_{i:02d}_{ts_str}{seed_suffix}.png"
-    image.save(os.path.join(save_dir, img_filename))
+    if image_writer is not None:
+        image_writer.save(image, os.path.join(save_dir, img_filename))
+    else:
+        to_pil_image(image).save(os.path.join(save_dir, img_filename))
 
     # wandb有効時のみログを送信
     try:
@@ -5656,7 +5915,7 @@ def sample_image_inference(
         except ImportError:  # 事前に一度確認するのでここはエラー出ないはず
             raise ImportError("No wandb / wandb がインストールされていないようです")
 
-        wandb_tracker.log({f"sample_{i}": wandb.Image(image)})
+        wandb_tracker.log({f"sample_{i}": wandb.Image(to_pil_image(image))})
     except:  # wandb 無効時
         pass
 
@@ -1,6 +1,15 @@
+from collections import OrderedDict
+import itertools
+import json
 import logging
+import math
+import os
+import random
+import re
+import struct
 import sys
 import threading
+import time
 import torch
 from torchvision import transforms
 from typing import *
@@ -101,6 +110,107 @@ def pil_resize(image, size, interpolation=Image.LANCZOS):
     return resized_cv2
 
 
+# region safetensors header/streaming utilities
+
+SAFETENSORS_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+
+
+def load_safetensors_header(file_name: str) -> Tuple[Dict[str, Any], Optional[Dict[str, str]], int]:
+    """
+    read only the header of a .safetensors file without loading tensors.
+    returns tensor infos (key -> dtype, shape, data_offsets), metadata and the file offset where tensor data starts
+    テンソルを読み込まずにヘッダーのみを読み込む
+    """
+    with open(file_name, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    metadata = header.pop("__metadata__", None)
+    return header, metadata, 8 + header_size
+
+
+class SafetensorsStreamWriter:
+    """
+    Write a .safetensors file tensor by tensor. All keys, dtypes and shapes must be known in advance: the header is written
+    first and each tensor is written at its own offset, in any order, so only one tensor has to be in memory at a time.
+    事前にキー・型・形状を指定して、テンソルを一つずつ任意の順序で書き込む。メモリ上には一度に一つのテンソルだけあればよい
+    """
+
+    def __init__(
+        self,
+        file_name: str,
+        tensor_specs: Dict[str, Tuple[torch.dtype, Tuple[int, ...]]],
+        metadata: Optional[Dict[str, str]] = None,
+    ):
+        self.file_name = file_name
+        self.offsets = {}
+
+        header = {}
+        if metadata:
+            header["__metadata__"] = metadata
+        offset = 0
+        for key, (dtype, shape) in tensor_specs.items():
+            size = torch.tensor([], dtype=dtype).element_size()
+            for s in shape:
+                size *= s
+            header[key] = {"dtype": SAFETENSORS_DTYPES[dtype], "shape": list(shape), "data_offsets": [offset, offset + size]}
+            self.offsets[key] = (offset, size, dtype, tuple(shape))
+            offset += size
+        self.data_size = offset
+
+        header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        header_bytes += b" " * ((8 - len(header_bytes) % 8) % 8)  # align data to 8 bytes
+        self.data_start = 8 + len(header_bytes)
+
+        self.written = set()
+        self.lock = threading.Lock()
+        self.file = open(file_name, "wb")
+        self.file.write(struct.pack("<Q", len(header_bytes)))
+        self.file.write(header_bytes)
+        self.file.truncate(self.data_start + self.data_size)
+
+    def write(self, key: str, tensor: torch.Tensor):
+        offset, size, dtype, shape = self.offsets[key]
+        assert (
+            tensor.dtype == dtype and tuple(tensor.shape) == shape
+        ), f"unexpected tensor for {key}: {tensor.dtype} {tuple(tensor.shape)}"
+        data = tensor.detach().to("cpu").contiguous().reshape(-1).view(torch.uint8).numpy().tobytes()
+        assert len(data) == size
+        with self.lock:
+            self.file.seek(self.data_start + offset)
+            self.file.write(data)
+            self.written.add(key)
+
+    def close(self):
+        missing = self.offsets.keys() - self.written
+        self.file.close()
+        if missing:
+            raise RuntimeError(f"tensors are not written / 書き込まれていないテンソルがあります: {sorted(missing)}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+        return False
+
+
+# endregion
+
+
 # TODO make inf_utils.py
 
 
@@ -285,3 +395,482 @@ class EulerAncestralDiscreteSchedulerGL(EulerAncestralDiscreteScheduler):
 
 
 # endregion
+
+
+# region batch planning for image generation
+
+
+class BatchPlanner:
+    """
+    Collects generation requests and passes them to `process_fn` as batches whose items share the same `ext`.
+    Without `regroup`, a batch is flushed as soon as `ext` changes (the original behavior). With `regroup`, requests are
+    grouped by `ext` across the whole prompt list, so that mixed prompts still produce full batches.
+
+    `next_stage` is another planner which `process_fn` feeds, such as the 2nd stage of highres fix. It is flushed after this
+    planner, so that the stages can use different batch sizes.
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        process_fn: Callable[[list], Any],
+        regroup: bool = False,
+        next_stage: Optional["BatchPlanner"] = None,
+    ):
+        self.batch_size = batch_size
+        self.process_fn = process_fn
+        self.regroup = regroup
+        self.next_stage = next_stage
+        self.groups: Dict[Any, list] = {}  # ext -> pending requests, in insertion order
+        self.group_times: Dict[Any, float] = {}  # ext -> time when the group is created
+        self.num_batches = 0
+        self.num_items = 0
+
+    def add(self, item) -> Optional[Any]:
+        # returns the result of process_fn if a batch is processed for this item
+        if not self.regroup and len(self.groups) > 0 and item.ext not in self.groups:
+            self.flush()
+
+        if item.ext not in self.groups:
+            self.groups[item.ext] = []
+            self.group_times[item.ext] = time.perf_counter()
+        group = self.groups[item.ext]
+        group.append(item)
+        if len(group) < self.batch_size:
+            return None
+
+        return self._process(self._pop(item.ext))
+
+    def flush(self, max_age: Optional[float] = None):
+        # process pending requests, the oldest group first. if max_age is given, only groups older than max_age (sec)
+        now = time.perf_counter()
+        processed = False
+        for ext in list(self.groups.keys()):
+            if max_age is None or now - self.group_times[ext] >= max_age:
+                self._process(self._pop(ext))
+                processed = True
+
+        if self.next_stage is not None:
+            # requests which have already waited in this stage should not wait again in the next stage
+            self.next_stage.flush(None if processed else max_age)
+
+    def get_time_to_flush(self, max_age: float) -> Optional[float]:
+        # seconds until the oldest group gets older than max_age, or None if no request is pending
+        times = []
+        if len(self.groups) > 0:
+            times.append(max(0.0, max_age - (time.perf_counter() - min(self.group_times.values()))))
+        if self.next_stage is not None and self.next_stage.get_time_to_flush(max_age) is not None:
+            times.append(self.next_stage.get_time_to_flush(max_age))
+        return min(times) if len(times) > 0 else None
+
+    def _pop(self, ext) -> list:
+        del self.group_times[ext]
+        return self.groups.pop(ext)
+
+    def _process(self, batch: list):
+        self.num_batches += 1
+        self.num_items += len(batch)
+        return self.process_fn(batch)
+
+    def get_fill_ratio(self) -> float:
+        if self.num_batches == 0:
+            return 0.0
+        return self.num_items / (self.num_batches * self.batch_size)
+
+
+# endregion
+
+
+# region dynamic prompt variants
+
+# sd-dynamic-prompts like variants:
+# starts and ends with "{" and "}"
+# contains at least one variant divided by "|"
+# optional framgments divided by "$$" at start
+# if the first fragment is "E" or "e", enumerate all variants
+# if the second fragment is a number or two numbers, repeat the variants in the range
+# if the third fragment is a string, use it as a separator
+
+RE_DYNAMIC_PROMPT = re.compile(r"\{((e|E)\$\$)?(([\d\-]+)\$\$)?(([^\|\}]+?)\$\$)?(.+?((\|).+?)*?)\}")
+
+
+class DynamicPromptVariants:
+    """
+    Expands the variants in `prompt` lazily: iterating yields one prompt at a time, so that the prompts are passed to the batch
+    planner without building all combinations in memory.
+
+    Without enumeration, `repeat_count` prompts are yielded with random variants (the prompt itself if it has no variants).
+    With enumeration, all combinations of the enumerated groups are yielded, and the other groups are chosen randomly for each
+    prompt. Duplicated variants in an enumerated group are yielded once, so the same prompt is not generated twice. If the
+    enumeration gives only one prompt, it is repeated `repeat_count` times like a prompt without variants.
+    """
+
+    def __init__(self, prompt: str, repeat_count: int):
+        self.prompt = prompt
+        self.repeat_count = repeat_count
+
+        # literal pieces and groups of the prompt: pieces[0] + group[0] + pieces[1] + ... + pieces[-1]
+        self.pieces: List[str] = []
+        self.groups: List[Tuple[bool, List[str], Tuple[int, int], str]] = []  # (enumerating, variants, count range, separator)
+        last = 0
+        for found in RE_DYNAMIC_PROMPT.finditer(prompt):
+            self.pieces.append(prompt[last : found.start()])
+            last = found.end()
+
+            enumerating = found.group(2) is not None
+            separator = ", " if found.group(6) is None else found.group(6)
+            variants = found.group(7).split("|")
+            if enumerating:
+                variants = list(dict.fromkeys(variants))  # unique, keep order
+            self.groups.append((enumerating, variants, self.parse_count_range(found.group(4), len(variants)), separator))
+        self.pieces.append(prompt[last:])
+
+        self.enumerating = any(group[0] for group in self.groups)
+
+    @staticmethod
+    def parse_count_range(count_range: Optional[str], num_variants: int) -> Tuple[int, int]:
+        if count_range is None:
+            return 1, 1
+        count_range = count_range.split("-")
+        if len(count_range) == 1:
+            count_range = [int(count_range[0]), int(count_range[0])]
+        elif len(count_range) == 2:
+            count_range = [int(count_range[0]), int(count_range[1])]
+        else:
+            logging.getLogger(__name__).warning(f"invalid count range: {count_range}")
+            return 1, 1
+        if count_range[0] > count_range[1]:
+            count_range = [count_range[1], count_range[0]]
+        return max(0, count_range[0]), min(num_variants, count_range[1])
+
+    @property
+    def is_dynamic(self) -> bool:
+        return len(self.groups) > 0
+
+    @property
+    def is_repeated(self) -> bool:
+        # the same prompt is yielded `repeat_count` times: no variants, or only one prompt by the enumeration
+        return not self.is_dynamic or (self.enumerating and self.get_num_enumerated() == 1)
+
+    def get_num_enumerated(self) -> int:
+        num = 1
+        for enumerating, variants, (min_count, max_count), _ in self.groups:
+            if enumerating:
+                num *= sum(math.comb(len(variants), count) for count in range(min_count, max_count + 1))
+        return num
+
+    def __len__(self) -> int:
+        if not self.enumerating:
+            return self.repeat_count
+        num = self.get_num_enumerated()
+        return self.repeat_count if num == 1 else num
+
+    @staticmethod
+    def enumerate_variants(variants: List[str], count_range: Tuple[int, int], separator: str) -> Iterator[str]:
+        for count in range(count_range[0], count_range[1] + 1):
+            for comb in itertools.combinations(variants, count):
+                yield separator.join(comb)
+
+    def choose_variants(self, values: Dict[int, str]) -> str:
+        # choose random variants for the groups not in `values`, and make the prompt
+        parts = [self.pieces[0]]
+        for i, (_, variants, count_range, separator) in enumerate(self.groups):
+            if i in values:
+                parts.append(values[i])
+            else:
+                count = random.randint(count_range[0], count_range[1])
+                parts.append(separator.join(random.sample(variants, count)))
+            parts.append(self.pieces[i + 1])
+        return "".join(parts)
+
+    def __iter__(self) -> Iterator[str]:
+        if not self.is_dynamic:
+            for _ in range(self.repeat_count):
+                yield self.prompt
+            return
+
+        if not self.enumerating:
+            for _ in range(self.repeat_count):
+                yield self.choose_variants({})
+            return
+
+        # the first group is the outermost loop. the variants of inner groups are enumerated again for each outer combination
+        indices = [i for i, group in enumerate(self.groups) if group[0]]
+
+        def product(level: int, values: Dict[int, str]):
+            if level == len(indices):
+                yield self.choose_variants(values)
+                return
+            _, variants, count_range, separator = self.groups[indices[level]]
+            for value in self.enumerate_variants(variants, count_range, separator):
+                values[indices[level]] = value
+                yield from product(level + 1, values)
+
+        if self.get_num_enumerated() == 1:
+            # only one prompt: repeat the same prompt as before
+            prompt = next(product(0, {}))
+            for _ in range(self.repeat_count):
+                yield prompt
+            return
+
+        yield from product(0, {})
+
+
+# endregion
+
+
+# region text embedding cache
+
+
+class TextEmbeddingCache:
+    r"""
+    LRU cache of text encoder outputs per token sequence, for repeated prompts and negative prompts in generation.
+
+    Outputs are cached per row of the token tensor, keyed by the text encoder, the padded token ids, `key` (clip_skip etc.)
+    and `state`. Set `state` to something which changes the text encoder outputs, such as multipliers of LoRA for text encoder.
+    The cache must be cleared if the weights of the text encoder are changed.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        # key -> (whether encode_fn returns a tuple, outputs)
+        self.entries: "OrderedDict[Any, Tuple[bool, Tuple[Optional[torch.Tensor], ...]]]" = OrderedDict()
+        self.state = None
+        self.hits = 0
+        self.misses = 0
+
+    def set_state(self, state):
+        self.state = state
+
+    def clear(self):
+        self.entries.clear()
+
+    def encode(self, text_encoder, text_input: torch.Tensor, encode_fn: Callable, *key):
+        # encode_fn(text_input) returns a tensor or a tuple of tensors (or None), the first dim is batch
+        keys = [(id(text_encoder), self.state, key, tuple(row)) for row in text_input.tolist()]
+
+        missing = []  # indices of unique missing rows
+        missing_keys = set()
+        for i, k in enumerate(keys):
+            if k in self.entries:
+                self.entries.move_to_end(k)
+                self.hits += 1
+            elif k in missing_keys:
+                self.hits += 1  # same tokens in the batch
+            else:
+                self.misses += 1
+                missing_keys.add(k)
+                missing.append(i)
+
+        if len(missing) > 0:
+            outputs = encode_fn(text_input[missing])
+            is_tuple = isinstance(outputs, tuple)
+            outputs = outputs if is_tuple else (outputs,)
+            for j, i in enumerate(missing):
+                self.entries[keys[i]] = (is_tuple, tuple(None if o is None else o[j].detach().clone() for o in outputs))
+
+        # stack always creates a new tensor, so the caller can modify the outputs in place
+        entries = [self.entries[k][1] for k in keys]
+        is_tuple = self.entries[keys[0]][0]
+        results = tuple(
+            None if entries[0][p] is None else torch.stack([entry[p] for entry in entries]) for p in range(len(entries[0]))
+        )
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        return results if is_tuple else results[0]
+
+    def get_stats_str(self) -> str:
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total > 0 else 0
+        return f"text embedding cache: {self.hits} hits / {self.misses} misses ({hit_rate:.1f}%), {len(self.entries)} entries"
+
+
+def encode_text_with_cache(cache: Optional[TextEmbeddingCache], text_encoder, text_input: torch.Tensor, encode_fn: Callable, *key):
+    if cache is None:
+        return encode_fn(text_input)
+    return cache.encode(text_encoder, text_input, encode_fn, *key)
+
+
+# endregion
+
+
+# region asynchronous image writer
+
+
+def to_pil_image(image) -> Image.Image:
+    # accepts PIL image, uint8/float ndarray (H,W,C) or tensor (C,H,W) in [-1, 1]
+    if isinstance(image, Image.Image):
+        return image
+    if isinstance(image, torch.Tensor):
+        image = ((image.detach().float().cpu().clamp(-1, 1) + 1) * 127.5).round().to(torch.uint8)
+        image = image.permute(1, 2, 0).numpy()
+    elif image.dtype != np.uint8:
+        image = (np.clip(image, 0, 1) * 255).round().astype(np.uint8)
+    return Image.fromarray(image.squeeze(-1) if image.shape[-1] == 1 else image)
+
+
+def save_image_atomic(image, file_name: str, **save_kwargs):
+    # write to a temporary file and rename it, so that an incomplete file is never left with the final name
+    image = to_pil_image(image)
+    ext = os.path.splitext(file_name)[1].lower()
+    image_format = save_kwargs.pop("format", None) or Image.registered_extensions().get(ext, "PNG")
+    tmp_file_name = file_name + ".tmp"
+    try:
+        image.save(tmp_file_name, format=image_format, **save_kwargs)
+        os.replace(tmp_file_name, file_name)
+    except BaseException:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+        raise
+
+
+class ImageWriter:
+    r"""
+    Converts and saves images in background workers, so that encoding PNG/WebP/JPEG does not block the generation.
+
+    PIL releases the GIL while encoding, so threads are usually enough. With `use_processes`, images are encoded in
+    subprocesses. `num_workers=0` saves images synchronously. The number of pending images is limited by `max_pending`.
+    `close()` waits until all images are saved.
+    """
+
+    def __init__(self, num_workers: int = 2, use_processes: bool = False, max_pending: Optional[int] = None):
+        self.num_workers = num_workers
+        self.executor = None
+        if num_workers > 0:
+            if use_processes:
+                from concurrent.futures import ProcessPoolExecutor
+
+                self.executor = ProcessPoolExecutor(max_workers=num_workers)
+            else:
+                from concurrent.futures import ThreadPoolExecutor
+
+                self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="image_writer")
+        self.pending = threading.BoundedSemaphore(max_pending or num_workers * 4) if num_workers > 0 else None
+        self.futures = set()
+        self.lock = threading.Lock()
+        self.num_saved = 0
+        self.errors = []
+
+    def save(self, image, file_name: str, **save_kwargs):
+        # image: PIL image, ndarray or tensor. the image must not be modified after this call
+        if self.executor is None:
+            save_image_atomic(image, file_name, **save_kwargs)
+            self.num_saved += 1
+            return
+
+        self.pending.acquire()  # wait if too many images are pending
+        future = self.executor.submit(save_image_atomic, image, file_name, **save_kwargs)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(lambda f, file_name=file_name: self._on_done(f, file_name))
+
+    def _on_done(self, future, file_name: str):
+        with self.lock:
+            self.futures.discard(future)
+            if future.cancelled():
+                # exception() raises CancelledError for a cancelled future
+                logging.getLogger(__name__).error(f"saving image is cancelled / 画像の保存がキャンセルされました: {file_name}")
+                self.errors.append((file_name, None))
+            elif future.exception() is not None:
+                logging.getLogger(__name__).error(
+                    f"failed to save image / 画像の保存に失敗しました: {file_name}: {future.exception()}"
+                )
+                self.errors.append((file_name, future.exception()))
+            else:
+                self.num_saved += 1
+        self.pending.release()
+
+    def wait(self):
+        # wait until all pending images are saved
+        with self.lock:
+            futures = list(self.futures)
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass  # logged in callback
+
+    def close(self):
+        if self.executor is not None:
+            self.wait()
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if len(self.errors) > 0:
+            logging.getLogger(__name__).error(
+                f"{len(self.errors)} images could not be saved / {len(self.errors)}枚の画像を保存できませんでした"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+# endregion
+
+
+# region progress journal for preprocessing tools
+
+
+class ProgressJournal:
+    r"""
+    Append-only JSON lines file of the processed files, so that an interrupted run can skip them. A file is identified by its
+    absolute path and modification time, so modified files are processed again. `file_name=None` disables the journal.
+    """
+
+    def __init__(self, file_name: Optional[str]):
+        self.file_name = file_name
+        self.done: Dict[str, int] = {}  # absolute path -> mtime in ns
+        self.file = None
+        if file_name is None:
+            return
+
+        needs_newline = False
+        if os.path.exists(file_name):
+            with open(file_name, "r", encoding="utf-8") as f:
+                for line in f:
+                    needs_newline = not line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # the last line may be incomplete if interrupted
+                    self.done[entry["path"]] = entry["mtime"]
+            logging.getLogger(__name__).info(f"loaded journal / ジャーナルを読み込みました: {file_name}, {len(self.done)} files")
+
+        self.file = open(file_name, "a", encoding="utf-8")
+        if needs_newline:
+            self.file.write("\n")
+
+    def is_done(self, path) -> bool:
+        path = os.path.abspath(path)
+        return path in self.done and self.done[path] == os.stat(path).st_mtime_ns
+
+    def add(self, path):
+        if self.file is None:
+            return
+        path = os.path.abspath(path)
+        self.done[path] = os.stat(path).st_mtime_ns
+        self.file.write(json.dumps({"path": path, "mtime": self.done[path]}, ensure_ascii=False) + "\n")
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+# endregion
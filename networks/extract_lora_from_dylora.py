@@ -3,6 +3,7 @@
 # Thanks to cloneofsimo
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import math
 import os
 import torch
@@ -31,10 +32,11 @@ def save_to_file(file_name, model, metadata):
     if model_util.is_safetensors(file_name):
         save_file(model, file_name, metadata)
     else:
-        torch.save(model, file_name)
+        # torch.save stores whole storage of views, so copy sliced weights
+        torch.save({k: v.clone() if type(v) == torch.Tensor else v for k, v in model.items()}, file_name)
 
 
-def split_lora_model(lora_sd, unit):
+def get_max_rank(lora_sd):
     max_rank = 0
 
     # Extract loaded lora dim and alpha
@@ -43,56 +45,53 @@ def split_lora_model(lora_sd, unit):
             rank = value.size()[0]
             if rank > max_rank:
                 max_rank = rank
-    logger.info(f"Max rank: {max_rank}")
-
-    rank = unit
-    split_models = []
-    new_alpha = None
-    while rank < max_rank:
-        logger.info(f"Splitting rank {rank}")
-        new_sd = {}
-        for key, value in lora_sd.items():
-            if "lora_down" in key:
-                new_sd[key] = value[:rank].contiguous()
-            elif "lora_up" in key:
-                new_sd[key] = value[:, :rank].contiguous()
-            else:
-                # なぜかscaleするとおかしくなる……
-                # this_rank = lora_sd[key.replace("alpha", "lora_down.weight")].size()[0]
-                # scale = math.sqrt(this_rank / rank)  # rank is > unit
-                # logger.info(key, value.size(), this_rank, rank, value, scale)
-                # new_alpha = value * scale  # always same
-                # new_sd[key] = new_alpha
-                new_sd[key] = value
-
-        split_models.append((new_sd, rank, new_alpha))
-        rank += unit
-
-    return max_rank, split_models
+    return max_rank
+
+
+def split_lora_model(lora_sd, rank):
+    # lora_down is sliced by rows, so it is a contiguous view of the loaded weight and needs no copy
+    new_sd = {}
+    for key, value in lora_sd.items():
+        if "lora_down" in key:
+            new_sd[key] = value[:rank]
+        elif "lora_up" in key:
+            new_sd[key] = value[:, :rank].contiguous()
+        else:
+            # なぜかscaleするとおかしくなる……
+            # this_rank = lora_sd[key.replace("alpha", "lora_down.weight")].size()[0]
+            # scale = math.sqrt(this_rank / rank)  # rank is > unit
+            # logger.info(key, value.size(), this_rank, rank, value, scale)
+            # new_alpha = value * scale  # always same
+            # new_sd[key] = new_alpha
+            new_sd[key] = value
+    return new_sd
 
 
 def split(args):
     logger.info("loading Model...")
     lora_sd, metadata = load_state_dict(args.model)
 
-    logger.info("Splitting Model...")
-    original_rank, split_models = split_lora_model(lora_sd, args.unit)
+    original_rank = get_max_rank(lora_sd)
+    logger.info(f"Max rank: {original_rank}")
 
+    if metadata is None:
+        metadata = {}
     comment = metadata.get("ss_training_comment", "")
-    for state_dict, new_rank, new_alpha in split_models:
-        # update metadata
-        if metadata is None:
-            new_metadata = {}
-        else:
-            new_metadata = metadata.copy()
 
+    def split_and_save(new_rank):
+        # the model is loaded once and each rank is sliced from it, so only max_workers split models are in memory
+        logger.info(f"Splitting rank {new_rank}")
+        state_dict = split_lora_model(lora_sd, new_rank)
+
+        # update metadata
+        new_metadata = metadata.copy()
         new_metadata["ss_training_comment"] = f"split from DyLoRA, rank {original_rank} to {new_rank}; {comment}"
         new_metadata["ss_network_dim"] = str(new_rank)
         # new_metadata["ss_network_alpha"] = str(new_alpha.float().numpy())
 
-        model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, metadata)
-        metadata["sshs_model_hash"] = model_hash
-        metadata["sshs_legacy_hash"] = legacy_hash
+        model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, new_metadata)
+        new_metadata["sshs_model_hash"] = model_hash
+        new_metadata["sshs_legacy_hash"] = legacy_hash
 
         filename, ext = os.path.splitext(args.save_to)
         model_file_name = filename + f"-{new_rank:04d}{ext}"
@@ -100,6 +99,12 @@ def split(args):
         logger.info(f"saving model to: {model_file_name}")
         save_to_file(model_file_name, state_dict, new_metadata)
 
+    ranks = list(range(args.unit, original_rank, args.unit))
+    logger.info(f"Splitting Model to ranks: {ranks}")
+    with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+        # list() to raise exceptions in workers
+        list(executor.map(split_and_save, ranks))
+
 
 def setup_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
@@ -117,6 +122,12 @@ def setup_parser() -> argparse.ArgumentParser:
         default=None,
         help="DyLoRA model to resize at to new rank: ckpt or safetensors file / 読み込むDyLoRAモデル、ckptまたはsafetensors",
     )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=4,
+        help="number of ranks to split and save concurrently (default 4) / 同時に分割・保存するrankの数（デフォルト4）",
+    )
 
     return parser
 
@@ -3,15 +3,20 @@
 # Thanks to cloneofsimo!
 
 import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 import json
 import os
 import time
 import torch
+from accelerate import init_empty_weights
+from safetensors import safe_open
 from safetensors.torch import load_file, save_file
 from tqdm import tqdm
-from library import sai_model_spec, model_util, sdxl_model_util
+from transformers import CLIPTextModel
+from library import sai_model_spec, model_util, sdxl_model_util, sdxl_original_unet
+from library.original_unet import UNet2DConditionModel
 import lora
-from library.utils import setup_logging
+from library.utils import setup_logging, SafetensorsStreamWriter
 setup_logging()
 import logging
 logger = logging.getLogger(__name__)
@@ -32,6 +37,302 @@ def save_to_file(file_name, model, state_dict, dtype):
         torch.save(model, file_name)
 
 
+def svd_lora_weights(mat, dim, conv_dim, clamp_quantile, device, work_device, save_dtype):
+    """approximate a weight difference with LoRA up/down weights / 重みの差分をSVDでLoRAのup/downに近似する"""
+    if device:
+        mat = mat.to(device)
+    mat = mat.to(torch.float)  # calc by float
+
+    # if conv_dim is None, diffs do not include LoRAs for conv2d-3x3
+    conv2d = len(mat.size()) == 4
+    kernel_size = None if not conv2d else mat.size()[2:4]
+    conv2d_3x3 = conv2d and kernel_size != (1, 1)
+
+    rank = dim if not conv2d_3x3 or conv_dim is None else conv_dim
+    out_dim, in_dim = mat.size()[0:2]
+
+    if device:
+        mat = mat.to(device)
+
+    # logger.info(lora_name, mat.size(), mat.device, rank, in_dim, out_dim)
+    rank = min(rank, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
+
+    if conv2d:
+        if conv2d_3x3:
+            mat = mat.flatten(start_dim=1)
+        else:
+            mat = mat.squeeze()
+
+    U, S, Vh = torch.linalg.svd(mat)
+
+    U = U[:, :rank]
+    S = S[:rank]
+    U = U @ torch.diag(S)
+
+    Vh = Vh[:rank, :]
+
+    dist = torch.cat([U.flatten(), Vh.flatten()])
+    hi_val = torch.quantile(dist, clamp_quantile)
+    low_val = -hi_val
+
+    U = U.clamp(low_val, hi_val)
+    Vh = Vh.clamp(low_val, hi_val)
+
+    if conv2d:
+        U = U.reshape(out_dim, rank, 1, 1)
+        Vh = Vh.reshape(rank, in_dim, kernel_size[0], kernel_size[1])
+
+    U = U.to(work_device, dtype=save_dtype).contiguous()
+    Vh = Vh.to(work_device, dtype=save_dtype).contiguous()
+
+    return U, Vh
+
+
+def build_metadata(save_to, v2, v_parameterization, sdxl, dim, conv_dim, model_version, no_metadata):
+    # minimum metadata
+    net_kwargs = {}
+    if conv_dim is not None:
+        net_kwargs["conv_dim"] = str(conv_dim)
+        net_kwargs["conv_alpha"] = str(float(conv_dim))
+
+    metadata = {
+        "ss_v2": str(v2),
+        "ss_base_model_version": model_version,
+        "ss_network_module": "networks.lora",
+        "ss_network_dim": str(dim),
+        "ss_network_alpha": str(float(dim)),
+        "ss_network_args": json.dumps(net_kwargs),
+    }
+
+    if not no_metadata:
+        title = os.path.splitext(os.path.basename(save_to))[0]
+        sai_metadata = sai_model_spec.build_metadata(None, v2, v_parameterization, sdxl, True, False, time.time(), title=title)
+        metadata.update(sai_metadata)
+
+    return metadata
+
+
+# region streaming extraction
+
+
+def build_lora_targets(v2, sdxl, dim, conv_dim):
+    """
+    create LoRA network on models with empty weights and resolve the checkpoint key of each target weight.
+    returns list of (lora_name, checkpoint key, chunk index of in_proj or None, weight shape, is text encoder)
+    重みを確保しないモデルでLoRAを作成し、各モジュールの重みのcheckpoint上のキーを求める
+    """
+    if not sdxl:
+        unet_config = model_util.create_unet_diffusers_config(v2, True)  # same as load_models_from_stable_diffusion_checkpoint
+        with init_empty_weights():
+            text_encoder = CLIPTextModel._from_config(model_util.create_clip_text_config(v2))
+            unet = UNet2DConditionModel(**unet_config)
+        text_encoders = [text_encoder]
+
+        # Diffusers U-Net key -> SD U-Net key
+        unet_keys = {k: k for k in unet.state_dict().keys()}
+        unet_key_map = {hf: sd for sd, hf in model_util.convert_unet_state_dict_to_sd(False, unet_keys).items()}
+    else:
+        text_encoder1, text_encoder2 = sdxl_model_util.create_empty_text_encoders()
+        with init_empty_weights():
+            unet = sdxl_original_unet.SdxlUNet2DConditionModel()
+        text_encoders = [text_encoder1, text_encoder2]
+        unet_key_map = None
+
+    def resolve_in_proj(key, prefix):
+        # q/k/v of open clip are stored as one in_proj weight
+        for i, proj in enumerate(["q_proj", "k_proj", "v_proj"]):
+            if f".self_attn.{proj}." in key:
+                key = key.replace("text_model.encoder.layers.", "transformer.resblocks.")
+                key = key.replace(f".self_attn.{proj}.weight", ".attn.in_proj_weight")
+                return prefix + key, i
+        return None
+
+    def resolve_text_encoder_key(te_index, key):
+        if sdxl and te_index == 0:
+            return "conditioner.embedders.0.transformer." + key, None
+        if sdxl:
+            prefix = "conditioner.embedders.1.model."
+            converter = lambda sd: sdxl_model_util.convert_text_encoder_2_state_dict_to_sdxl(sd, None)
+        elif v2:
+            prefix = "cond_stage_model.model."
+            converter = model_util.convert_text_encoder_state_dict_to_sd_v2
+        else:
+            return "cond_stage_model.transformer." + key, None
+
+        resolved = resolve_in_proj(key, prefix)
+        if resolved is not None:
+            return resolved
+        return prefix + list(converter({key: None}).keys())[0], None
+
+    def resolve_unet_key(key):
+        if unet_key_map is not None:
+            key = unet_key_map[key]
+        return "model.diffusion_model." + key, None
+
+    kwargs = {} if conv_dim is None else {"conv_dim": conv_dim, "conv_alpha": conv_dim}
+    lora_network = lora.create_network(1.0, dim, dim, None, text_encoders, unet, **kwargs)
+
+    targets = []
+    for te_index, text_encoder in enumerate(text_encoders):
+        module_names = {id(module): name for name, module in text_encoder.named_modules()}
+        for lora_module in lora_network.text_encoder_loras:
+            name = module_names.get(id(lora_module.org_module))
+            if name is None:
+                continue  # other text encoder
+            key, chunk = resolve_text_encoder_key(te_index, name + ".weight")
+            targets.append((lora_module.lora_name, key, chunk, tuple(lora_module.org_module.weight.shape), True))
+
+    module_names = {id(module): name for name, module in unet.named_modules()}
+    for lora_module in lora_network.unet_loras:
+        key, chunk = resolve_unet_key(module_names[id(lora_module.org_module)] + ".weight")
+        targets.append((lora_module.lora_name, key, chunk, tuple(lora_module.org_module.weight.shape), False))
+
+    return targets
+
+
+def load_target_weight(f, keys, key, chunk, dtype):
+    if key not in keys:
+        # text encoder in old format, without "text_model."
+        key = key.replace("cond_stage_model.transformer.text_model.", "cond_stage_model.transformer.")
+    assert key in keys, f"weight not found in checkpoint / checkpointに重みが見つかりません: {key}"
+
+    if chunk is None:
+        weight = f.get_tensor(key)
+    else:
+        weight_slice = f.get_slice(key)
+        rows = weight_slice.get_shape()[0] // 3
+        weight = weight_slice[chunk * rows : (chunk + 1) * rows]
+
+    if dtype is not None:
+        weight = weight.to(dtype)
+    return weight
+
+
+def svd_streaming(
+    model_org,
+    model_tuned,
+    save_to,
+    dim,
+    v2,
+    sdxl,
+    conv_dim,
+    v_parameterization,
+    device,
+    save_dtype,
+    load_dtype,
+    clamp_quantile,
+    min_diff,
+    no_metadata,
+    num_workers,
+):
+    """
+    read the weights of the two models pairwise from safetensors files, compute SVD per layer in a worker pool and write
+    the results to the output file as soon as they are computed. Memory usage is proportional to the number of in-flight layers.
+    二つのモデルの重みをsafetensorsから一層ずつ読み込み、ワーカーでSVDを計算して順次書き出す。メモリ使用量は処理中の層数に比例する
+    """
+    for file_name in [model_org, model_tuned, save_to]:
+        assert model_util.is_safetensors(
+            file_name
+        ), f"streaming extraction supports safetensors only / ストリーミング抽出はsafetensorsのみ対応しています: {file_name}"
+
+    work_device = "cpu"
+    model_version = (
+        sdxl_model_util.MODEL_VERSION_SDXL_BASE_V1_0 if sdxl else model_util.get_model_version_str_for_sd1_sd2(v2, v_parameterization)
+    )
+
+    logger.info("resolving LoRA target weights")
+    targets = build_lora_targets(v2, sdxl, dim, conv_dim)
+    te_targets = [t for t in targets if t[4]]
+    unet_targets = [t for t in targets if not t[4]]
+
+    def calculate_diff(target, weight_o, weight_t):
+        shape = target[3]
+        return (weight_t.to(work_device) - weight_o.to(work_device)).reshape(shape)  # reshape for conv <-> linear projection
+
+    def calculate_max_diff(target, weight_o, weight_t):
+        with torch.no_grad():
+            diff = calculate_diff(target, weight_o, weight_t)
+            return (torch.max(torch.abs(diff)).item(),)
+
+    def extract(target, weight_o, weight_t):
+        with torch.no_grad():
+            diff = calculate_diff(target, weight_o, weight_t)
+            up_weight, down_weight = svd_lora_weights(diff, dim, conv_dim, clamp_quantile, device, work_device, save_dtype)
+        return target[0], up_weight, down_weight
+
+    with safe_open(model_org, framework="pt") as f_o, safe_open(model_tuned, framework="pt") as f_t:
+        keys_o = set(f_o.keys())
+        keys_t = set(f_t.keys())
+
+        def run(targets, func, callback):
+            # read weights in this thread and keep at most num_workers * 2 layers in flight
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = set()
+                for target in tqdm(targets):
+                    _, key, chunk, _, _ = target
+                    weight_o = load_target_weight(f_o, keys_o, key, chunk, load_dtype)
+                    weight_t = load_target_weight(f_t, keys_t, key, chunk, load_dtype)
+                    futures.add(executor.submit(func, target, weight_o, weight_t))
+
+                    if len(futures) >= num_workers * 2:
+                        done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            callback(*future.result())
+                for future in as_completed(futures):
+                    callback(*future.result())
+
+        # check the difference of the text encoder before svd, same as the non-streaming mode. the text encoder is usually same
+        # (SDXL, fine-tuning U-Net only), then svd for the text encoder is skipped. reading its weights twice is cheap
+        logger.info("checking the difference of text encoder")
+        te_max_diffs = []
+        run(te_targets, calculate_max_diff, te_max_diffs.append)
+
+        max_te_diff = max(te_max_diffs, default=0.0)
+        if max_te_diff > min_diff:
+            logger.info(f"Text encoder is different. {max_te_diff} > {min_diff}")
+        else:
+            logger.warning("Text encoder is same. Extract U-Net only.")
+            te_targets = []
+
+        # header of the output file can be written now, because the shape of each LoRA weight is fixed
+        save_or_float_dtype = save_dtype if save_dtype is not None else torch.float
+        tensor_specs = {}
+        for lora_name, _, _, shape, _ in te_targets + unet_targets:
+            conv2d = len(shape) == 4
+            conv2d_3x3 = conv2d and shape[2:4] != (1, 1)
+            out_dim, in_dim = shape[0:2]
+            rank = dim if not conv2d_3x3 or conv_dim is None else conv_dim
+            rank = min(rank, in_dim, out_dim)
+            tensor_specs[lora_name + ".lora_up.weight"] = (save_or_float_dtype, (out_dim, rank) + ((1, 1) if conv2d else ()))
+            tensor_specs[lora_name + ".lora_down.weight"] = (save_or_float_dtype, (rank, in_dim) + tuple(shape[2:4]))
+            tensor_specs[lora_name + ".alpha"] = (save_or_float_dtype, ())
+
+        dir_name = os.path.dirname(save_to)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name, exist_ok=True)
+
+        metadata = build_metadata(save_to, v2, v_parameterization, sdxl, dim, conv_dim, model_version, no_metadata)
+
+        with SafetensorsStreamWriter(save_to, tensor_specs, metadata) as writer:
+
+            def write(lora_name, up_weight, down_weight):
+                writer.write(lora_name + ".lora_up.weight", up_weight)
+                writer.write(lora_name + ".lora_down.weight", down_weight)
+                writer.write(lora_name + ".alpha", torch.tensor(down_weight.size()[0], dtype=save_or_float_dtype))
+
+            if len(te_targets) > 0:
+                logger.info("calculating text encoder LoRA by svd")
+                run(te_targets, extract, write)
+
+            logger.info("calculating U-Net LoRA by svd")
+            run(unet_targets, extract, write)
+
+    logger.info(f"LoRA weights are saved to: {save_to}")
+
+
+# endregion
+
+
 def svd(
     model_org=None,
     model_tuned=None,
@@ -49,6 +350,8 @@ def svd(
     load_precision=None,
     load_original_model_to=None,
     load_tuned_model_to=None,
+    streaming=False,
+    num_workers=1,
 ):
     def str_to_dtype(p):
         if p == "float":
@@ -67,6 +370,26 @@ def svd(
     save_dtype = str_to_dtype(save_precision)
     work_device = "cpu"
 
+    if streaming:
+        svd_streaming(
+            model_org,
+            model_tuned,
+            save_to,
+            dim,
+            v2,
+            sdxl,
+            conv_dim,
+            v_parameterization,
+            device,
+            save_dtype,
+            load_dtype,
+            clamp_quantile,
+            min_diff,
+            no_metadata,
+            num_workers,
+        )
+        return
+
     # load models
     if not sdxl:
         logger.info(f"loading original SD model : {model_org}")
@@ -173,53 +496,7 @@ def svd(
     lora_weights = {}
     with torch.no_grad():
         for lora_name, mat in tqdm(list(diffs.items())):
-            if args.device:
-                mat = mat.to(args.device)
-            mat = mat.to(torch.float)  # calc by float
-
-            # if conv_dim is None, diffs do not include LoRAs for conv2d-3x3
-            conv2d = len(mat.size()) == 4
-            kernel_size = None if not conv2d else mat.size()[2:4]
-            conv2d_3x3 = conv2d and kernel_size != (1, 1)
-
-            rank = dim if not conv2d_3x3 or conv_dim is None else conv_dim
-            out_dim, in_dim = mat.size()[0:2]
-
-            if device:
-                mat = mat.to(device)
-
-            # logger.info(lora_name, mat.size(), mat.device, rank, in_dim, out_dim)
-            rank = min(rank, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
-
-            if conv2d:
-                if conv2d_3x3:
-                    mat = mat.flatten(start_dim=1)
-                else:
-                    mat = mat.squeeze()
-
-            U, S, Vh = torch.linalg.svd(mat)
-
-            U = U[:, :rank]
-            S = S[:rank]
-            U = U @ torch.diag(S)
-
-            Vh = Vh[:rank, :]
-
-            dist = torch.cat([U.flatten(), Vh.flatten()])
-            hi_val = torch.quantile(dist, clamp_quantile)
-            low_val = -hi_val
-
-            U = U.clamp(low_val, hi_val)
-            Vh = Vh.clamp(low_val, hi_val)
-
-            if conv2d:
-                U = U.reshape(out_dim, rank, 1, 1)
-                Vh = Vh.reshape(rank, in_dim, kernel_size[0], kernel_size[1])
-
-            U = U.to(work_device, dtype=save_dtype).contiguous()
-            Vh = Vh.to(work_device, dtype=save_dtype).contiguous()
-
-            lora_weights[lora_name] = (U, Vh)
+            lora_weights[lora_name] = svd_lora_weights(mat, dim, conv_dim, clamp_quantile, device, work_device, save_dtype)
 
     # make state dict for LoRA
     lora_sd = {}
@@ -239,25 +516,7 @@ def svd(
     if dir_name and not os.path.exists(dir_name):
         os.makedirs(dir_name, exist_ok=True)
 
-    # minimum metadata
-    net_kwargs = {}
-    if conv_dim is not None:
-        net_kwargs["conv_dim"] = str(conv_dim)
-        net_kwargs["conv_alpha"] = str(float(conv_dim))
-
-    metadata = {
-        "ss_v2": str(v2),
-        "ss_base_model_version": model_version,
-        "ss_network_module": "networks.lora",
-        "ss_network_dim": str(dim),
-        "ss_network_alpha": str(float(dim)),
-        "ss_network_args": json.dumps(net_kwargs),
-    }
-
-    if not no_metadata:
-        title = os.path.splitext(os.path.basename(save_to))[0]
-        sai_metadata = sai_model_spec.build_metadata(None, v2, v_parameterization, sdxl, True, False, time.time(), title=title)
-        metadata.update(sai_metadata)
+    metadata = build_metadata(save_to, v2, v_parameterization, sdxl, dim, conv_dim, model_version, no_metadata)
 
     lora_network_save.save_weights(save_to, save_dtype, metadata)
     logger.info(f"LoRA weights are saved to: {save_to}")
@@ -350,6 +609,19 @@ def setup_parser() -> argparse.ArgumentParser:
         help="location to load tuned model, cpu or cuda, cuda:0, etc, default is cpu, only for SDXL / 派生モデル読み込み先、cpuまたはcuda、cuda:0など、省略時はcpu、SDXLのみ有効",
     )
 
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="read weights layer by layer from safetensors files and write LoRA incrementally instead of loading both models, "
+        + "sshs hashes are not saved in this mode / 両モデルを読み込まずにsafetensorsから一層ずつ読み込み順次書き出す。このモードではsshsハッシュは保存されない",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="number of workers to compute SVD in streaming mode (default 1) / ストリーミング時にSVDを計算するワーカー数（デフォルト1）",
+    )
+
     return parser
 
 
@@ -240,23 +240,21 @@ class LoRAInfModule(LoRAModule):
             return self.sub_prompt_forward(x)
 
     def get_mask_for_x(self, x):
-        # calculate size from shape of x
+        # masks are precomputed for each resolution in set_current_generation, both for 4d (b,c,h,w) and 3d (b,h*w,c) x
         if len(x.size()) == 4:
             h, w = x.size()[2:4]
             area = h * w
         else:
             area = x.size()[1]
 
-        mask = self.network.mask_dic.get(area, None)
-        if mask is None or len(x.size()) == 2:
+        masks = self.network.mask_dic.get(area, None)
+        if masks is None or len(x.size()) == 2:
             # emb_layers in SDXL doesn't have mask
             # if "emb" not in self.lora_name:
             #     print(f"mask is None for resolution {self.lora_name}, {area}, {x.size()}")
             mask_size = (1, x.size()[1]) if len(x.size()) == 2 else (1, *x.size()[1:-1], 1)
-            return torch.ones(mask_size, dtype=x.dtype, device=x.device) / self.network.num_sub_prompts
-        if len(x.size()) == 3:
-            mask = torch.reshape(mask, (1, -1, 1))
-        return mask
+            return self.network.get_uniform_mask(mask_size, x.dtype, x.device)
+        return masks[0] if len(x.size()) == 4 else masks[1]
 
     def regional_forward(self, x):
         if "attn2_to_out" in self.lora_name:
@@ -284,20 +282,13 @@ class LoRAInfModule(LoRAModule):
     def postp_to_q(self, x):
         # repeat x to num_sub_prompts
         has_real_uncond = x.size()[0] // self.network.batch_size == 3
-        qc = self.network.batch_size  # uncond
-        qc += self.network.batch_size * self.network.num_sub_prompts  # cond
-        if has_real_uncond:
-            qc += self.network.batch_size  # real_uncond
-
-        query = torch.zeros((qc, x.size()[1], x.size()[2]), device=x.device, dtype=x.dtype)
-        query[: self.network.batch_size] = x[: self.network.batch_size]
-
-        for i in range(self.network.batch_size):
-            qi = self.network.batch_size + i * self.network.num_sub_prompts
-            query[qi : qi + self.network.num_sub_prompts] = x[self.network.batch_size + i]
 
+        # uncond, cond repeated for each sub prompt, real_uncond
+        batch_size = self.network.batch_size
+        queries = [x[:batch_size], x[batch_size : batch_size * 2].repeat_interleave(self.network.num_sub_prompts, dim=0)]
         if has_real_uncond:
-            query[-self.network.batch_size :] = x[-self.network.batch_size :]
+            queries.append(x[-batch_size:])
+        query = torch.cat(queries)
 
         # logger.info(f"postp_to_q {self.lora_name} {x.size()} {query.size()} {self.network.num_sub_prompts}")
         return query
@@ -352,35 +343,30 @@ class LoRAInfModule(LoRAModule):
         lx, masks = self.network.shared.pop(self.lora_name)
 
         # if last network, combine separated x with mask weighted sum
-        has_real_uncond = x.size()[0] // self.network.batch_size == self.network.num_sub_prompts + 2
-
-        out = torch.zeros((self.network.batch_size * (3 if has_real_uncond else 2), *x.size()[1:]), device=x.device, dtype=x.dtype)
-        out[: self.network.batch_size] = x[: self.network.batch_size]  # uncond
+        batch_size = self.network.batch_size
+        num_sub_prompts = self.network.num_sub_prompts
+        has_real_uncond = x.size()[0] // batch_size == num_sub_prompts + 2
+
+        # stacked masks of all sub prompts are same for all to_out in the same resolution
+        key = (x.size()[1], x.dtype)
+        stacked = self.network.stacked_masks.get(key, None)
+        if stacked is None:
+            # if num_sub_prompts > num of LoRAs, fill with zero
+            masks = [torch.zeros_like(masks[0]) if m is None else m for m in masks]
+            mask = torch.cat(masks).unsqueeze(0)  # 1,num_sub_prompts,...
+            stacked = (mask, torch.sum(mask, dim=1) + 1e-4)
+            self.network.stacked_masks[key] = stacked
+        mask, mask_sum = stacked
+
+        # weighted sum of all images and sub prompts at once
+        x_cond = x[batch_size : batch_size * (num_sub_prompts + 1)].reshape(batch_size, num_sub_prompts, *x.size()[1:])
+        lx = lx.reshape(batch_size, num_sub_prompts, *lx.size()[1:])
+        cond = torch.sum(x_cond * mask, dim=1) / mask_sum + torch.sum(lx * mask, dim=1)
+
+        outs = [x[:batch_size], cond]  # uncond, cond
         if has_real_uncond:
-            out[-self.network.batch_size :] = x[-self.network.batch_size :]  # real_uncond
-
-        # logger.info(f"to_out_forward {self.lora_name} {self.network.sub_prompt_index} {self.network.num_sub_prompts}")
-        # if num_sub_prompts > num of LoRAs, fill with zero
-        for i in range(len(masks)):
-            if masks[i] is None:
-                masks[i] = torch.zeros_like(masks[0])
-
-        mask = torch.cat(masks)
-        mask_sum = torch.sum(mask, dim=0) + 1e-4
-        for i in range(self.network.batch_size):
-            # 1枚の画像ごとに処理する
-            lx1 = lx[i * self.network.num_sub_prompts : (i + 1) * self.network.num_sub_prompts]
-            lx1 = lx1 * mask
-            lx1 = torch.sum(lx1, dim=0)
-
-            xi = self.network.batch_size + i * self.network.num_sub_prompts
-            x1 = x[xi : xi + self.network.num_sub_prompts]
-            x1 = x1 * mask
-            x1 = torch.sum(x1, dim=0)
-            x1 = x1 / mask_sum
-
-            x1 = x1 + lx1
-            out[self.network.batch_size + i] = x1
+            outs.append(x[-batch_size:])  # real_uncond
+        out = torch.cat(outs)
 
         # logger.info(f"to_out_forward {x.size()} {out.size()} {has_real_uncond}")
         return out
@@ -1287,6 +1273,9 @@ class LoRANetwork(torch.nn.Module):
         self.mask = mask
         self.sub_prompt_index = sub_prompt_index
         self.is_last_network = is_last_network
+        self.mask_cache = {}  # (height, width, ds_ratio, dtype, device) -> mask_dic
+        self.uniform_masks = {}
+        self.stacked_masks = {}
 
         for lora in self.text_encoder_loras + self.unet_loras:
             lora.set_network(self)
@@ -1296,20 +1285,26 @@ class LoRANetwork(torch.nn.Module):
         self.num_sub_prompts = num_sub_prompts
         self.current_size = (height, width)
         self.shared = shared
+        self.stacked_masks = {}  # depends on masks of other networks, so created for each generation
 
-        # create masks
-        mask = self.mask
-        mask_dic = {}
-        mask = mask.unsqueeze(0).unsqueeze(1)  # b(1),c(1),h,w
+        # create masks for each resolution once, and reuse them for the same size
         ref_weight = self.text_encoder_loras[0].lora_down.weight if self.text_encoder_loras else self.unet_loras[0].lora_down.weight
         dtype = ref_weight.dtype
         device = ref_weight.device
+        key = (height, width, ds_ratio, dtype, device)
+        if key in self.mask_cache:
+            self.mask_dic = self.mask_cache[key]
+            return
+
+        mask = self.mask
+        mask_dic = {}
+        mask = mask.unsqueeze(0).unsqueeze(1)  # b(1),c(1),h,w
 
         def resize_add(mh, mw):
             # logger.info(mh, mw, mh * mw)
             m = torch.nn.functional.interpolate(mask, (mh, mw), mode="bilinear")  # doesn't work in bf16
             m = m.to(device, dtype=dtype)
-            mask_dic[mh * mw] = m
+            mask_dic[mh * mw] = (m, m.reshape(1, -1, 1))  # for 4d and 3d x
 
         h = height // 8
         w = width // 8
@@ -1328,6 +1323,16 @@ class LoRANetwork(torch.nn.Module):
             w = (w + 1) // 2
 
         self.mask_dic = mask_dic
+        self.mask_cache[key] = mask_dic
+
+    def get_uniform_mask(self, size, dtype, device):
+        # mask for the layers without region, e.g. emb_layers in SDXL
+        key = (size, dtype, device, self.num_sub_prompts)
+        mask = self.uniform_masks.get(key, None)
+        if mask is None:
+            mask = torch.ones(size, dtype=dtype, device=device) / self.num_sub_prompts
+            self.uniform_masks[key] = mask
+        return mask
 
     def backup_weights(self):
         # 重みのバックアップを行う
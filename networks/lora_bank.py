@@ -0,0 +1,185 @@
+# LoRA weight bank for generation: switches LoRAs merged to the model weights between batches
+# the delta weight (up @ down * scale) of each module is calculated once per LoRA and kept in memory (LRU), optionally cached
+# to disk in the target dtype. switching LoRAs costs only a copy and an add per module, instead of loading and merging again.
+
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from safetensors.torch import load_file, save_file
+
+from library.sdxl_original_unet import SdxlUNet2DConditionModel
+from library.utils import setup_logging
+from networks.lora import LoRAInfModule, LoRANetwork, create_network_from_weights
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LoRABank:
+    r"""
+    Keeps the delta weights of LoRAs (multiplier 1.0) and merges them to the original modules in place with `apply`.
+
+    The weights before applying are backed up on the first change of each module and restored when the module is not used
+    by the current LoRAs, same as `backup_weights` / `restore_weights` of LoRANetwork. LoRAs merged to the model before
+    creating the bank (--network_merge) are kept.
+    """
+
+    def __init__(
+        self,
+        text_encoders: List[torch.nn.Module],
+        unet: torch.nn.Module,
+        dtype: torch.dtype,
+        device: torch.device,
+        cache_dir: Optional[str] = None,
+        max_loras: int = 4,
+        store_device: Optional[torch.device] = None,
+    ):
+        self.text_encoders = text_encoders
+        self.unet = unet
+        self.dtype = dtype
+        self.device = device
+        self.cache_dir = cache_dir
+        self.max_loras = max_loras
+        self.store_device = store_device or torch.device("cpu")  # device of the deltas in memory
+
+        self.deltas: "OrderedDict[str, Dict[str, torch.Tensor]]" = OrderedDict()  # LoRA file -> lora name -> delta
+        self.modules: Dict[str, torch.nn.Module] = {}  # lora name -> original Linear/Conv2d
+        self.org_weights: Dict[str, torch.Tensor] = {}  # lora name -> weight before applying
+        self.current: Tuple[Tuple[str, float], ...] = ()  # ((path, multiplier), ...)
+        self.applied_names = set()
+
+        self.switch_times: List[float] = []
+        self.num_calculated = 0
+        self.num_disk_loaded = 0
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get_cache_file(self, path: str) -> str:
+        # the deltas depend on the LoRA file and dtype only, not on the model weights
+        stat = os.stat(path)
+        key = f"{os.path.abspath(path)}:{stat.st_mtime}:{stat.st_size}:{self.dtype}"
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{os.path.splitext(os.path.basename(path))[0]}_{digest}.safetensors")
+
+    def find_modules(self, names):
+        # create a small network only to find the original modules by the lora names
+        names = [name for name in names if name not in self.modules]
+        if len(names) == 0:
+            return
+        network = LoRANetwork(
+            self.text_encoders,
+            self.unet,
+            modules_dim={name: 1 for name in names},
+            modules_alpha={name: 1 for name in names},
+            module_class=LoRAInfModule,
+            is_sdxl=isinstance(self.unet, SdxlUNet2DConditionModel),
+        )
+        for lora in network.text_encoder_loras + network.unet_loras:
+            self.modules[lora.lora_name] = lora.org_module_ref[0]
+
+        missing = [name for name in names if name not in self.modules]
+        if len(missing) > 0:
+            raise ValueError(f"LoRA modules not found in the model / モデルにLoRAのモジュールがありません: {missing[:5]}")
+
+    def calculate_deltas(self, path: str) -> Dict[str, torch.Tensor]:
+        network, weights_sd = create_network_from_weights(1.0, path, None, self.text_encoders, self.unet, for_inference=True)
+
+        deltas = {}
+        with torch.no_grad():
+            for lora in network.text_encoder_loras + network.unet_loras:
+                # the LoRA modules are registered to the network in `apply_to`, so load the weights to each module like
+                # `merge_to`. move the LoRA weights only: `.to()` of the module also converts the original module in place
+                org_module = lora.org_module_ref[0]
+                org_dtype = org_module.weight.dtype
+                prefix = lora.lora_name + "."
+                sd_for_lora = {key[len(prefix) :]: value for key, value in weights_sd.items() if key.startswith(prefix)}
+                lora.load_state_dict(sd_for_lora, False)
+                lora.lora_up.to(self.device)
+                lora.lora_down.to(self.device)
+                self.modules[lora.lora_name] = org_module
+                deltas[lora.lora_name] = lora.get_weight().to(self.store_device, dtype=self.dtype).contiguous()
+                assert org_module.weight.dtype == org_dtype, f"dtype of {lora.lora_name} is changed: {org_module.weight.dtype}"
+        return deltas
+
+    def load(self, path: str) -> Dict[str, torch.Tensor]:
+        if path in self.deltas:
+            self.deltas.move_to_end(path)
+            return self.deltas[path]
+
+        cache_file = self.get_cache_file(path) if self.cache_dir is not None else None
+        if cache_file is not None and os.path.exists(cache_file):
+            deltas = load_file(cache_file, device=str(self.store_device))
+            self.find_modules(deltas.keys())
+            self.num_disk_loaded += 1
+        else:
+            deltas = self.calculate_deltas(path)
+            self.num_calculated += 1
+            if cache_file is not None:
+                tmp_file = cache_file + ".tmp"
+                save_file(deltas, tmp_file)
+                os.replace(tmp_file, cache_file)
+
+        self.deltas[path] = deltas
+        while len(self.deltas) > self.max_loras:
+            self.deltas.popitem(last=False)
+        return deltas
+
+    def apply(self, loras: Tuple[Tuple[str, float], ...]) -> float:
+        r"""
+        Merges `loras` ((path, multiplier), ...) to the model weights in place, replacing the previous LoRAs of the bank.
+        Returns the seconds taken.
+        """
+        start_time = time.perf_counter()
+        deltas_and_muls = [(self.load(path), multiplier) for path, multiplier in loras]
+        load_time = time.perf_counter() - start_time
+
+        names = set()
+        for deltas, _ in deltas_and_muls:
+            names.update(deltas.keys())
+
+        # if failed in the middle, the next call restores all modules
+        self.applied_names = self.applied_names | names
+        self.current = None
+
+        with torch.no_grad():
+            for name in self.applied_names:
+                weight = self.modules[name].weight
+                if name not in self.org_weights:
+                    self.org_weights[name] = weight.detach().clone()
+                weight.copy_(self.org_weights[name])
+
+                if name not in names:
+                    del self.org_weights[name]  # restored
+                    continue
+                for deltas, multiplier in deltas_and_muls:
+                    if name in deltas:
+                        weight.add_(deltas[name].to(weight.device, dtype=weight.dtype), alpha=multiplier)
+
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        self.applied_names = names
+        self.current = tuple(loras)
+
+        elapsed = time.perf_counter() - start_time
+        self.switch_times.append(elapsed)
+        logger.info(
+            f"switch LoRAs / LoRAを切り替えました: {len(loras)} LoRAs, {len(names)} modules,"
+            + f" {elapsed:.3f} sec (load {load_time:.3f} sec)"
+        )
+        return elapsed
+
+    def get_stats_str(self) -> str:
+        if len(self.switch_times) == 0:
+            return "LoRA bank: no switches"
+        mean = sum(self.switch_times) / len(self.switch_times)
+        return (
+            f"LoRA bank: {len(self.switch_times)} switches, mean {mean:.3f} sec, max {max(self.switch_times):.3f} sec,"
+            + f" calculated {self.num_calculated} LoRAs, loaded {self.num_disk_loaded} LoRAs from cache"
+        )
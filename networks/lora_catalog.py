@@ -0,0 +1,279 @@
+# scan LoRA files and build a queryable index (JSON or SQLite) from safetensors headers
+# tensors are not loaded: dims, dtypes and metadata come from the header, alphas are read as a few bytes from the file.
+# norms of the delta weights are computed only with --norms, through mmap
+
+import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, List, Optional
+
+import torch
+from safetensors import safe_open
+from tqdm import tqdm
+
+from library.utils import setup_logging, load_safetensors_header, SAFETENSORS_DTYPES
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+TORCH_DTYPES = {v: k for k, v in SAFETENSORS_DTYPES.items()}
+
+DOWN_SUFFIXES = [".lora_down.weight", ".lora_A.weight"]
+UP_SUFFIXES = {".lora_down.weight": ".lora_up.weight", ".lora_A.weight": ".lora_B.weight"}
+
+# columns of the SQLite index. list/dict values are stored as JSON text
+COLUMNS = [
+    ("path", "TEXT PRIMARY KEY"),
+    ("mtime", "REAL"),
+    ("size", "INTEGER"),
+    ("network_module", "TEXT"),
+    ("base_model_version", "TEXT"),
+    ("title", "TEXT"),
+    ("num_modules", "INTEGER"),
+    ("num_params", "INTEGER"),
+    ("has_text_encoder", "INTEGER"),
+    ("dims", "TEXT"),
+    ("alphas", "TEXT"),
+    ("dtypes", "TEXT"),
+    ("norm_mean", "REAL"),
+    ("norm_max", "REAL"),
+    ("metadata", "TEXT"),
+    ("error", "TEXT"),
+]
+JSON_COLUMNS = ["dims", "alphas", "dtypes", "metadata"]
+
+
+def find_model_files(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, file_names in os.walk(path):
+                files += [os.path.join(root, f) for f in file_names if f.lower().endswith(".safetensors")]
+        elif path.lower().endswith(".safetensors"):
+            files.append(path)
+        else:
+            logger.warning(f"only safetensors is supported, skip / safetensorsのみ対応しています: {path}")
+    return sorted(set(os.path.abspath(f) for f in files))
+
+
+def get_lora_modules(tensor_infos: Dict[str, dict]) -> Dict[str, str]:
+    # module name -> suffix of down weight
+    modules = {}
+    for key in tensor_infos.keys():
+        for suffix in DOWN_SUFFIXES:
+            if key.endswith(suffix):
+                modules[key[: -len(suffix)]] = suffix
+    return modules
+
+
+def read_scalars(file_name: str, data_start: int, tensor_infos: Dict[str, dict], keys: List[str]) -> Dict[str, float]:
+    # read only the bytes of small tensors such as alpha
+    values = {}
+    with open(file_name, "rb") as f:
+        for key in keys:
+            info = tensor_infos[key]
+            begin, end = info["data_offsets"]
+            f.seek(data_start + begin)
+            data = bytearray(f.read(end - begin))
+            values[key] = torch.frombuffer(data, dtype=TORCH_DTYPES[info["dtype"]]).float().item()
+    return values
+
+
+def calculate_delta_norm(down_weight: torch.Tensor, up_weight: torch.Tensor) -> float:
+    # ||up @ down||_F without building the full matrix: ||UD||^2 = sum((U^T U) * (D D^T)), both are rank x rank
+    down_weight = down_weight.float().reshape(down_weight.shape[0], -1)
+    up_weight = up_weight.float().reshape(up_weight.shape[0], -1)
+    norm_sq = torch.sum((up_weight.T @ up_weight) * (down_weight @ down_weight.T))
+    return float(torch.sqrt(torch.clamp(norm_sq, min=0)))
+
+
+def scan_file(file_name: str, calc_norms: bool) -> dict:
+    stat = os.stat(file_name)
+    entry = {name: None for name, _ in COLUMNS}
+    entry.update({"path": file_name, "mtime": stat.st_mtime, "size": stat.st_size})
+
+    try:
+        tensor_infos, metadata, data_start = load_safetensors_header(file_name)
+        metadata = metadata or {}
+        modules = get_lora_modules(tensor_infos)
+
+        alpha_keys = [m + ".alpha" for m in modules.keys() if m + ".alpha" in tensor_infos]
+        alphas = read_scalars(file_name, data_start, tensor_infos, alpha_keys)
+
+        num_params = 0
+        for info in tensor_infos.values():
+            n = 1
+            for s in info["shape"]:
+                n *= s
+            num_params += n
+
+        entry.update(
+            {
+                "network_module": metadata.get("ss_network_module"),
+                "base_model_version": metadata.get("ss_base_model_version", metadata.get("modelspec.architecture")),
+                "title": metadata.get("modelspec.title", metadata.get("ss_output_name")),
+                "num_modules": len(modules),
+                "num_params": num_params,
+                "has_text_encoder": any(m.startswith("lora_te") for m in modules.keys()),
+                "dims": sorted(set(tensor_infos[m + suffix]["shape"][0] for m, suffix in modules.items())),
+                "alphas": sorted(set(alphas.values())),
+                "dtypes": sorted(set(info["dtype"] for info in tensor_infos.values())),
+                "metadata": metadata,
+            }
+        )
+
+        if calc_norms and len(modules) > 0:
+            # safe_open maps the file, so only the tensors of LoRA modules are read
+            norms = []
+            with safe_open(file_name, framework="pt") as f:
+                for module, suffix in modules.items():
+                    down_weight = f.get_tensor(module + suffix)
+                    up_weight = f.get_tensor(module + UP_SUFFIXES[suffix])
+                    scale = alphas[module + ".alpha"] / down_weight.shape[0] if module + ".alpha" in alphas else 1.0
+                    norms.append(calculate_delta_norm(down_weight, up_weight) * scale)
+            entry["norm_mean"] = sum(norms) / len(norms)
+            entry["norm_max"] = max(norms)
+    except Exception as e:
+        logger.warning(f"failed to scan / 読み込みに失敗しました: {file_name}: {e}")
+        entry["error"] = str(e)
+
+    return entry
+
+
+def load_index(index_file: str) -> Dict[str, dict]:
+    if not os.path.exists(index_file):
+        return {}
+
+    if index_file.lower().endswith(".json"):
+        with open(index_file, "r", encoding="utf-8") as f:
+            return {entry["path"]: entry for entry in json.load(f)}
+
+    with contextlib.closing(sqlite3.connect(index_file)) as conn, conn:  # closingで接続を閉じ、connでcommitする
+        conn.row_factory = sqlite3.Row
+        entries = {}
+        for row in conn.execute("SELECT * FROM models"):
+            entry = dict(row)
+            for name in JSON_COLUMNS:
+                if entry[name] is not None:
+                    entry[name] = json.loads(entry[name])
+            entries[entry["path"]] = entry
+    return entries
+
+
+def save_index(index_file: str, entries: Dict[str, dict]):
+    entries = [entries[path] for path in sorted(entries.keys())]
+
+    if index_file.lower().endswith(".json"):
+        tmp_file = index_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(entries, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_file, index_file)
+        return
+
+    with contextlib.closing(sqlite3.connect(index_file)) as conn, conn:
+        conn.execute("DROP TABLE IF EXISTS models")
+        conn.execute(f"CREATE TABLE models ({', '.join(f'{name} {type}' for name, type in COLUMNS)})")
+        rows = []
+        for entry in entries:
+            row = []
+            for name, _ in COLUMNS:
+                value = entry.get(name)
+                if name in JSON_COLUMNS and value is not None:
+                    value = json.dumps(value, ensure_ascii=False)
+                row.append(value)
+            rows.append(row)
+        conn.executemany(f"INSERT INTO models VALUES ({', '.join(['?'] * len(COLUMNS))})", rows)
+
+
+def is_up_to_date(entry: Optional[dict], file_name: str, calc_norms: bool) -> bool:
+    if entry is None:
+        return False
+    stat = os.stat(file_name)
+    if entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+        return False
+    return not calc_norms or entry.get("norm_mean") is not None or entry.get("error") is not None or not entry.get("num_modules")
+
+
+def main(args):
+    entries = load_index(args.index) if args.index is not None and not args.rebuild else {}
+    files = find_model_files(args.paths)
+
+    # incremental by mtime and size: scan only new or updated files
+    targets = [f for f in files if not is_up_to_date(entries.get(f), f, args.norms)]
+    logger.info(f"found {len(files)} files, {len(targets)} files to scan / {len(files)}ファイル中{len(targets)}ファイルを読み込みます")
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+        for entry in tqdm(executor.map(lambda f: scan_file(f, args.norms), targets), total=len(targets)):
+            entries[entry["path"]] = entry
+    elapsed = time.perf_counter() - start_time
+    if len(targets) > 0:
+        logger.info(f"scanned {len(targets)} files in {elapsed:.2f} sec ({len(targets) / max(elapsed, 1e-9):.1f} files/sec)")
+
+    # remove entries of deleted files
+    for path in list(entries.keys()):
+        if not os.path.exists(path):
+            del entries[path]
+
+    if args.index is not None:
+        save_index(args.index, entries)
+        logger.info(f"index is saved to / インデックスを保存しました: {args.index}")
+
+    if args.query is not None:
+        assert args.index is not None and not args.index.lower().endswith(
+            ".json"
+        ), "--query requires SQLite index / --queryにはSQLiteのインデックスが必要です"
+        with contextlib.closing(sqlite3.connect(args.index)) as conn, conn:
+            cursor = conn.execute(args.query)
+            print(",".join(d[0] for d in cursor.description))
+            for row in cursor:
+                print(",".join("" if v is None else str(v) for v in row))
+    elif args.index is None:
+        for path in files:
+            entry = entries[path]
+            print(
+                f"{path},{entry['network_module']},{entry['base_model_version']},dims={entry['dims']},alphas={entry['alphas']},"
+                + f"dtypes={entry['dtypes']},norm_mean={entry['norm_mean']},norm_max={entry['norm_max']}"
+            )
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "paths", type=str, nargs="+", help="LoRA files or directories to scan recursively / LoRAファイルまたはディレクトリ（再帰的に検索）"
+    )
+    parser.add_argument(
+        "--index",
+        type=str,
+        default=None,
+        help="index file, .json or SQLite (other extensions), updated incrementally by mtime. print results if omitted"
+        + " / インデックスファイル、.jsonまたはSQLite（その他の拡張子）。mtimeで差分更新する。省略時は結果を表示する",
+    )
+    parser.add_argument("--rebuild", action="store_true", help="ignore existing index and scan all files / 既存のインデックスを無視して全て読み込む")
+    parser.add_argument(
+        "--norms",
+        action="store_true",
+        help="calculate norms of delta weights (reads tensors) / 差分の重みのノルムを計算する（テンソルを読み込む）",
+    )
+    parser.add_argument("--max_workers", type=int, default=8, help="number of parallel workers / 並列数")
+    parser.add_argument(
+        "--query",
+        type=str,
+        default=None,
+        help='SQL to run against the SQLite index, e.g. "SELECT path, dims FROM models WHERE base_model_version LIKE \'sdxl%%\'"'
+        + " / SQLiteのインデックスに対して実行するSQL",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+
+    args = parser.parse_args()
+    main(args)
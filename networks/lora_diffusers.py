@@ -274,6 +274,22 @@ def merge_lora_weights(pipe, weights_sd: Dict, multiplier: float = 1.0):
     lora_network.merge_to(multiplier=multiplier)
 
 
+def apply_stacked_lora_weights(pipe, weights_sds: List[Dict], multipliers: Optional[List[float]] = None):
+    text_encoders = [pipe.text_encoder, pipe.text_encoder_2] if hasattr(pipe, "text_encoder_2") else [pipe.text_encoder]
+    unet = pipe.unet
+
+    networks = []
+    for weights_sd in weights_sds:
+        lora_network = create_network_from_weights(text_encoders, unet, weights_sd)
+        lora_network.load_state_dict(weights_sd)
+        networks.append(lora_network)
+
+    stacked_network = StackedLoRANetwork(networks, multipliers)
+    stacked_network.to(unet.device, dtype=unet.dtype)
+    stacked_network.apply_to()
+    return stacked_network
+
+
 # block weightや学習に対応しない簡易版 / simple version without block weight and training
 class LoRANetwork(torch.nn.Module):
     UNET_TARGET_REPLACE_MODULE = ["Transformer2DModel"]
@@ -476,6 +492,128 @@ class LoRANetwork(torch.nn.Module):
         return super().load_state_dict(state_dict, strict)
 
 
+class StackedLoRAModule(torch.nn.Module):
+    """
+    LoRA modules of multiple networks for one original module, stacked into one wider low-rank pair.
+    down weights are concatenated along the rank and up weights along the input, so the cost is one matmul pair
+    regardless of the number of LoRAs. multiplier * scale of each LoRA is applied per rank, and can be changed without re-merging.
+    複数のLoRAのdown/upをrank方向に結合し、LoRAの数によらず一組の行列積で計算する
+    """
+
+    def __init__(self, lora_name, loras: List[LoRAModule], network_indices: List[int]):
+        super().__init__()
+        self.lora_name = lora_name
+        self.org_module = loras[0].org_module
+        self.network_indices = network_indices
+        self.ranks = [lora.lora_dim for lora in loras]
+        self.scales = [lora.scale for lora in loras]
+
+        down_weight = torch.cat([lora.lora_down.weight for lora in loras], dim=0)
+        up_weight = torch.cat([lora.lora_up.weight for lora in loras], dim=1)
+        lora_dim = down_weight.size()[0]
+
+        org_module = self.org_module[0]
+        self.is_conv2d = org_module.__class__.__name__ == "Conv2d" or org_module.__class__.__name__ == "LoRACompatibleConv"
+        if self.is_conv2d:
+            self.lora_down = torch.nn.Conv2d(
+                org_module.in_channels, lora_dim, org_module.kernel_size, org_module.stride, org_module.padding, bias=False
+            )
+            self.lora_up = torch.nn.Conv2d(lora_dim, org_module.out_channels, (1, 1), (1, 1), bias=False)
+        else:
+            self.lora_down = torch.nn.Linear(org_module.in_features, lora_dim, bias=False)
+            self.lora_up = torch.nn.Linear(lora_dim, org_module.out_features, bias=False)
+        self.lora_down.weight = torch.nn.Parameter(down_weight, requires_grad=False)
+        self.lora_up.weight = torch.nn.Parameter(up_weight, requires_grad=False)
+
+        # multiplier * scale for each rank
+        self.register_buffer("rank_scale", torch.zeros(lora_dim), persistent=False)
+
+        self.enabled = True
+        self.org_forward = None
+
+    def set_multipliers(self, multipliers: List[float]):
+        rank_scale = []
+        for network_index, rank, scale in zip(self.network_indices, self.ranks, self.scales):
+            rank_scale += [float(multipliers[network_index] * scale)] * rank
+        self.rank_scale.copy_(torch.tensor(rank_scale))
+
+    def apply_to(self):
+        if self.org_forward is None:
+            self.org_forward = self.org_module[0].forward
+            self.org_module[0].forward = self.forward
+
+    def unapply_to(self):
+        if self.org_forward is not None:
+            self.org_module[0].forward = self.org_forward
+            self.org_forward = None
+
+    # scale is used LoRACompatibleConv, but we ignore it because we have multipliers
+    def forward(self, x, scale=1.0):
+        if not self.enabled:
+            return self.org_forward(x)
+        lx = self.lora_down(x)
+        rank_scale = self.rank_scale.view(1, -1, 1, 1) if self.is_conv2d else self.rank_scale
+        return self.org_forward(x) + self.lora_up(lx * rank_scale)
+
+
+class StackedLoRANetwork(torch.nn.Module):
+    """
+    apply multiple LoRA networks with one StackedLoRAModule per original module.
+    networks must be created by create_network_from_weights and loaded, but not applied.
+    """
+
+    def __init__(self, networks: List[LoRANetwork], multipliers: Optional[List[float]] = None) -> None:
+        super().__init__()
+
+        # group LoRA modules of all networks by the original module, keeping the order of networks
+        groups: Dict[int, List] = {}
+        for network_index, network in enumerate(networks):
+            for lora in network.text_encoder_loras + network.unet_loras:
+                groups.setdefault(id(lora.org_module[0]), []).append((network_index, lora))
+
+        self.text_encoder_loras: List[StackedLoRAModule] = []
+        self.unet_loras: List[StackedLoRAModule] = []
+        for group in groups.values():
+            network_indices = [network_index for network_index, _ in group]
+            loras = [lora for _, lora in group]
+            stacked = StackedLoRAModule(loras[0].lora_name, loras, network_indices)
+            if stacked.lora_name.startswith(LoRANetwork.LORA_PREFIX_TEXT_ENCODER):
+                self.text_encoder_loras.append(stacked)
+            else:
+                self.unet_loras.append(stacked)
+        logger.info(
+            f"stack {len(networks)} LoRA networks: {len(self.text_encoder_loras)} modules for Text Encoder, "
+            + f"{len(self.unet_loras)} modules for U-Net"
+        )
+
+        for lora in self.text_encoder_loras + self.unet_loras:
+            self.add_module(lora.lora_name, lora)
+
+        if multipliers is None:
+            multipliers = [network.multiplier for network in networks]
+        self.set_multipliers(multipliers)
+
+    def set_multipliers(self, multipliers: List[float]):
+        # only the per-rank scales are updated, weights are not re-merged
+        self.multipliers = list(multipliers)
+        for lora in self.text_encoder_loras + self.unet_loras:
+            lora.set_multipliers(self.multipliers)
+
+    def apply_to(self, apply_text_encoder=True, apply_unet=True):
+        if apply_text_encoder:
+            logger.info("enable stacked LoRA for text encoder")
+            for lora in self.text_encoder_loras:
+                lora.apply_to()
+        if apply_unet:
+            logger.info("enable stacked LoRA for U-Net")
+            for lora in self.unet_loras:
+                lora.apply_to()
+
+    def unapply_to(self):
+        for lora in self.text_encoder_loras + self.unet_loras:
+            lora.unapply_to()
+
+
 if __name__ == "__main__":
     # sample code to use LoRANetwork
     import os
@@ -614,3 +752,38 @@ if __name__ == "__main__":
     seed_everything(args.seed)
     image = pipe(args.prompt, negative_prompt=args.negative_prompt).images[0]
     image.save(image_prefix + "convenience_merged_lora.png")
+
+    # restore original weights
+    logger.info(f"restore original weights")
+    pipe.unet.load_state_dict(org_unet_sd)
+    pipe.text_encoder.load_state_dict(org_text_encoder_sd)
+    if args.sdxl:
+        pipe.text_encoder_2.load_state_dict(org_text_encoder_2_sd)
+
+    # apply multiple LoRAs stacked into one low-rank pair per module. here the same LoRA twice with multiplier 0.5,
+    # so the image should be same as "applied_lora.png"
+    logger.info(f"apply stacked LoRA networks to the model")
+    stacked_multipliers = [0.5, 0.5]
+    stacked_network = apply_stacked_lora_weights(pipe, [lora_sd, lora_sd], stacked_multipliers)
+
+    # check that the stacked forward is the sum of the forwards of each LoRA
+    lora_modules = {lora.lora_name: lora for lora in lora_network.text_encoder_loras + lora_network.unet_loras}
+    with torch.no_grad():
+        for stacked in stacked_network.text_encoder_loras + stacked_network.unet_loras:
+            lora = lora_modules[stacked.lora_name]
+            if stacked.is_conv2d:
+                x = torch.randn(1, stacked.lora_down.in_channels, 16, 16, device=device, dtype=pipe.unet.dtype)
+            else:
+                x = torch.randn(1, 4, stacked.lora_down.in_features, device=device, dtype=pipe.unet.dtype)
+            expected = stacked.org_forward(x)
+            for multiplier in stacked_multipliers:
+                expected = expected + lora.lora_up(lora.lora_down(x)) * multiplier * lora.scale
+            assert torch.allclose(stacked(x), expected, rtol=1e-2, atol=1e-2), f"stacked LoRA differs: {stacked.lora_name}"
+    logger.info(f"stacked LoRA is same as the sum of LoRAs")
+
+    logger.info(f"create image with stacked LoRA")
+    seed_everything(args.seed)
+    image = pipe(args.prompt, negative_prompt=args.negative_prompt).images[0]
+    image.save(image_prefix + "stacked_lora.png")
+
+    stacked_network.unapply_to()
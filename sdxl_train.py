@@ -192,6 +192,9 @@ def train(args):
             train_dataset_group.is_latent_cacheable()
         ), "when caching latents, either color_aug or random_crop cannot be used / latentをキャッシュするときはcolor_augとrandom_cropは使えません"
 
+    if args.image_cache_dir is not None and not cache_latents:
+        train_dataset_group.enable_image_cache(args.image_cache_dir, args.image_cache_max_size)
+
     if args.cache_text_encoder_outputs:
         assert (
             train_dataset_group.is_text_encoder_output_cacheable()
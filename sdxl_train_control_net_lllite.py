@@ -134,6 +134,9 @@ def train(args):
             "WARNING: random_crop is not supported yet for ControlNet training / ControlNetの学習ではrandom_cropはまだサポートされていません"
         )
 
+    if args.image_cache_dir is not None and not cache_latents:
+        train_dataset_group.enable_image_cache(args.image_cache_dir, args.image_cache_max_size)
+
     if args.cache_text_encoder_outputs:
         assert (
             train_dataset_group.is_text_encoder_output_cacheable()
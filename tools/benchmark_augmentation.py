@@ -0,0 +1,99 @@
+# 画像1枚ずつのaugmentation（AugHelper）とバッチ単位のaugmentation（BatchAugHelper）の速度を比較する
+# python tools/benchmark_augmentation.py [--batch_size 8] [--resolution 1024,1024] [--device cuda]
+
+import argparse
+import random
+import time
+
+import numpy as np
+import torch
+
+from library import train_util
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def make_images(num_images, width, height, seed):
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(num_images)]
+
+
+def augment_per_image(aug_helper, images, batch_size):
+    # 従来のデータセットと同じく、uint8の画像1枚ずつにcolor augとflipを行ってからtensorにする
+    batches = []
+    for i in range(0, len(images), batch_size):
+        batch = []
+        for img in images[i : i + batch_size]:
+            img = img.copy()
+            img = aug_helper.color_aug(img)["image"]
+            if random.random() < 0.5:
+                img = img[:, ::-1, :].copy()  # copy to avoid negative stride problem
+            batch.append(train_util.IMAGE_TRANSFORMS(img))
+        batches.append(torch.stack(batch).to(memory_format=torch.contiguous_format).float())
+    return batches
+
+
+def augment_batched(batch_aug_helper, images, batch_size, device, seed):
+    # tensorにしてから、バッチ単位でcolor augとflipを行う
+    batches = []
+    for step, i in enumerate(range(0, len(images), batch_size)):
+        batch = [train_util.IMAGE_TRANSFORMS(img) for img in images[i : i + batch_size]]
+        batch = torch.stack(batch).to(memory_format=torch.contiguous_format).float().to(device)
+
+        generator = torch.Generator().manual_seed(seed + step)
+        use_color_aug = torch.ones(len(batch), dtype=torch.bool)
+        flipped = torch.rand(len(batch), generator=generator) < 0.5
+        batch = batch_aug_helper.color_aug(batch, use_color_aug, generator)
+        batch = batch_aug_helper.flip(batch, flipped)
+        batches.append(batch)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return batches
+
+
+def main(args):
+    width, height = [int(r) for r in args.resolution.split(",")]
+    device = torch.device(args.device)
+    images = make_images(args.num_images, width, height, args.seed)
+    logger.info(f"{len(images)} images, {width}x{height}, batch size {args.batch_size}, device {device}")
+
+    random.seed(args.seed)
+    start_time = time.perf_counter()
+    augment_per_image(train_util.AugHelper(), images, args.batch_size)
+    per_image_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    batched = augment_batched(train_util.BatchAugHelper(), images, args.batch_size, device, args.seed)
+    batched_time = time.perf_counter() - start_time
+
+    for name, elapsed in [("per image", per_image_time), ("batched", batched_time)]:
+        logger.info(f"{name}: {len(images) / elapsed:.1f} images/sec")
+    logger.info(f"speedup: {per_image_time / batched_time:.2f}x")
+
+    # 同じseedなら同じ結果になることを確認する
+    batched_again = augment_batched(train_util.BatchAugHelper(), images, args.batch_size, device, args.seed)
+    if all([torch.equal(a, b) for a, b in zip(batched, batched_again)]):
+        logger.info("batched augmentation is reproducible with the same seed / 同じseedで同じ結果になりました")
+    else:
+        logger.error("batched augmentation is not reproducible / 同じseedで結果が一致しません")
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_images", type=int, default=256, help="number of images / 画像数")
+    parser.add_argument("--batch_size", type=int, default=8, help="batch size / バッチサイズ")
+    parser.add_argument("--resolution", type=str, default="512,512", help="image size (width,height) / 画像サイズ（幅,高さ）")
+    parser.add_argument("--device", type=str, default="cpu", help="device for batched augmentation / バッチ単位のaugmentationを行うデバイス")
+    parser.add_argument("--seed", type=int, default=0, help="random seed / 乱数のseed")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+
+    args = parser.parse_args()
+    main(args)
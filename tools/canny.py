@@ -1,11 +1,23 @@
 import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import cv2
+import numpy as np
+from tqdm import tqdm
 
 import logging
-from library.utils import setup_logging
+from library.utils import setup_logging, pil_resize
 setup_logging()
 logger = logging.getLogger(__name__)
 
+IMAGE_EXTENSIONS = [".png", ".jpg", ".jpeg", ".webp", ".bmp"]
+
+_bucket_managers = {}                   # bucket settings -> BucketManager, for each worker process
+
+
 def canny(args):
   img = cv2.imread(args.input)
   img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
@@ -17,12 +29,110 @@ def canny(args):
   logger.info("done!")
 
 
+def get_bucket_manager(bucket_settings):
+  # 学習時と同じbucketを選ぶ。train_utilの読み込みは重いので必要な時だけ
+  if bucket_settings not in _bucket_managers:
+    from library.train_util import BucketManager
+
+    resolution, enable_bucket, min_bucket_reso, max_bucket_reso, bucket_reso_steps, bucket_no_upscale = bucket_settings
+    if enable_bucket:
+      bucket_manager = BucketManager(bucket_no_upscale, resolution, min_bucket_reso, max_bucket_reso, bucket_reso_steps)
+      if not bucket_no_upscale:
+        bucket_manager.make_buckets()
+    else:
+      bucket_manager = BucketManager(False, resolution, None, None, None)
+      bucket_manager.set_predefined_resos([resolution])
+    _bucket_managers[bucket_settings] = bucket_manager
+  return _bucket_managers[bucket_settings]
+
+
+def resize_to_bucket(hint, bucket_settings):
+  # ControlNetDatasetが学習時に制御用画像に行うのと同じリサイズとcropをする
+  bucket_manager = get_bucket_manager(bucket_settings)
+  height, width = hint.shape[0:2]
+  bucket_reso, resized_size, _ = bucket_manager.select_bucket(width, height)
+
+  hint = cv2.cvtColor(hint, cv2.COLOR_GRAY2BGR)
+  enable_bucket = bucket_settings[1]
+  if enable_bucket:
+    hint = cv2.resize(hint, resized_size, interpolation=cv2.INTER_AREA)
+    ct = (hint.shape[0] - bucket_reso[1]) // 2
+    cl = (hint.shape[1] - bucket_reso[0]) // 2
+    hint = hint[ct:ct + bucket_reso[1], cl:cl + bucket_reso[0]]
+  elif hint.shape[0] != bucket_reso[1] or hint.shape[1] != bucket_reso[0]:
+    hint = pil_resize(hint, bucket_reso)
+  return hint
+
+
+def process_file(src_file, dst_file, thres1, thres2, bucket_settings):
+  # ワーカープロセスで実行される。日本語ファイル名に対応するためimdecode/imencodeを使う
+  img = cv2.imdecode(np.fromfile(src_file, np.uint8), cv2.IMREAD_GRAYSCALE)
+  if img is None:
+    logger.error(f"Could not load image path / 画像を読み込めません: {src_file}")
+    return False
+
+  hint = cv2.Canny(img, thres1, thres2)
+  if bucket_settings is not None:
+    hint = resize_to_bucket(hint, bucket_settings)
+
+  _, buf = cv2.imencode(".png", hint)
+  with open(dst_file, "wb") as f:
+    buf.tofile(f)
+  return True
+
+
+def canny_dir(args):
+  src_files = []
+  for ext in IMAGE_EXTENSIONS:
+    src_files += glob.glob(os.path.join(glob.escape(args.input_dir), "*" + ext))
+  src_files.sort()
+  logger.info(f"found {len(src_files)} images.")
+  os.makedirs(args.output_dir, exist_ok=True)
+
+  bucket_settings = None
+  if args.resolution is not None:
+    resolution = tuple([int(r) for r in args.resolution.split(",")])
+    if len(resolution) == 1:
+      resolution = (resolution[0], resolution[0])
+    bucket_settings = (resolution, args.enable_bucket, args.min_bucket_reso, args.max_bucket_reso, args.bucket_reso_steps,
+                       args.bucket_no_upscale)
+
+  # 制御用画像は学習画像と同じファイル名（拡張子は.png）で保存する
+  dst_files = [os.path.join(args.output_dir, os.path.splitext(os.path.basename(f))[0] + ".png") for f in src_files]
+
+  start_time = time.perf_counter()
+  num_processed = 0
+  with ProcessPoolExecutor(max_workers=args.max_workers) as executor:
+    futures = [executor.submit(process_file, src_file, dst_file, args.thres1, args.thres2, bucket_settings)
+               for src_file, dst_file in zip(src_files, dst_files)]
+    for future in tqdm(futures, smoothing=0.0):
+      num_processed += 1 if future.result() else 0
+
+  elapsed = time.perf_counter() - start_time
+  logger.info(f"processed {num_processed} images in {elapsed:.1f} sec ({num_processed / max(elapsed, 1e-9):.2f} images/sec)")
+
+
 def setup_parser() -> argparse.ArgumentParser:
   parser = argparse.ArgumentParser()
   parser.add_argument("--input", type=str, default=None, help="input path")
   parser.add_argument("--output", type=str, default=None, help="output path")
   parser.add_argument("--thres1", type=int, default=32, help="thres1")
   parser.add_argument("--thres2", type=int, default=224, help="thres2")
+  parser.add_argument("--input_dir", type=str, default=None,
+                      help="process all images in this directory instead of --input / --inputの代わりにこのディレクトリ内の全画像を処理する")
+  parser.add_argument("--output_dir", type=str, default=None,
+                      help="directory to save the images with the same names as the inputs (conditioning_data_dir)"
+                      + " / 入力と同じファイル名で画像を保存するディレクトリ（conditioning_data_dir）")
+  parser.add_argument("--max_workers", type=int, default=None,
+                      help="number of worker processes, default is the number of CPUs / 並列に処理するワーカープロセス数、省略時はCPU数")
+  parser.add_argument("--resolution", type=str, default=None,
+                      help="resize and crop the images to the bucket resolution in training, with the same dataset options as training"
+                      + " / 学習時と同じデータセットのオプションを指定すると、学習時のbucketの解像度にリサイズ、cropする")
+  parser.add_argument("--enable_bucket", action="store_true", help="same as training / 学習時と同じ")
+  parser.add_argument("--min_bucket_reso", type=int, default=256, help="same as training / 学習時と同じ")
+  parser.add_argument("--max_bucket_reso", type=int, default=1024, help="same as training / 学習時と同じ")
+  parser.add_argument("--bucket_reso_steps", type=int, default=64, help="same as training / 学習時と同じ")
+  parser.add_argument("--bucket_no_upscale", action="store_true", help="same as training / 学習時と同じ")
 
   return parser
 
@@ -31,4 +141,7 @@ if __name__ == '__main__':
   parser = setup_parser()
 
   args = parser.parse_args()
-  canny(args)
+  if args.input_dir is not None:
+    canny_dir(args)
+  else:
+    canny(args)
@@ -12,6 +12,9 @@ import math
 import cv2
 import glob
 import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from anime_face_detector import create_detector
 from tqdm import tqdm
 import numpy as np
@@ -77,14 +80,18 @@ def rotate_image(image, angle, cx, cy):
   return result, cx, cy
 
 
-def process(args):
-  assert (not args.resize_fit) or args.resize_face_size is None, f"resize_fit and resize_face_size can't be specified both / resize_fitとresize_face_sizeはどちらか片方しか指定できません"
-  assert args.crop_ratio is None or args.resize_face_size is None, f"crop_ratio指定時はresize_face_sizeは指定できません"
+OUTPUT_EXTENSION = ".png"
+
+_detector = None                              # ワーカープロセスごとの顔検出モデル
+
 
-  # アニメ顔検出モデルを読み込む
-  logger.info("loading face detector.")
-  detector = create_detector('yolov3')
+def init_detector():
+  global _detector
+  if _detector is None:
+    _detector = create_detector('yolov3')
 
+
+def parse_crop_options(args):
   # cropの引数を解析する
   if args.crop_size is None:
     crop_width = crop_height = None
@@ -99,126 +106,192 @@ def process(args):
     tokens = args.crop_ratio.split(',')
     assert len(tokens) == 2, f"crop_ratio must be 'horizontal,vertical' / crop_ratioは'幅,高さ'の倍率で指定してください"
     crop_h_ratio, crop_v_ratio = [float(t) for t in tokens]
+  return crop_width, crop_height, crop_h_ratio, crop_v_ratio
+
+
+def process_image(path, args, crop_options):
+  # 一枚の画像から顔を検出して切り出し、(ファイル名, エンコード済みの画像) のリストを返す。ワーカープロセスで実行される
+  crop_width, crop_height, crop_h_ratio, crop_v_ratio = crop_options
+  basename = os.path.splitext(os.path.basename(path))[0]
+  results = []
+
+  # image = cv2.imread(path)        # 日本語ファイル名でエラーになる
+  image = cv2.imdecode(np.fromfile(path, np.uint8), cv2.IMREAD_UNCHANGED)
+  if image is None:
+    logger.error(f"Could not load image path / 画像を読み込めません: {path}")
+    return path, results
+  if len(image.shape) == 2:
+    image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+  if image.shape[2] == 4:
+    logger.warning(f"image has alpha. ignore / 画像の透明度が設定されているため無視します: {path}")
+    image = image[:, :, :3].copy()                    # copyをしないと内部的に透明度情報が付いたままになるらしい
+
+  h, w = image.shape[:2]
+
+  faces = detect_faces(_detector, image, args.multiple_faces)
+  for i, face in enumerate(faces):
+    cx, cy, fw, fh, angle = face
+    face_size = max(fw, fh)
+    if args.min_size is not None and face_size < args.min_size:
+      continue
+    if args.max_size is not None and face_size >= args.max_size:
+      continue
+    face_suffix = f"_{i+1:02d}" if args.multiple_faces else ""
+
+    # オプション指定があれば回転する
+    face_img = image
+    if args.rotate:
+      face_img, cx, cy = rotate_image(face_img, angle, cx, cy)
+
+    # オプション指定があれば顔を中心に切り出す
+    if crop_width is not None or crop_h_ratio is not None:
+      cur_crop_width, cur_crop_height = crop_width, crop_height
+      if crop_h_ratio is not None:
+        cur_crop_width = int(face_size * crop_h_ratio + .5)
+        cur_crop_height = int(face_size * crop_v_ratio + .5)
+
+      # リサイズを必要なら行う
+      scale = 1.0
+      if args.resize_face_size is not None:
+        # 顔サイズを基準にリサイズする
+        scale = args.resize_face_size / face_size
+        if scale < cur_crop_width / w:
+          logger.warning(
+              f"image width too small in face size based resizing / 顔を基準にリサイズすると画像の幅がcrop sizeより小さい（顔が相対的に大きすぎる）ので顔サイズが変わります: {path}")
+          scale = cur_crop_width / w
+        if scale < cur_crop_height / h:
+          logger.warning(
+              f"image height too small in face size based resizing / 顔を基準にリサイズすると画像の高さがcrop sizeより小さい（顔が相対的に大きすぎる）ので顔サイズが変わります: {path}")
+          scale = cur_crop_height / h
+      elif crop_h_ratio is not None:
+        # 倍率指定の時にはリサイズしない
+        pass
+      else:
+        # 切り出しサイズ指定あり
+        if w < cur_crop_width:
+          logger.warning(f"image width too small/ 画像の幅がcrop sizeより小さいので画質が劣化します: {path}")
+          scale = cur_crop_width / w
+        if h < cur_crop_height:
+          logger.warning(f"image height too small/ 画像の高さがcrop sizeより小さいので画質が劣化します: {path}")
+          scale = cur_crop_height / h
+        if args.resize_fit:
+          scale = max(cur_crop_width / w, cur_crop_height / h)
+
+      if scale != 1.0:
+        w = int(w * scale + .5)
+        h = int(h * scale + .5)
+        if scale < 1.0:
+          face_img = cv2.resize(face_img, (w, h), interpolation=cv2.INTER_AREA)
+        else:
+          face_img = pil_resize(face_img, (w, h))
+        cx = int(cx * scale + .5)
+        cy = int(cy * scale + .5)
+        fw = int(fw * scale + .5)
+        fh = int(fh * scale + .5)
+
+      cur_crop_width = min(cur_crop_width, face_img.shape[1])
+      cur_crop_height = min(cur_crop_height, face_img.shape[0])
+
+      x = cx - cur_crop_width // 2
+      cx = cur_crop_width // 2
+      if x < 0:
+        cx = cx + x
+        x = 0
+      elif x + cur_crop_width > w:
+        cx = cx + (x + cur_crop_width - w)
+        x = w - cur_crop_width
+      face_img = face_img[:, x:x+cur_crop_width]
+
+      y = cy - cur_crop_height // 2
+      cy = cur_crop_height // 2
+      if y < 0:
+        cy = cy + y
+        y = 0
+      elif y + cur_crop_height > h:
+        cy = cy + (y + cur_crop_height - h)
+        y = h - cur_crop_height
+      face_img = face_img[y:y + cur_crop_height]
+
+    # # debug
+    # logger.info(path, cx, cy, angle)
+    # crp = cv2.resize(image, (image.shape[1]//8, image.shape[0]//8))
+    # cv2.imshow("image", crp)
+    # if cv2.waitKey() == 27:
+    #   break
+    # cv2.destroyAllWindows()
+
+    # debug
+    if args.debug:
+      cv2.rectangle(face_img, (cx-fw//2, cy-fh//2), (cx+fw//2, cy+fh//2), (255, 0, 255), fw//20)
+
+    _, buf = cv2.imencode(OUTPUT_EXTENSION, face_img)
+    results.append((f"{basename}{face_suffix}_{cx:04d}_{cy:04d}_{fw:04d}_{fh:04d}{OUTPUT_EXTENSION}", buf))
+
+  return path, results
+
+
+def iterate_processed_images(paths, args, crop_options):
+  r"""
+  Yields (path, [(file name, encoded image), ...]) in order. With `num_workers`, each worker process has its own detector
+  and processes the images in parallel, at most `num_workers * 4` images ahead.
+  """
+  if not args.num_workers:
+    init_detector()
+    for path in paths:
+      yield process_image(path, args, crop_options)
+    return
+
+  prefetch = args.num_workers * 4
+  with ProcessPoolExecutor(max_workers=args.num_workers, initializer=init_detector) as executor:
+    paths = iter(paths)
+    futures = deque()
+    for path in paths:
+      futures.append(executor.submit(process_image, path, args, crop_options))
+      if len(futures) >= prefetch:
+        break
+
+    while len(futures) > 0:
+      future = futures.popleft()
+      next_path = next(paths, None)
+      if next_path is not None:
+        futures.append(executor.submit(process_image, next_path, args, crop_options))
+      yield future.result()
+
+
+def write_image(file_name, buf):
+  with open(file_name, "wb") as f:
+    buf.tofile(f)
 
-  # 画像を処理する
-  logger.info("processing.")
-  output_extension = ".png"
+
+def process(args):
+  assert (not args.resize_fit) or args.resize_face_size is None, f"resize_fit and resize_face_size can't be specified both / resize_fitとresize_face_sizeはどちらか片方しか指定できません"
+  assert args.crop_ratio is None or args.resize_face_size is None, f"crop_ratio指定時はresize_face_sizeは指定できません"
+
+  crop_options = parse_crop_options(args)
+
+  # 画像を処理する：顔検出モデルは各ワーカープロセス（ワーカーなしの場合はこのプロセス）で読み込む
+  logger.info("loading face detector and processing.")
 
   os.makedirs(args.dst_dir, exist_ok=True)
   paths = glob.glob(os.path.join(args.src_dir, "*.png")) + glob.glob(os.path.join(args.src_dir, "*.jpg")) + \
       glob.glob(os.path.join(args.src_dir, "*.webp"))
-  for path in tqdm(paths):
-    basename = os.path.splitext(os.path.basename(path))[0]
-
-    # image = cv2.imread(path)        # 日本語ファイル名でエラーになる
-    image = cv2.imdecode(np.fromfile(path, np.uint8), cv2.IMREAD_UNCHANGED)
-    if len(image.shape) == 2:
-      image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
-    if image.shape[2] == 4:
-      logger.warning(f"image has alpha. ignore / 画像の透明度が設定されているため無視します: {path}")
-      image = image[:, :, :3].copy()                    # copyをしないと内部的に透明度情報が付いたままになるらしい
-
-    h, w = image.shape[:2]
-
-    faces = detect_faces(detector, image, args.multiple_faces)
-    for i, face in enumerate(faces):
-      cx, cy, fw, fh, angle = face
-      face_size = max(fw, fh)
-      if args.min_size is not None and face_size < args.min_size:
-        continue
-      if args.max_size is not None and face_size >= args.max_size:
-        continue
-      face_suffix = f"_{i+1:02d}" if args.multiple_faces else ""
-
-      # オプション指定があれば回転する
-      face_img = image
-      if args.rotate:
-        face_img, cx, cy = rotate_image(face_img, angle, cx, cy)
-
-      # オプション指定があれば顔を中心に切り出す
-      if crop_width is not None or crop_h_ratio is not None:
-        cur_crop_width, cur_crop_height = crop_width, crop_height
-        if crop_h_ratio is not None:
-          cur_crop_width = int(face_size * crop_h_ratio + .5)
-          cur_crop_height = int(face_size * crop_v_ratio + .5)
-
-        # リサイズを必要なら行う
-        scale = 1.0
-        if args.resize_face_size is not None:
-          # 顔サイズを基準にリサイズする
-          scale = args.resize_face_size / face_size
-          if scale < cur_crop_width / w:
-            logger.warning(
-                f"image width too small in face size based resizing / 顔を基準にリサイズすると画像の幅がcrop sizeより小さい（顔が相対的に大きすぎる）ので顔サイズが変わります: {path}")
-            scale = cur_crop_width / w
-          if scale < cur_crop_height / h:
-            logger.warning(
-                f"image height too small in face size based resizing / 顔を基準にリサイズすると画像の高さがcrop sizeより小さい（顔が相対的に大きすぎる）ので顔サイズが変わります: {path}")
-            scale = cur_crop_height / h
-        elif crop_h_ratio is not None:
-          # 倍率指定の時にはリサイズしない
-          pass
-        else:
-          # 切り出しサイズ指定あり
-          if w < cur_crop_width:
-            logger.warning(f"image width too small/ 画像の幅がcrop sizeより小さいので画質が劣化します: {path}")
-            scale = cur_crop_width / w
-          if h < cur_crop_height:
-            logger.warning(f"image height too small/ 画像の高さがcrop sizeより小さいので画質が劣化します: {path}")
-            scale = cur_crop_height / h
-          if args.resize_fit:
-            scale = max(cur_crop_width / w, cur_crop_height / h)
-
-        if scale != 1.0:
-          w = int(w * scale + .5)
-          h = int(h * scale + .5)
-          if scale < 1.0:
-            face_img = cv2.resize(face_img, (w, h), interpolation=cv2.INTER_AREA)
-          else:
-            face_img = pil_resize(face_img, (w, h))
-          cx = int(cx * scale + .5)
-          cy = int(cy * scale + .5)
-          fw = int(fw * scale + .5)
-          fh = int(fh * scale + .5)
-
-        cur_crop_width = min(cur_crop_width, face_img.shape[1])
-        cur_crop_height = min(cur_crop_height, face_img.shape[0])
-
-        x = cx - cur_crop_width // 2
-        cx = cur_crop_width // 2
-        if x < 0:
-          cx = cx + x
-          x = 0
-        elif x + cur_crop_width > w:
-          cx = cx + (x + cur_crop_width - w)
-          x = w - cur_crop_width
-        face_img = face_img[:, x:x+cur_crop_width]
-
-        y = cy - cur_crop_height // 2
-        cy = cur_crop_height // 2
-        if y < 0:
-          cy = cy + y
-          y = 0
-        elif y + cur_crop_height > h:
-          cy = cy + (y + cur_crop_height - h)
-          y = h - cur_crop_height
-        face_img = face_img[y:y + cur_crop_height]
-
-      # # debug
-      # logger.info(path, cx, cy, angle)
-      # crp = cv2.resize(image, (image.shape[1]//8, image.shape[0]//8))
-      # cv2.imshow("image", crp)
-      # if cv2.waitKey() == 27:
-      #   break
-      # cv2.destroyAllWindows()
-
-      # debug
-      if args.debug:
-        cv2.rectangle(face_img, (cx-fw//2, cy-fh//2), (cx+fw//2, cy+fh//2), (255, 0, 255), fw//20)
-
-      _, buf = cv2.imencode(output_extension, face_img)
-      with open(os.path.join(args.dst_dir, f"{basename}{face_suffix}_{cx:04d}_{cy:04d}_{fw:04d}_{fh:04d}{output_extension}"), "wb") as f:
-        buf.tofile(f)
+
+  # 書き込みは別スレッドで順番に行う
+  start_time = time.perf_counter()
+  num_faces = 0
+  with ThreadPoolExecutor(max_workers=1) as writer:
+    writes = deque()
+    for _, results in tqdm(iterate_processed_images(paths, args, crop_options), total=len(paths), smoothing=0.0):
+      for file_name, buf in results:
+        writes.append(writer.submit(write_image, os.path.join(args.dst_dir, file_name), buf))
+        num_faces += 1
+      while len(writes) > 0 and (writes[0].done() or len(writes) > 64):
+        writes.popleft().result()                 # 書き込みエラーがあればここで例外になる
+    for future in writes:
+      future.result()
+
+  elapsed = time.perf_counter() - start_time
+  logger.info(f"processed {len(paths)} images, {num_faces} faces in {elapsed:.1f} sec ({len(paths) / max(elapsed, 1e-9):.2f} images/sec)")
 
 
 def setup_parser() -> argparse.ArgumentParser:
@@ -241,6 +314,8 @@ def setup_parser() -> argparse.ArgumentParser:
   parser.add_argument("--multiple_faces", action="store_true",
                       help="output each faces / 複数の顔が見つかった場合、それぞれを切り出す")
   parser.add_argument("--debug", action="store_true", help="render rect for face / 処理後画像の顔位置に矩形を描画します")
+  parser.add_argument("--num_workers", type=int, default=None,
+                      help="number of worker processes, each loads the face detector / 並列に処理するワーカープロセス数（それぞれ顔検出モデルを読み込む）")
 
   return parser
 
@@ -0,0 +1,108 @@
+# simple client for the generation server of gen_img.py (--server)
+# sends prompts concurrently, saves returned images and prints the server metrics
+
+import argparse
+import base64
+import http.client
+import json
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request(args, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    if args.socket is not None:
+        conn = UnixHTTPConnection(args.socket, args.timeout)
+    else:
+        conn = http.client.HTTPConnection(args.host, args.port, timeout=args.timeout)
+    try:
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        conn.request(method, path, body=data, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        result = json.loads(response.read().decode("utf-8"))
+        if response.status != 200:
+            raise RuntimeError(f"{response.status}: {result.get('error')}")
+        return result
+    finally:
+        conn.close()
+
+
+def main(args):
+    prompts = list(args.prompt or [])
+    if args.from_file is not None:
+        with open(args.from_file, "r", encoding="utf-8") as f:
+            prompts += [line for line in f.read().splitlines() if len(line.strip()) > 0 and line[0] != "#"]
+
+    loras = []
+    for i, path in enumerate(args.lora or []):
+        multiplier = 1.0 if args.lora_mul is None or len(args.lora_mul) <= i else args.lora_mul[i]
+        loras.append({"path": path, "multiplier": multiplier})
+
+    if args.outdir is not None:
+        os.makedirs(args.outdir, exist_ok=True)
+
+    def generate(index_prompt):
+        index, prompt = index_prompt
+        result = request(args, "POST", "/generate", {"prompt": prompt, "loras": loras, "return_images": args.outdir is not None})
+        for j, image in enumerate(result["images"]):
+            if args.outdir is not None:
+                file_name = os.path.join(args.outdir, f"client_{index:04d}_{j:02d}_{image['seed']}.png")
+                with open(file_name, "wb") as f:
+                    f.write(base64.b64decode(image["png_base64"]))
+        logger.info(f"{index}: {len(result['images'])} images, latency {result['latency']:.2f} sec: {prompt}")
+        return len(result["images"])
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        num_images = sum(executor.map(generate, enumerate(prompts)))
+    elapsed = time.perf_counter() - start_time
+    if len(prompts) > 0:
+        logger.info(f"{num_images} images in {elapsed:.2f} sec ({num_images / max(elapsed, 1e-9):.2f} images/sec)")
+
+    print(json.dumps(request(args, "GET", "/metrics"), indent=2))
+
+    if args.shutdown:
+        request(args, "POST", "/shutdown")
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="host of the server / サーバーのホスト")
+    parser.add_argument("--port", type=int, default=7860, help="port of the server / サーバーのポート")
+    parser.add_argument("--socket", type=str, default=None, help="Unix socket of the server / サーバーのUnixソケット")
+    parser.add_argument("--prompt", type=str, nargs="*", help="prompts with options such as --w, --d / プロンプト（--w、--d等のオプションも可）")
+    parser.add_argument("--from_file", type=str, default=None, help="load prompts from this file / プロンプトをファイルから読み込む")
+    parser.add_argument("--lora", type=str, nargs="*", help="LoRA files for the jobs / ジョブで使うLoRAファイル")
+    parser.add_argument("--lora_mul", type=float, nargs="*", help="multipliers of LoRA / LoRAの適用率")
+    parser.add_argument("--outdir", type=str, default=None, help="save returned images to this directory / 返された画像の保存先")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of concurrent requests / 同時リクエスト数")
+    parser.add_argument("--timeout", type=float, default=600, help="timeout in seconds / タイムアウト秒数")
+    parser.add_argument("--shutdown", action="store_true", help="shutdown the server after the jobs / 終了後にサーバーを停止する")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+
+    args = parser.parse_args()
+    main(args)
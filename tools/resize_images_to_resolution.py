@@ -1,28 +1,57 @@
-import glob
+import functools
+import hashlib
+import json
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 import cv2
 import argparse
 import shutil
 import math
 from PIL import Image
 import numpy as np
-from library.utils import setup_logging, pil_resize
+from library.utils import ProgressJournal, setup_logging, pil_resize
 setup_logging()
 import logging
 logger = logging.getLogger(__name__)
 
-def resize_images(src_img_folder, dst_img_folder, max_resolution="512x512", divisible_by=2, interpolation=None, save_as_png=False, copy_associated_files=False):
-  # Split the max_resolution string by "," and strip any whitespaces
-  max_resolutions = [res.strip() for res in max_resolution.split(',')]
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")                   # copy from train_util.py
 
-  # # Calculate max_pixels from max_resolution string
-  # max_pixels = int(max_resolution.split("x")[0]) * int(max_resolution.split("x")[1])
 
-  # Create destination folder if it does not exist
-  if not os.path.exists(dst_img_folder):
-    os.makedirs(dst_img_folder)
+def parse_max_resolutions(max_resolution):
+  # Split the max_resolution string by "," and strip any whitespaces
+  # the largest first, so that each resolution is resized from the previous (larger) one
+  max_resolutions = [res.strip() for res in max_resolution.split(',')]
+  return sorted(max_resolutions, key=lambda res: int(res.split("x")[0]) * int(res.split("x")[1]), reverse=True)
+
+
+def copy_file(src_file, dst_file, hardlink=False):
+  if os.path.exists(dst_file) and os.path.samefile(src_file, dst_file):
+    if os.path.realpath(src_file) == os.path.realpath(dst_file):
+      # the destination folder is the source folder: never remove the source
+      raise shutil.SameFileError(f"{src_file!r} and {dst_file!r} are the same file")
+    if hardlink:
+      return                                # already a hard link of the source
+
+  # replace the existing file: it may be a hard link of the source
+  if os.path.lexists(dst_file):
+    os.remove(dst_file)
+  if hardlink:
+    try:
+      os.link(src_file, dst_file)
+      return
+    except OSError:
+      pass                                  # different file system etc.
+  shutil.copy(src_file, dst_file)
+
+
+def resize_image_file(src_img_folder, dst_img_folder, filename, associated_files, max_resolutions, divisible_by, interpolation,
+                      save_as_png, hardlink):
+  # decode once and save all resolutions. runs in the worker processes, returns the log messages
+  messages = []
 
   # Select interpolation method
+  cv2_interpolation = pil_interpolation = None
   if interpolation == 'lanczos4':
     pil_interpolation = Image.LANCZOS
   elif interpolation == 'cubic':
@@ -30,78 +59,147 @@ def resize_images(src_img_folder, dst_img_folder, max_resolution="512x512", divi
   else:
     cv2_interpolation = cv2.INTER_AREA
 
-  # Iterate through all files in src_img_folder
-  img_exts = (".png", ".jpg", ".jpeg", ".webp", ".bmp")                   # copy from train_util.py
-  for filename in os.listdir(src_img_folder):
-    # Check if the image is png, jpg or webp etc...
-    if not filename.endswith(img_exts):
-      # Copy the file to the destination folder if not png, jpg or webp etc (.txt or .caption or etc.)
-      shutil.copy(os.path.join(src_img_folder, filename), os.path.join(dst_img_folder, filename))
-      continue
-
-    # Load image
-    # img = cv2.imread(os.path.join(src_img_folder, filename))
-    image = Image.open(os.path.join(src_img_folder, filename))
-    if not image.mode == "RGB":
-      image = image.convert("RGB")
-    img = np.array(image, np.uint8)
-
-    base, _ = os.path.splitext(filename)
-    for max_resolution in max_resolutions:
-      # Calculate max_pixels from max_resolution string
-      max_pixels = int(max_resolution.split("x")[0]) * int(max_resolution.split("x")[1])
-
-      # Calculate current number of pixels
-      current_pixels = img.shape[0] * img.shape[1]
-
-      # Check if the image needs resizing
-      if current_pixels > max_pixels:
-        # Calculate scaling factor
-        scale_factor = max_pixels / current_pixels
-
-        # Calculate new dimensions
-        new_height = int(img.shape[0] * math.sqrt(scale_factor))
-        new_width = int(img.shape[1] * math.sqrt(scale_factor))
-
-        # Resize image
-        if cv2_interpolation:
-          img = cv2.resize(img, (new_width, new_height), interpolation=cv2_interpolation)
-        else:
-          img = pil_resize(img, (new_width, new_height), interpolation=pil_interpolation)
+  # Load image
+  # img = cv2.imread(os.path.join(src_img_folder, filename))
+  image = Image.open(os.path.join(src_img_folder, filename))
+  if not image.mode == "RGB":
+    image = image.convert("RGB")
+  img = np.array(image, np.uint8)
+
+  base, _ = os.path.splitext(filename)
+  for max_resolution in max_resolutions:
+    # Calculate max_pixels from max_resolution string
+    max_pixels = int(max_resolution.split("x")[0]) * int(max_resolution.split("x")[1])
+
+    # Calculate current number of pixels
+    current_pixels = img.shape[0] * img.shape[1]
+
+    # Check if the image needs resizing
+    if current_pixels > max_pixels:
+      # Calculate scaling factor
+      scale_factor = max_pixels / current_pixels
+
+      # Calculate new dimensions
+      new_height = int(img.shape[0] * math.sqrt(scale_factor))
+      new_width = int(img.shape[1] * math.sqrt(scale_factor))
+
+      # Resize image
+      if cv2_interpolation:
+        img = cv2.resize(img, (new_width, new_height), interpolation=cv2_interpolation)
       else:
-        new_height, new_width = img.shape[0:2]
+        img = pil_resize(img, (new_width, new_height), interpolation=pil_interpolation)
+    else:
+      new_height, new_width = img.shape[0:2]
+
+    # Calculate the new height and width that are divisible by divisible_by (with/without resizing)
+    new_height = new_height if new_height % divisible_by == 0 else new_height - new_height % divisible_by
+    new_width = new_width if new_width % divisible_by == 0 else new_width - new_width % divisible_by
+
+    # Center crop the image to the calculated dimensions
+    y = int((img.shape[0] - new_height) / 2)
+    x = int((img.shape[1] - new_width) / 2)
+    img = img[y:y + new_height, x:x + new_width]
 
-      # Calculate the new height and width that are divisible by divisible_by (with/without resizing)
-      new_height = new_height if new_height % divisible_by == 0 else new_height - new_height % divisible_by
-      new_width = new_width if new_width % divisible_by == 0 else new_width - new_width % divisible_by
+    # Split filename into base and extension
+    new_filename = base + '+' + max_resolution + ('.png' if save_as_png else '.jpg')
 
-      # Center crop the image to the calculated dimensions
-      y = int((img.shape[0] - new_height) / 2)
-      x = int((img.shape[1] - new_width) / 2)
-      img = img[y:y + new_height, x:x + new_width]
+    # Save resized image in dst_img_folder
+    # cv2.imwrite(os.path.join(dst_img_folder, new_filename), img, [cv2.IMWRITE_JPEG_QUALITY, 100])
+    image = Image.fromarray(img)
+    image.save(os.path.join(dst_img_folder, new_filename), quality=100)
 
-      # Split filename into base and extension
-      new_filename = base + '+' + max_resolution + ('.png' if save_as_png else '.jpg')
+    proc = "Resized" if current_pixels > max_pixels else "Saved"
+    messages.append(f"{proc} image: {filename} with size {img.shape[0]}x{img.shape[1]} as {new_filename}")
 
-      # Save resized image in dst_img_folder
-      # cv2.imwrite(os.path.join(dst_img_folder, new_filename), img, [cv2.IMWRITE_JPEG_QUALITY, 100])
-      image = Image.fromarray(img)
-      image.save(os.path.join(dst_img_folder, new_filename), quality=100)
+  # If other files with same basename, copy them with resolution suffix
+  for asoc_file in associated_files:
+    ext = os.path.splitext(asoc_file)[1]
+    for max_resolution in max_resolutions:
+      new_asoc_file = base + '+' + max_resolution + ext
+      messages.append(f"{'Link' if hardlink else 'Copy'} {asoc_file} as {new_asoc_file}")
+      copy_file(os.path.join(src_img_folder, asoc_file), os.path.join(dst_img_folder, new_asoc_file), hardlink)
+
+  return messages
+
+
+def get_output_files(filename, associated_files, max_resolutions, save_as_png):
+  base = os.path.splitext(filename)[0]
+  output_files = []
+  for max_resolution in max_resolutions:
+    output_files.append(base + '+' + max_resolution + ('.png' if save_as_png else '.jpg'))
+    output_files += [base + '+' + max_resolution + os.path.splitext(f)[1] for f in associated_files]
+  return output_files
 
-      proc = "Resized" if current_pixels > max_pixels else "Saved"
-      logger.info(f"{proc} image: {filename} with size {img.shape[0]}x{img.shape[1]} as {new_filename}")
 
-    # If other files with same basename, copy them with resolution suffix
-    if copy_associated_files:
-      asoc_files = glob.glob(os.path.join(src_img_folder, base + ".*"))
-      for asoc_file in asoc_files:
-        ext = os.path.splitext(asoc_file)[1]
-        if ext in img_exts:
-          continue
-        for max_resolution in max_resolutions:
-          new_asoc_file = base + '+' + max_resolution + ext
-          logger.info(f"Copy {asoc_file} as {new_asoc_file}")
-          shutil.copy(os.path.join(src_img_folder, asoc_file), os.path.join(dst_img_folder, new_asoc_file))
+def resize_images(src_img_folder, dst_img_folder, max_resolution="512x512", divisible_by=2, interpolation=None, save_as_png=False,
+                  copy_associated_files=False, max_workers=None, skip_up_to_date=False, hardlink=False):
+  max_resolutions = parse_max_resolutions(max_resolution)
+
+  # # Calculate max_pixels from max_resolution string
+  # max_pixels = int(max_resolution.split("x")[0]) * int(max_resolution.split("x")[1])
+
+  # Create destination folder if it does not exist
+  if not os.path.exists(dst_img_folder):
+    os.makedirs(dst_img_folder)
+
+  # Iterate through all files in src_img_folder
+  filenames = [f for f in os.listdir(src_img_folder) if os.path.isfile(os.path.join(src_img_folder, f))]
+  image_files = [f for f in filenames if f.endswith(IMAGE_EXTENSIONS)]
+  other_files = [f for f in filenames if not f.endswith(IMAGE_EXTENSIONS)]
+
+  # files with same basename: "a.txt" and "a.b.txt" for "a.png", same as glob("a.*")
+  files_by_base = {}
+  if copy_associated_files:
+    for f in other_files:
+      for i, c in enumerate(f):
+        if c == '.':
+          files_by_base.setdefault(f[:i], []).append(f)
+
+  # 処理済みの記録: 変換元のパスと更新日時に加えて、変換の設定ごとに別のジャーナルにする
+  journal_file = None
+  if skip_up_to_date:
+    settings = json.dumps([max_resolutions, divisible_by, interpolation, save_as_png, copy_associated_files])
+    journal_file = os.path.join(dst_img_folder, f".resize_journal_{hashlib.sha256(settings.encode()).hexdigest()[:16]}.jsonl")
+
+  def is_up_to_date(src_files, output_files):
+    return all(journal.is_done(os.path.join(src_img_folder, f)) for f in src_files) and all(
+        os.path.exists(os.path.join(dst_img_folder, f)) for f in output_files)
+
+  start_time = time.perf_counter()
+  num_skipped = 0
+  with ProgressJournal(journal_file) as journal:
+    # Copy the file to the destination folder if not png, jpg or webp etc (.txt or .caption or etc.)
+    for filename in other_files:
+      if skip_up_to_date and is_up_to_date([filename], [filename]):
+        num_skipped += 1
+        continue
+      copy_file(os.path.join(src_img_folder, filename), os.path.join(dst_img_folder, filename), hardlink)
+      journal.add(os.path.join(src_img_folder, filename))
+
+    jobs = []
+    for filename in image_files:
+      associated_files = files_by_base.get(os.path.splitext(filename)[0], [])
+      output_files = get_output_files(filename, associated_files, max_resolutions, save_as_png)
+      if skip_up_to_date and is_up_to_date([filename] + associated_files, output_files):
+        num_skipped += 1
+        continue
+      jobs.append((filename, associated_files))
+
+    # 画像ごとにワーカープロセスで処理する
+    func = functools.partial(resize_image_file, src_img_folder, dst_img_folder, max_resolutions=max_resolutions,
+                             divisible_by=divisible_by, interpolation=interpolation, save_as_png=save_as_png, hardlink=hardlink)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+      futures = [executor.submit(func, filename, associated_files) for filename, associated_files in jobs]
+      for (filename, associated_files), future in zip(jobs, futures):
+        for message in future.result():
+          logger.info(message)
+        for f in [filename] + associated_files:
+          journal.add(os.path.join(src_img_folder, f))
+        journal.flush()
+
+  elapsed = time.perf_counter() - start_time
+  logger.info(f"processed {len(jobs)} images in {elapsed:.1f} sec ({len(jobs) / max(elapsed, 1e-9):.2f} images/sec),"
+              + f" skipped {num_skipped} up-to-date files")
 
 
 def setup_parser() -> argparse.ArgumentParser:
@@ -118,6 +216,14 @@ def setup_parser() -> argparse.ArgumentParser:
   parser.add_argument('--save_as_png', action='store_true', help='Save as png format / png形式で保存')
   parser.add_argument('--copy_associated_files', action='store_true',
                       help='Copy files with same base name to images (captions etc) / 画像と同じファイル名（拡張子を除く）のファイルもコピーする')
+  parser.add_argument('--max_workers', type=int, default=None,
+                      help='Number of worker processes, default is the number of CPUs / 並列に処理するワーカープロセス数、省略時はCPU数')
+  parser.add_argument('--skip_up_to_date', action='store_true',
+                      help='Skip files already processed with the same options and not modified since, recorded in a journal in the destination folder'
+                      + ' / 同じ設定で処理済みで、その後更新されていないファイルをスキップする（変換先フォルダのジャーナルに記録）')
+  parser.add_argument('--hardlink', action='store_true',
+                      help='Hard link non-image files instead of copying if possible. Editing the linked file changes the source too'
+                      + ' / 画像以外のファイルを可能ならコピーせずハードリンクする。リンクしたファイルを編集すると元のファイルも変更される')
 
   return parser
 
@@ -127,7 +233,8 @@ def main():
 
   args = parser.parse_args()
   resize_images(args.src_img_folder, args.dst_img_folder, args.max_resolution,
-                args.divisible_by, args.interpolation, args.save_as_png, args.copy_associated_files)
+                args.divisible_by, args.interpolation, args.save_as_png, args.copy_associated_files,
+                args.max_workers, args.skip_up_to_date, args.hardlink)
 
 
 if __name__ == '__main__':
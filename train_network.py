@@ -219,6 +219,9 @@ class NetworkTrainer:
                 train_dataset_group.is_latent_cacheable()
             ), "when caching latents, either color_aug or random_crop cannot be used / latentをキャッシュするときはcolor_augとrandom_cropは使えません"
 
+        if args.image_cache_dir is not None and not cache_latents:
+            train_dataset_group.enable_image_cache(args.image_cache_dir, args.image_cache_max_size)
+
         self.assert_extra_args(args, train_dataset_group)
 
         # acceleratorを準備する